@@ -7,10 +7,13 @@ logger = getLogger('chime')
 
 from os import mkdir
 from os.path import realpath, join
+import socket
+import errno
 
 from flask import Blueprint, Flask
 
 from .httpd import run_apache_forever
+from .httpd.static import run_static_forever
 from . import constants
 from . import view_functions
 
@@ -66,6 +69,30 @@ def run_apache(running_dir):
 
     return run_apache_forever(doc_root, root, port, False)
 
+def run_static_server(running_dir, port=5001):
+    ''' Serve the live site from a thread in this process, without Apache.
+
+        Every gunicorn worker calls this, and only the first to bind the port
+        gets to serve; the others log it and return None.
+    '''
+    logger.debug('Starting static server in {running_dir}'.format(**locals()))
+
+    doc_root = join(realpath(running_dir), 'master')
+
+    try:
+        mkdir(doc_root)
+    except OSError:
+        pass
+
+    try:
+        return run_static_forever(doc_root, port)
+    except socket.error as e:
+        if e.errno != errno.EADDRINUSE:
+            raise
+
+        logger.debug('Not starting static server because port {port} is already in use'.format(**locals()))
+        return None
+
 def create_app(environ):
     app = Flask(__name__, static_folder='static')
     app.secret_key = 'boop'
@@ -78,20 +105,25 @@ def create_app(environ):
     app.config['WORK_PATH'] = environ.get('WORK_PATH', '.')
     app.config['LOG_PATH'] = environ.get('LOG_PATH')
     app.config['REPO_PATH'] = environ.get('REPO_PATH', 'sample-site')
+    app.config['WORKTREE_DISK_BUDGET'] = int(environ.get('WORKTREE_DISK_BUDGET', 0)) * 1024 * 1024
     app.config['BROWSERID_URL'] = environ['BROWSERID_URL']
     app.config['SINGLE_USER'] = bool(environ.get('SINGLE_USER', False))
     app.config['AUTH_DATA_HREF'] = environ.get('AUTH_DATA_HREF', view_functions.AUTH_DATA_HREF_DEFAULT)
     app.config['LIVE_SITE_URL'] = environ.get('LIVE_SITE_URL', 'http://127.0.0.1:5001/')
+    app.config['LIVE_SITE_SERVER'] = environ.get('LIVE_SITE_SERVER', 'apache')
     app.config['PUBLISH_PATH'] = environ.get('PUBLISH_PATH')
     app.config['SNS_ALERTS_TOPIC'] = environ.get('SNS_ALERTS_TOPIC')
     app.config['SUPPORT_EMAIL_ADDRESS'] = environ.get('SUPPORT_EMAIL_ADDRESS')
     app.config['SUPPORT_PHONE_NUMBER'] = environ.get('SUPPORT_PHONE_NUMBER')
     app.config['ACCEPTANCE_TEST_MODE'] = environ.get('ACCEPTANCE_TEST_MODE', False)
-    app.config['default_branch'] = 'master'
+    app.config['default_branch'] = environ.get('DEFAULT_BRANCH', 'master')
 
-    # If no live site URL was provided, we'll use Apache to make our own.
+    # If no live site URL was provided, we'll use Apache or our own static server to make our own.
     if 'LIVE_SITE_URL' not in environ:
-        run_apache(app.config['RUNNING_STATE_DIR'])
+        if app.config['LIVE_SITE_SERVER'] == 'static':
+            run_static_server(app.config['RUNNING_STATE_DIR'])
+        else:
+            run_apache(app.config['RUNNING_STATE_DIR'])
 
     # attach routes and custom error pages here
     app.register_blueprint(chime)
@@ -138,7 +138,7 @@ class BaseActivity(object):
         # an empty summary object
         history_summary = dict(description=dict(long=u'', short=u''), changes=[])
 
-        ed_lookup = {'create': u'created', 'edit': u'edited', 'delete': u'deleted'}
+        ed_lookup = {'create': u'created', 'edit': u'edited', 'move': u'moved', 'delete': u'deleted'}
         change_lookup = {}
         display_types_encountered = []
         # we only care about edits
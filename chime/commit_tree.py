@@ -0,0 +1,150 @@
+from __future__ import absolute_import
+from logging import getLogger
+Logger = getLogger('chime.commit_tree')
+
+from io import BytesIO
+
+from git.cmd import GitCommandError
+
+def _clean_path(path):
+    ''' Normalize a repository path for lookups in a tree.
+    '''
+    return u'/'.join([item for item in (path or u'').split('/') if item and item != '.'])
+
+class CommitTree(object):
+    ''' Read-only access to the files in a single commit, without a checkout.
+
+        Paths are relative to the root of the repository, like paths
+        in the working directory; trees stand in for directories.
+    '''
+    def __init__(self, repo, commit):
+        '''
+        '''
+        self.repo = repo
+        self.commit = commit
+        self.hexsha = commit.hexsha
+
+    def __repr__(self):
+        return '<CommitTree {}>'.format(self.hexsha[:7])
+
+    def _object(self, path):
+        ''' Return the tree or blob at the passed path, or None.
+        '''
+        path = _clean_path(path)
+        if not path:
+            return self.commit.tree
+
+        try:
+            return self.commit.tree[path]
+        except KeyError:
+            return None
+
+    def exists(self, path):
+        return self._object(path) is not None
+
+    def isdir(self, path):
+        return getattr(self._object(path), 'type', None) == 'tree'
+
+    def isfile(self, path):
+        return getattr(self._object(path), 'type', None) == 'blob'
+
+    def listdir(self, path):
+        ''' Return the names of the objects in the directory at the passed path.
+        '''
+        tree = self._object(path)
+        if getattr(tree, 'type', None) != 'tree':
+            raise OSError(u'Not a directory: {}'.format(path))
+
+        return [item.name for item in tree]
+
+    def tree_sha(self, path):
+        ''' Return the SHA of the tree at the passed path, or None.
+        '''
+        tree = self._object(path)
+        if getattr(tree, 'type', None) != 'tree':
+            return None
+
+        return tree.hexsha
+
+    def blob_sha(self, path):
+        ''' Return the SHA of the blob at the passed path, or None.
+        '''
+        blob = self._object(path)
+        if getattr(blob, 'type', None) != 'blob':
+            return None
+
+        return blob.hexsha
+
+    def read(self, path):
+        ''' Return the contents of the file at the passed path.
+        '''
+        blob = self._object(path)
+        if getattr(blob, 'type', None) != 'blob':
+            raise IOError(u'No file exists at {}'.format(path))
+
+        return blob.data_stream.read()
+
+    def open(self, path):
+        ''' Return a file-like object with the contents of the file at the passed path.
+        '''
+        return BytesIO(self.read(path))
+
+    def modified_timestamp(self, path):
+        ''' Return the epoch seconds of the last commit to touch the passed path, or None.
+        '''
+        try:
+            timestamp = self.repo.git.log('-1', '--format=%at', self.hexsha, '--', _clean_path(path) or '.').strip()
+        except GitCommandError:
+            return None
+
+        return int(timestamp) if timestamp else None
+
+    def modified_timestamps(self, path, names):
+        ''' Return a dict of epoch seconds of the last commit to touch each passed name in a directory.
+
+            Reads a single log for the whole directory, and stops reading
+            as soon as every name has been seen.
+        '''
+        path = _clean_path(path)
+        prefix = u'{}/'.format(path) if path else u''
+        remaining = set(names)
+        timestamps = dict([(name, None) for name in names])
+        if not remaining:
+            return timestamps
+
+        process = self.repo.git(c='core.quotepath=off').log('--format=%x00%at', '--name-only', self.hexsha, '--', path or '.', as_process=True)
+        timestamp = None
+        try:
+            for line in process.stdout:
+                line = line.rstrip('\n').decode('utf-8')
+                if line.startswith(u'\x00'):
+                    timestamp = int(line[1:])
+                    continue
+
+                if not line.startswith(prefix):
+                    continue
+
+                name = line[len(prefix):].split(u'/')[0]
+                if name in remaining:
+                    timestamps[name] = timestamp
+                    remaining.discard(name)
+                    if not remaining:
+                        break
+        finally:
+            # stop git from writing out the rest of the log
+            process.stdout.close()
+            process.wait()
+
+        return timestamps
+
+def get_commit_tree(repo, branch_name):
+    ''' Return a CommitTree for the tip of the passed branch, or None.
+
+        Prefers the origin's copy of the branch, which is fresh after a fetch;
+        falls back to a local branch or a tag with the same name.
+    '''
+    for ref_name in (u'origin/{}'.format(branch_name), branch_name):
+        if ref_name in repo.refs:
+            return CommitTree(repo, repo.refs[ref_name].commit)
+
+    return None
@@ -7,6 +7,10 @@ USERTASK_DIRECTORY_PATTERN = 'usertask-{sha}-{email}'
 # This must be different from UserTask's, because they treat master differently.
 GETREPO_DIRECTORY_PATTERN = 'repo-{sha}-{email}'
 
+# Patterns used in calculating directory and index names for per-activity clones.
+WORKTREE_DIRECTORY_PATTERN = 'worktree-{sha}-{email}-{branch}'
+WORKTREE_INDEX_PATTERN = 'worktrees-{sha}-{email}.json'
+
 # the different review states for an activity
 # no changes have yet been made to the activity
 REVIEW_STATE_FRESH = u'fresh'
@@ -83,6 +87,12 @@ LAYOUT_PLURAL_LOOKUP = {
     IMAGE_FILE_TYPE: 'images'
 }
 
+# how many files to show at once in a directory listing
+DIRECTORY_PAGE_SIZE = 100
+# the ways directory listings can be sorted
+SORT_BY_TITLE = 'title'
+SORT_BY_MODIFIED = 'modified'
+
 # routes
 ROUTE_ACTIVITY = '/activity'
 ROUTE_BROWSE_LIVE = '/browse/'
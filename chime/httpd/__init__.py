@@ -5,7 +5,8 @@ logger = getLogger('chime.httpd')
 from os.path import join, exists
 from subprocess import Popen, check_output
 from re import compile
-from os import mkdir
+from os import mkdir, kill, remove
+import errno
 
 config = '''
 LoadModule rewrite_module {ModulesPath}/mod_rewrite.so
@@ -13,6 +14,7 @@ LoadModule alias_module {ModulesPath}/mod_alias.so
 LoadModule dir_module {ModulesPath}/mod_dir.so
 LoadModule mime_module {ModulesPath}/mod_mime.so
 LoadModule negotiation_module {ModulesPath}/mod_negotiation.so
+LoadModule headers_module {ModulesPath}/mod_headers.so
 
 <IfDefine Unixd>
     LoadModule unixd_module {ModulesPath}/mod_unixd.so
@@ -45,6 +47,34 @@ CustomLog "{ServerRoot}/logs/access_log" combined
     AllowOverride Options FileInfo Indexes
     MultiviewsMatch Any
 </Directory>
+
+# Publishing writes .br and .gz copies of text files; send the
+# smallest one the client accepts instead of compressing per request.
+AddEncoding br .br
+AddEncoding gzip .gz
+
+<Directory "{DocumentRoot}">
+    RewriteEngine On
+    RewriteBase /
+
+    # responses depend on Accept-Encoding, so caches must keep them apart
+    Header append Vary Accept-Encoding
+
+    # directory URLs are served by their index.html
+    RewriteCond %{{HTTP:Accept-Encoding}} br
+    RewriteCond %{{REQUEST_FILENAME}}index.html.br -f
+    RewriteRule ^(.*/)?$ $1index.html.br [L]
+    RewriteCond %{{HTTP:Accept-Encoding}} gzip
+    RewriteCond %{{REQUEST_FILENAME}}index.html.gz -f
+    RewriteRule ^(.*/)?$ $1index.html.gz [L]
+
+    RewriteCond %{{HTTP:Accept-Encoding}} br
+    RewriteCond %{{REQUEST_FILENAME}}.br -f
+    RewriteRule ^(.+)$ $1.br [L]
+    RewriteCond %{{HTTP:Accept-Encoding}} gzip
+    RewriteCond %{{REQUEST_FILENAME}}.gz -f
+    RewriteRule ^(.+)$ $1.gz [L]
+</Directory>
 '''
 
 def write_config(doc_root, root, port):
@@ -78,6 +108,19 @@ def apache_version(httpd_path):
 
     return major, minor
 
+def is_running(pid_path):
+    ''' Return True if the process in a pid file is still running.
+    '''
+    try:
+        with open(pid_path) as file:
+            kill(int(file.read().strip()), 0)
+    except ValueError:
+        return False
+    except (IOError, OSError) as e:
+        return e.errno == errno.EPERM
+
+    return True
+
 def run_apache_forever(doc_root, root, port, watch):
     ''' Look for Apache executable and start it up.
 
@@ -88,8 +131,12 @@ def run_apache_forever(doc_root, root, port, watch):
     pid_path = join(root, 'httpd.pid')
 
     if exists(pid_path):
-        logger.debug('Refusing to run Apache because {} exists'.format(pid_path))
-        return None
+        if is_running(pid_path):
+            logger.debug('Refusing to run Apache because {} exists'.format(pid_path))
+            return None
+
+        logger.debug('Removing stale {}'.format(pid_path))
+        remove(pid_path)
 
     try:
         mkdir(join(root, 'logs'))
@@ -0,0 +1,315 @@
+''' Serve the live site from Python, for when Apache isn't installed.
+
+Files are read from the publish path on every request, so a new release
+goes live as soon as publishing swaps the symlink. Precompressed .br and
+.gz copies are sent to clients that accept them, conditional requests get
+ETag and Last-Modified answers, and small files are kept in memory.
+Bigger files go straight from disk to the socket with sendfile() when
+pysendfile is installed.
+'''
+from __future__ import absolute_import, print_function
+from logging import getLogger
+logger = getLogger('chime.httpd.static')
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from threading import Thread, Lock
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from mimetypes import guess_type
+from shutil import copyfileobj
+from os.path import join, isdir, isfile
+from urlparse import urlparse
+from urllib import unquote
+from time import time
+from os import stat
+import argparse
+import httplib
+
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+# Total bytes of small files to keep in memory, and the biggest file to keep.
+STATIC_CACHE_SIZE = 16 * 1024 * 1024
+STATIC_CACHE_FILE_SIZE = 64 * 1024
+
+# Bytes read at a time when copying files without sendfile().
+STATIC_CHUNK_SIZE = 64 * 1024
+
+# Precompressed copies written at publish time, in order of preference.
+PRECOMPRESSED_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+class FileCache(object):
+    ''' Least-recently-used contents of small files, up to a number of bytes.
+
+        Entries are keyed on path, inode, size and modification time, so a
+        file replaced by a new release is read again.
+    '''
+    def __init__(self, size=STATIC_CACHE_SIZE, file_size=STATIC_CACHE_FILE_SIZE):
+        self.size = size
+        self.file_size = file_size
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, path, stats):
+        ''' Return contents of the file at path, or None if it's too big to keep.
+        '''
+        if stats.st_size > self.file_size:
+            return None
+
+        key = path, stats.st_ino, stats.st_size, stats.st_mtime
+
+        with self._lock:
+            if key in self._entries:
+                content = self._entries.pop(key)
+                self._entries[key] = content
+                return content
+
+        with open(path, 'rb') as file:
+            content = file.read()
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = content
+                self.bytes += len(content)
+
+            while self.bytes > self.size:
+                _, old_content = self._entries.popitem(last=False)
+                self.bytes -= len(old_content)
+
+        return content
+
+def get_accepted_encodings(header):
+    ''' Return set of content codings from an Accept-Encoding header.
+    '''
+    encodings = set()
+
+    for value in (header or '').split(','):
+        params = [param.strip() for param in value.split(';')]
+        qvalues = [param[2:] for param in params[1:] if param.startswith('q=')]
+
+        try:
+            if qvalues and float(qvalues[0]) == 0:
+                continue
+        except ValueError:
+            continue
+
+        encodings.add(params[0].lower())
+
+    return encodings
+
+def get_local_path(doc_root, url_path):
+    ''' Return the path under doc_root for a URL path, or None if it's outside.
+    '''
+    parts = [part for part in unquote(url_path).split('/') if part not in ('', '.')]
+
+    if '..' in parts or [part for part in parts if '\0' in part]:
+        return None
+
+    return join(doc_root, *parts)
+
+def find_file(local_path):
+    ''' Return the path of the file to send for a local path, or None.
+
+        Directories are served by their index.html, and missing files by
+        a .html file with the same name, like Apache's MultiViews.
+    '''
+    if isdir(local_path):
+        local_path = join(local_path, 'index.html')
+    elif not isfile(local_path) and isfile(local_path + '.html'):
+        local_path += '.html'
+
+    return local_path if isfile(local_path) else None
+
+def make_etag(stats):
+    ''' Return an ETag header value from a file's size and modification time.
+    '''
+    return '"{:x}-{:x}"'.format(stats.st_size, int(stats.st_mtime * 1000000))
+
+class StaticRequestHandler (BaseHTTPRequestHandler):
+    ''' Answer GET and HEAD requests for files under the server's doc_root.
+    '''
+    server_version = 'chime-static'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_file(True)
+
+    def do_HEAD(self):
+        self.send_file(False)
+
+    def send_file(self, send_body):
+        url_path = urlparse(self.path).path
+        local_path = get_local_path(self.server.doc_root, url_path)
+        path = find_file(local_path) if local_path else None
+
+        if path is None:
+            return self.send_error(404)
+
+        if isdir(local_path) and not url_path.endswith('/'):
+            self.send_response(301)
+            self.send_header('Location', url_path + '/')
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+
+        mime_type = guess_type(path)[0] or 'application/octet-stream'
+        accepted = get_accepted_encodings(self.headers.get('Accept-Encoding'))
+        encoding = None
+
+        for (coding, extension) in PRECOMPRESSED_ENCODINGS:
+            if coding in accepted and isfile(path + extension):
+                path, encoding = path + extension, coding
+                break
+
+        stats = stat(path)
+        etag = make_etag(stats)
+
+        if self.is_not_modified(etag, stats.st_mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            return self.end_headers()
+
+        self.send_response(200)
+        self.send_header('Content-Type', mime_type)
+        self.send_header('Content-Length', str(stats.st_size))
+        self.send_header('Last-Modified', formatdate(stats.st_mtime, usegmt=True))
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+
+        self.end_headers()
+
+        if not send_body:
+            return
+
+        content = self.server.cache.get(path, stats)
+
+        if content is not None:
+            self.wfile.write(content)
+            return
+
+        with open(path, 'rb') as file:
+            if sendfile is None:
+                copyfileobj(file, self.wfile, STATIC_CHUNK_SIZE)
+                return
+
+            # headers are buffered in wfile, and must go out before the body
+            self.wfile.flush()
+            offset = 0
+
+            while offset < stats.st_size:
+                sent = sendfile(self.connection.fileno(), file.fileno(), offset, stats.st_size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+
+    def is_not_modified(self, etag, mtime):
+        ''' Return True if the client's copy is the current one.
+        '''
+        if_none_match = self.headers.get('If-None-Match')
+
+        if if_none_match is not None:
+            return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+        if_modified_since = parsedate_tz(self.headers.get('If-Modified-Since') or '')
+
+        if if_modified_since is not None:
+            return int(mtime) <= mktime_tz(if_modified_since)
+
+        return False
+
+    def log_message(self, format, *args):
+        logger.debug('{} {}'.format(self.address_string(), format % args))
+
+class StaticServer (ThreadingMixIn, HTTPServer):
+    ''' Threaded HTTP server for the files under doc_root.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, doc_root, cache_size=STATIC_CACHE_SIZE):
+        HTTPServer.__init__(self, address, StaticRequestHandler)
+        self.doc_root = doc_root
+        self.cache = FileCache(cache_size)
+
+def run_static_forever(doc_root, port, cache_size=STATIC_CACHE_SIZE):
+    ''' Serve doc_root in a background thread.
+
+        Return the StaticServer instance; call its shutdown() method to stop.
+    '''
+    server = StaticServer(('0.0.0.0', port), doc_root, cache_size)
+
+    thread = Thread(target=server.serve_forever, name='chime-static-server')
+    thread.daemon = True
+    thread.start()
+
+    logger.debug('Running static server at http://127.0.0.1:{} from {}'.format(port, doc_root))
+
+    return server
+
+def benchmark(url, requests, concurrency, headers=None):
+    ''' Request url from a number of threads, return requests per second.
+
+        Used to compare this server with Apache on the same live site.
+    '''
+    parsed = urlparse(url)
+    headers = headers or {}
+    counts = [requests // concurrency] * concurrency
+    errors = []
+
+    def fetch(count):
+        connection = httplib.HTTPConnection(parsed.hostname, parsed.port or 80)
+        for _ in range(count):
+            connection.request('GET', parsed.path or '/', headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        connection.close()
+
+    threads = [Thread(target=fetch, args=(count, )) for count in counts]
+    start_time = time()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise RuntimeError('Got {} non-200 responses from {}, e.g. {}'.format(len(errors), url, errors[0]))
+
+    return sum(counts) / (time() - start_time)
+
+parser = argparse.ArgumentParser(description='Serve the live site, or measure how fast a live site server is.')
+subparsers = parser.add_subparsers(dest='command')
+
+serve_parser = subparsers.add_parser('serve', help='Serve a directory.')
+serve_parser.add_argument('doc_root', help='Directory to serve, usually the publish path.')
+serve_parser.add_argument('--port', type=int, default=5001, help='Port to listen on; defaults to 5001.')
+
+bench_parser = subparsers.add_parser('bench', help='Request URLs repeatedly and report requests per second.')
+bench_parser.add_argument('urls', nargs='+', help='URLs to request, e.g. the same page from Apache and from this server.')
+bench_parser.add_argument('--requests', type=int, default=1000, help='Requests per URL; defaults to 1000.')
+bench_parser.add_argument('--concurrency', type=int, default=8, help='Simultaneous connections; defaults to 8.')
+bench_parser.add_argument('--gzip', action='store_true', help='Ask for compressed responses.')
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = StaticServer(('0.0.0.0', args.port), args.doc_root)
+        print('Serving', args.doc_root, 'at http://127.0.0.1:{}/'.format(args.port))
+        server.serve_forever()
+
+    else:
+        headers = {'Accept-Encoding': 'br, gzip'} if args.gzip else {}
+        for url in args.urls:
+            print('{:.1f} requests/sec'.format(benchmark(url, args.requests, args.concurrency, headers)), url)
@@ -0,0 +1,212 @@
+''' Import a whole site's worth of content into one activity.
+
+Reads markdown files and other assets from a zip file, a tar file, or a
+directory, and writes them into a UserTask as one commit. Markdown files
+become articles or categories with normalized front matter, paths are
+slugified, and a category index is made for every directory that needs
+one. Files are read and written one at a time, so the import doesn't
+hold the whole archive in memory.
+'''
+from __future__ import absolute_import, print_function
+from logging import getLogger
+Logger = getLogger('chime.import_functions')
+
+from os.path import join, relpath, split, splitext, isdir, getsize
+from os import walk, environ
+from io import BytesIO
+from tempfile import mkdtemp
+from shutil import rmtree
+import argparse
+import tarfile
+import zipfile
+import json
+
+from git import Actor
+
+from .jekyll_functions import load_jekyll_doc, dump_jekyll_doc
+from .edit_functions import make_slug_path
+from .repo_functions import ChimeRepo, get_start_branch, make_commit_message
+from .storage.user_task import get_usertask
+from . import constants
+
+MARKDOWN_EXTENSIONS = ('.md', '.markdown', '.mdown', '.mkd')
+INDEX_NAMES = ('index', 'readme')
+
+def is_hidden_path(path):
+    ''' Return True if any part of the passed path is a hidden file or directory.
+    '''
+    return any([part.startswith('.') or part == '__MACOSX' for part in path.split('/')])
+
+def iter_source_files(source):
+    ''' Yield (path, file, size) for every file in a zip, a tar, or a directory.
+
+        Each file is only readable until the next one is yielded.
+    '''
+    if isdir(source):
+        for (dir_path, dir_names, file_names) in walk(source):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                full_path = join(dir_path, file_name)
+                with open(full_path, 'rb') as file:
+                    yield relpath(full_path, source), file, getsize(full_path)
+
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if not info.filename.endswith('/'):
+                    yield info.filename, archive.open(info), info.file_size
+
+    elif tarfile.is_tarfile(source):
+        # stream the tar, so compressed archives aren't unpacked into memory
+        with tarfile.open(source, 'r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member), member.size
+
+    else:
+        raise ValueError(u'Can\'t import from {}; it\'s not a directory, zip, or tar file.'.format(source))
+
+def make_import_path(path):
+    ''' Return the repository path, layout, and default title for an imported file.
+
+        Markdown files become articles at their slugified path, or
+        categories if they're the directory's index. Other files keep
+        their names inside slugified directories.
+    '''
+    dir_path, file_name = split(path)
+    stem, ext = splitext(file_name)
+    slug_dir_path = make_slug_path(dir_path) if dir_path else u''
+
+    if ext.lower() not in MARKDOWN_EXTENSIONS:
+        return join(slug_dir_path, file_name), None, None
+
+    index_name = u'index.{}'.format(constants.CONTENT_FILE_EXTENSION)
+    if stem.lower() in INDEX_NAMES:
+        title = split(dir_path)[1] or stem
+        return join(slug_dir_path, index_name), constants.CATEGORY_LAYOUT, title
+
+    return join(slug_dir_path, make_slug_path(stem), index_name), constants.ARTICLE_LAYOUT, stem
+
+def normalize_front(front, layout, title):
+    ''' Return front matter with the values Chime expects filled in.
+    '''
+    front = dict(front) if isinstance(front, dict) else {}
+    front['title'] = front.get('title') or title
+    front['layout'] = front.get('layout') or layout
+    front.setdefault('description', u'')
+    front.setdefault('order', 0)
+    return front
+
+def import_content(user_task, source, dir_path=u''):
+    ''' Write everything in the passed archive or directory to a task under dir_path.
+
+        Return a list of action descriptions for the commit message.
+    '''
+    dir_path = make_slug_path(dir_path.strip('/')) if dir_path.strip('/') else u''
+    action_descriptions = []
+    categories, indexed = {}, set()
+
+    def prepare_files():
+        for (path, file, size) in iter_source_files(source):
+            path = path.replace('\\', '/')
+            while path.startswith('./'):
+                path = path[2:]
+            if not path or is_hidden_path(path):
+                continue
+
+            repo_path, layout, title = make_import_path(path)
+            repo_path = join(dir_path, repo_path)
+
+            if layout is None:
+                # not a page; copy it across as it is
+                yield repo_path, file, size
+                continue
+
+            # one page at a time is read into memory to fix its front matter
+            front, body = load_jekyll_doc(BytesIO(file.read()))
+            front = normalize_front(front, layout, title)
+            data = BytesIO()
+            dump_jekyll_doc(front, body, data)
+            size = data.tell()
+            data.seek(0)
+
+            yield repo_path, data, size
+            action_descriptions.append({'action': u'create', 'title': front['title'], 'display_type': front['layout'], 'file_path': repo_path})
+
+            # note the categories that this page should be inside
+            source_dirs = split(path)[0].split('/') if split(path)[0] else []
+            if front['layout'] == constants.CATEGORY_LAYOUT and source_dirs:
+                indexed.add(split(repo_path)[0])
+                source_dirs = source_dirs[:-1]
+
+            for depth in range(1, len(source_dirs) + 1):
+                category_dir = join(dir_path, make_slug_path('/'.join(source_dirs[:depth])))
+                categories.setdefault(category_dir, source_dirs[depth - 1])
+
+    user_task.write_files(prepare_files())
+
+    def prepare_category_files():
+        for category_dir in sorted(categories):
+            if category_dir in indexed:
+                continue
+
+            index_path = join(category_dir, u'index.{}'.format(constants.CONTENT_FILE_EXTENSION))
+            try:
+                user_task.read(index_path)
+            except IOError:
+                pass
+            else:
+                continue
+
+            front = normalize_front({}, constants.CATEGORY_LAYOUT, categories[category_dir])
+            data = BytesIO()
+            dump_jekyll_doc(front, u'', data)
+            size = data.tell()
+            data.seek(0)
+
+            yield index_path, data, size
+            action_descriptions.append({'action': u'create', 'title': front['title'], 'display_type': front['layout'], 'file_path': index_path})
+
+    user_task.write_files(prepare_category_files())
+
+    return action_descriptions
+
+def import_new_activity(source, repo_path, work_path, email, task_description, default_branch_name, dir_path=u''):
+    ''' Start a new activity and import the passed archive or directory into it.
+
+        Everything is written as one commit and pushed once. Return the
+        new activity's branch name.
+    '''
+    clone_path = mkdtemp(prefix='chime-import-')
+    try:
+        clone = ChimeRepo(repo_path).clone(clone_path)
+        branch_name = get_start_branch(clone, default_branch_name, task_description, email).name
+    finally:
+        rmtree(clone_path)
+
+    with get_usertask(Actor(' ', email), branch_name, default_branch_name, repo_path, work_path, branch_name) as user_task:
+        action_descriptions = import_content(user_task, source, dir_path)
+        subject = u'{} pages were imported'.format(len(action_descriptions))
+        message_body = dict(branch_name=branch_name, actions=action_descriptions)
+        user_task.commit(make_commit_message(subject=subject, body=json.dumps(message_body, ensure_ascii=False)))
+        user_task.push()
+
+    Logger.info(u'Imported {} pages from {} into {}'.format(len(action_descriptions), source, branch_name))
+    return branch_name
+
+parser = argparse.ArgumentParser(description='Import a zip, tar, or directory of markdown files into a new activity.')
+parser.add_argument('source', help='Zip file, tar file, or directory to import.')
+parser.add_argument('--email', required=True, help='Email address of the activity\'s author.')
+parser.add_argument('--description', default=u'Import content', help='Description of the new activity.')
+parser.add_argument('--directory', default=u'', help='Directory in the site to import into.')
+parser.add_argument('--repo', default=environ.get('REPO_PATH', 'sample-site'), help='Path to the origin repository.')
+parser.add_argument('--work', default=environ.get('WORK_PATH', '.'), help='Path to the working directory for clones.')
+parser.add_argument('--branch', default='master', help='Name of the default branch.')
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    print(import_new_activity(args.source, args.repo, args.work, args.email,
+                              args.description.decode('utf8'), args.branch,
+                              args.directory.decode('utf8')))
@@ -27,11 +27,19 @@ from __future__ import absolute_import
 from os.path import join, exists
 from collections import OrderedDict
 import yaml
+import shutil
 import logging
 from . import constants
 
 _marker = "---\n"
 
+# Jekyll ignores directories that start with an underscore.
+JEKYLL_SHARDS_DIRECTORY_NAME = '_chime-shards'
+
+class JekyllBuildFailed (Exception):
+    ''' Jekyll exited with an error, so whatever it built is incomplete.
+    '''
+
 def load_languages(directory):
     ''' Load languages from site configuration.
 
@@ -47,7 +55,15 @@ def load_languages(directory):
 
     if exists(config_path):
         with open(config_path) as file:
-            config = yaml.load(file).get('languages', [])
+            return load_languages_from_config(file)
+
+    return load_languages_from_config(None)
+
+def load_languages_from_config(file):
+    ''' Load languages from an open site configuration file, or None.
+    '''
+    if file is not None:
+        config = yaml.load(file).get('languages', [])
 
         if type(config) is not list:
             raise ValueError(u'Unable to load language options.')
@@ -133,10 +149,9 @@ def dump_jekyll_doc(front_matter, content, file):
     file.write(_marker)
     file.write(content.encode('utf-8'))
 
-def build_jekyll_site(dirname):
-    ''' Build the Jekyll site inside dirname, return path to the built site.
+def _start_jekyll(dirname):
+    ''' Start jekyll build inside dirname, return an instance of subprocess.Popen.
     '''
-
     from subprocess import Popen
     import os
 
@@ -146,17 +161,101 @@ def build_jekyll_site(dirname):
 
     call = [jekyll_script, 'build', '--quiet']
     try:
-        build = Popen(call, cwd=dirname)
-        build.wait()
+        return Popen(call, cwd=dirname)
     except:
         error_message = u'Unexpected Jekyll failure running {} in {}'.format(call, dirname)
         logger = logging.getLogger('chime.jekyll')
         logger.error(error_message)
         raise Exception(error_message)
 
+def build_jekyll_site(dirname, shards=1):
+    ''' Build the Jekyll site inside dirname, return path to the built site.
+
+        With more than one shard, the site is built by that many Jekyll
+        processes at once; see build_jekyll_site_in_shards(). Raises
+        JekyllBuildFailed if Jekyll exits with an error.
+    '''
+    if shards > 1:
+        return build_jekyll_site_in_shards(dirname, shards)
+
+    # a crash can leave part of a site behind, which mustn't be taken for a whole one
+    if _start_jekyll(dirname).wait() != 0:
+        error_message = u'Jekyll failed building {}'.format(dirname)
+        logging.getLogger('chime.jekyll').error(error_message)
+        raise JekyllBuildFailed(error_message)
+
     # By default Jekyll builds into dirname/_site
     return join(dirname, constants.JEKYLL_BUILD_DIRECTORY_NAME)
 
+def build_jekyll_site_in_shards(dirname, shards):
+    ''' Build the Jekyll site inside dirname in parallel, return path to the built site.
+
+        Each shard is a Jekyll process reading the whole site, so layouts
+        and the directory structure generator see every page, but only
+        rendering and writing the pages and files in its share. The
+        directory-structure-generator gem picks the share from the
+        chime_shard setting. Shard outputs are moved into one _site, and
+        nothing is moved if any shard fails.
+    '''
+    import os
+
+    config_path = join(dirname, '_config.yml')
+
+    if exists(config_path):
+        with open(config_path) as file:
+            config = yaml.safe_load(file) or {}
+    else:
+        config = {}
+
+    shards_dir = join(dirname, JEKYLL_SHARDS_DIRECTORY_NAME)
+    shard_dirs, builds = [], []
+
+    for index in range(shards):
+        shard_dir = join(shards_dir, str(index))
+        os.makedirs(shard_dir)
+
+        # Jekyll runs in the shard directory, reading this config instead of the site's.
+        shard_config = dict(config, source=os.path.abspath(dirname),
+                            destination=join(os.path.abspath(shard_dir), constants.JEKYLL_BUILD_DIRECTORY_NAME),
+                            chime_shard=dict(index=index, count=shards))
+
+        with open(join(shard_dir, '_config.yml'), 'w') as file:
+            yaml.safe_dump(shard_config, file, default_flow_style=False)
+
+        shard_dirs.append(shard_dir)
+        builds.append(_start_jekyll(shard_dir))
+
+    failed_shards = [index for (index, build) in enumerate(builds) if build.wait() != 0]
+
+    # a missing shard would publish a site with pages missing
+    if failed_shards:
+        shutil.rmtree(shards_dir, ignore_errors=True)
+        error_message = u'Jekyll failed building shards {} of {} in {}'.format(failed_shards, shards, dirname)
+        logging.getLogger('chime.jekyll').error(error_message)
+        raise JekyllBuildFailed(error_message)
+
+    site_dir = join(dirname, constants.JEKYLL_BUILD_DIRECTORY_NAME)
+    shutil.rmtree(site_dir, ignore_errors=True)
+
+    try:
+        for shard_dir in shard_dirs:
+            shard_site_dir = join(shard_dir, constants.JEKYLL_BUILD_DIRECTORY_NAME)
+
+            for (dirpath, _, filenames) in os.walk(shard_site_dir):
+                merged_dirpath = join(site_dir, os.path.relpath(dirpath, shard_site_dir))
+
+                if not os.path.isdir(merged_dirpath):
+                    os.makedirs(merged_dirpath)
+
+                # files that aren't split up, like collections, are written by every shard
+                for filename in filenames:
+                    if not exists(join(merged_dirpath, filename)):
+                        os.rename(join(dirpath, filename), join(merged_dirpath, filename))
+    finally:
+        shutil.rmtree(shards_dir, ignore_errors=True)
+
+    return site_dir
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
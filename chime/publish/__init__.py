@@ -1,17 +1,21 @@
 from logging import getLogger
 logger = getLogger('chime.publish')
 
-from os import mkdir
-from os.path import join
-from tempfile import mkdtemp
+from os import mkdir, listdir, remove, rename, utime, fdopen
+from os.path import join, exists, getmtime, getsize
+from tempfile import mkstemp
 from urlparse import urljoin
-from shutil import rmtree
-from io import BytesIO
 
 from flask import Blueprint, Flask
 from logging import getLogger, DEBUG
 
-from .functions import process_local_commit
+from ..publish_functions import publish_commit
+
+# Directory in the running dir where zip archives of commits are cached.
+CHECKOUTS_DIRNAME = 'checkouts'
+
+# Bytes of zip archives to keep in the cache.
+CHECKOUT_CACHE_SIZE = 1024 * 1024 * 1024
 
 def announce_commit(base_href, repo, commit_ref):
     '''
@@ -20,60 +24,88 @@ def announce_commit(base_href, repo, commit_ref):
 
     raise Exception(build_url)
 
-def retrieve_commit_checkout(running_dir, repo, commit_ref):
-    '''
+def evict_checkouts(checkouts_dir, cache_size, keep=None):
+    ''' Remove least-recently-used archives until they fit in cache_size bytes.
+
+        The archive at the path in keep is never removed, even if it's
+        bigger than the whole cache on its own.
     '''
-    logger.debug('Retrieve commit {}'.format(commit_ref))
+    archives = []
+    for name in listdir(checkouts_dir):
+        if name.endswith('.zip') and not name.startswith('.'):
+            path = join(checkouts_dir, name)
+            archives.append((getmtime(path), getsize(path), path))
 
-    try:
-        working_dir = mkdtemp()
-        archive_path = join(working_dir, 'archive.zip')
+    total = sum([size for (_, size, _) in archives])
 
-        with open(archive_path, 'w') as file:
-            repo.archive(file, commit_ref, format='zip')
+    for (_, size, path) in sorted(archives):
+        if total <= cache_size:
+            break
 
-        with open(archive_path, 'r') as file:
-            bytes = BytesIO(file.read())
+        if path == keep:
+            continue
 
-        return bytes
+        try:
+            remove(path)
+        except OSError:
+            pass
 
-    except Exception as e:
-        print e
-        logger.warning(e)
+        total -= size
 
-    finally:
-        rmtree(working_dir)
+def retrieve_commit_checkout(running_dir, repo, commit_ref, cache_size=CHECKOUT_CACHE_SIZE):
+    ''' Return the path of a zip archive of the passed commit, and the commit's SHA.
 
-def release_commit(running_dir, repo, commit_ref):
-    '''
+        A ref names a commit whose contents never change, so archives are
+        cached on disk by SHA. They're written by git archive straight to
+        the cache, and the least-recently-used ones are removed when the
+        cache grows past cache_size bytes.
     '''
-    logger.debug('Release commit {}'.format(commit_ref))
+    hexsha = repo.commit(commit_ref).hexsha
+    logger.debug('Retrieve commit {} as {}'.format(commit_ref, hexsha))
+
+    checkouts_dir = join(running_dir, CHECKOUTS_DIRNAME)
+    archive_path = join(checkouts_dir, '{}.zip'.format(hexsha))
 
     try:
-        working_dir = mkdtemp()
-        archive_path = join(working_dir, 'archive.zip')
+        mkdir(checkouts_dir)
+    except OSError:
+        pass
 
-        with open(archive_path, 'w') as file:
-            repo.archive(file, commit_ref, format='zip')
+    if exists(archive_path):
+        # a cached archive counts as used for eviction
+        utime(archive_path, None)
+        return archive_path, hexsha
 
-        zip = process_local_commit(archive_path)
-        extract_dir = join(running_dir, 'master')
+    # write to a temporary name, so no one sees a half-written archive
+    handle, temp_path = mkstemp(prefix='.', suffix='.zip', dir=checkouts_dir)
 
-        try:
-            mkdir(extract_dir)
-        except OSError:
-            pass
+    try:
+        with fdopen(handle, 'wb') as file:
+            repo.archive(file, hexsha, format='zip')
+        rename(temp_path, archive_path)
+    except:
+        remove(temp_path)
+        raise
+
+    evict_checkouts(checkouts_dir, cache_size, keep=archive_path)
+
+    return archive_path, hexsha
 
-        logger.debug('Extracting zip archive to {}'.format(extract_dir))
-        zip.extractall(extract_dir)
+def release_commit(running_dir, repo, commit_ref):
+    ''' Build the passed commit and make it the live release in running_dir/master.
+
+        The commit is streamed from git archive into a directory next to
+        its release, built in place, and moved into the release.
+    '''
+    logger.debug('Release commit {}'.format(commit_ref))
+
+    try:
+        publish_commit(repo, join(running_dir, 'master'), commit_ref)
 
     except Exception as e:
         print e
         logger.warning(e)
 
-    finally:
-        rmtree(working_dir)
-
 publish = Blueprint('chime.publish', __name__, template_folder='templates')
 
 def create_app(environ):
@@ -2,17 +2,44 @@ from logging import getLogger
 logger = getLogger('chime.publish.functions')
 
 from urlparse import urlparse
-from zipfile import ZipFile, ZIP_DEFLATED
-from os.path import dirname, basename, join, exists, relpath
-from tempfile import mkdtemp
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+from os.path import dirname, basename, join, exists, relpath, splitext
+from tempfile import mkdtemp, SpooledTemporaryFile
+from time import time
 from shutil import rmtree
 from io import BytesIO
 from os import walk
 
+from threading import Thread, Lock
+from collections import OrderedDict
+from Queue import Queue
+
 from requests import get
 
 from ..jekyll_functions import build_jekyll_site
 
+# How many commits to build at once, how many can wait, and how many built ones to remember.
+BUILD_WORKER_COUNT = 2
+BUILD_QUEUE_SIZE = 32
+BUILT_COMMITS_REMEMBERED = 256
+
+_build_queue = Queue(BUILD_QUEUE_SIZE)
+_build_lock = Lock()
+_build_workers = []
+
+# SHAs waiting or being built, and recently built ones, so repeated webhooks are ignored.
+# There are never more than BUILD_QUEUE_SIZE + BUILD_WORKER_COUNT queued SHAs, and the
+# built ones are a least-recently-used list of BUILT_COMMITS_REMEMBERED.
+_queued_shas = set()
+_built_shas = OrderedDict()
+
+# Bytes of archive to keep in memory before moving it to a temporary file.
+ARCHIVE_SPOOL_SIZE = 64 * 1024 * 1024
+
+# Files that are already compressed, so deflating them again only costs time.
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico', '.woff', '.woff2',
+                     '.gz', '.br', '.zip', '.pdf', '.mp3', '.mp4', '.mov', '.webm')
+
 def process_local_commit(archive_path):
     ''' Return ZipFile.
     '''
@@ -49,6 +76,79 @@ def process_remote_commit(commit_url, commit_sha):
 
     return zip
 
+def queue_remote_commit(commit_url, commit_sha):
+    ''' Queue a commit from Github to be built in the background.
+
+        The build is fire-and-forget: it checks that the commit builds,
+        and the archive is thrown away. Return False if the commit is
+        already waiting, being built, or was recently built in this
+        process. Raises Queue.Full if too many commits are waiting.
+    '''
+    with _build_lock:
+        if commit_sha in _built_shas:
+            _remember_built_sha(commit_sha)
+            return False
+
+        if commit_sha in _queued_shas:
+            return False
+
+        _build_queue.put_nowait((commit_url, commit_sha))
+        _queued_shas.add(commit_sha)
+
+        # start the workers the first time they're needed
+        while len(_build_workers) < BUILD_WORKER_COUNT:
+            worker = Thread(target=_build_queued_commits, name='chime-publish-build-{}'.format(len(_build_workers)))
+            worker.daemon = True
+            worker.start()
+            _build_workers.append(worker)
+
+    return True
+
+def commit_was_built(commit_sha):
+    ''' Return True if the commit was recently built.
+    '''
+    with _build_lock:
+        return commit_sha in _built_shas
+
+def wait_for_queued_commits():
+    ''' Block until every queued commit has been built.
+    '''
+    _build_queue.join()
+
+def _build_queued_commits():
+    ''' Build queued commits forever, one at a time.
+    '''
+    while True:
+        commit_url, commit_sha = _build_queue.get()
+        zip = None
+
+        try:
+            zip = process_remote_commit(commit_url, commit_sha)
+        except Exception as e:
+            logger.warning(e)
+
+        finally:
+            with _build_lock:
+                _queued_shas.discard(commit_sha)
+
+                # a failed build can be tried again by the next webhook
+                if zip is not None:
+                    _remember_built_sha(commit_sha)
+
+            _build_queue.task_done()
+
+def _remember_built_sha(commit_sha):
+    ''' Mark a commit as the most recently built one, forgetting the oldest.
+
+        Call with _build_lock held.
+    '''
+    _built_shas.pop(commit_sha, None)
+
+    # the most recently used SHAs are at the end
+    _built_shas[commit_sha] = True
+    while len(_built_shas) > BUILT_COMMITS_REMEMBERED:
+        _built_shas.popitem(last=False)
+
 def extract_local_commit(work_dir, archive_path):
     '''
     '''
@@ -86,18 +186,38 @@ def extract_github_commit(work_dir, commit_url, commit_sha):
 
     return checkout_dir
 
-def archive_commit(directory):
-    ''' Pack directory into a zip archive, return zip object.
+def archive_commit(directory, spool_size=ARCHIVE_SPOOL_SIZE):
+    ''' Pack directory into a zip archive, return zip object open for reading.
+
+        Files that are already compressed are stored as they are, and the
+        rest are deflated, in walk order. ZipFile reads each file in chunks
+        and zlib lets go of the GIL while it compresses, so the background
+        build threads can archive at the same time. The archive is kept in
+        memory until it's bigger than spool_size bytes, and in a temporary
+        file after that.
     '''
-    content = BytesIO()
-    zip = ZipFile(content, 'w', ZIP_DEFLATED)
+    start_time = time()
+    content = SpooledTemporaryFile(max_size=spool_size)
+    zip = ZipFile(content, 'w', ZIP_DEFLATED, allowZip64=True)
+    stored_count = 0
 
     for (dirpath, _, filenames) in walk(directory):
-        for filename in filenames:
+        for filename in sorted(filenames):
             filepath = join(dirpath, filename)
-            archpath = relpath(filepath, directory)
-            zip.write(filepath, archpath)
 
-    print len(zip.namelist()), 'files in', len(content.getvalue()), 'bytes'
+            if splitext(filename)[1].lower() in STORED_EXTENSIONS:
+                zip.write(filepath, relpath(filepath, directory), ZIP_STORED)
+                stored_count += 1
+            else:
+                zip.write(filepath, relpath(filepath, directory), ZIP_DEFLATED)
 
-    return zip
+    zip.close()
+
+    metrics = dict(files=len(zip.infolist()), stored_files=stored_count,
+                   bytes=sum([info.file_size for info in zip.infolist()]),
+                   archive_bytes=content.tell(), seconds=time() - start_time)
+
+    logger.info('Archived {files} files, {bytes} bytes into {archive_bytes} in {seconds:.3f} seconds'.format(**metrics), extra=dict(metrics=metrics))
+
+    content.seek(0)
+    return ZipFile(content, 'r')
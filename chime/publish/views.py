@@ -2,17 +2,29 @@ from logging import getLogger
 logger = getLogger('chime.publish.views')
 
 from flask import request, Response
+from Queue import Full
 from . import publish as app
-from .functions import process_remote_commit
+from .functions import queue_remote_commit, commit_was_built
 
 @app.route('/', methods=['POST'])
 def index():
+    ''' Queue the pushed commit to be built, and answer without waiting for it.
+    '''
     payload = request.get_json(force=True)
     commit = payload.get('commits', [None])[0]
 
     if commit is None or 'url' not in commit:
         return Response('No', status=400)
 
-    process_remote_commit(commit['url'], commit['sha'])
+    try:
+        queued = queue_remote_commit(commit['url'], commit['sha'])
+    except Full:
+        return Response('Too many commits are waiting to be built; try again later.', status=503)
 
-    return ''
+    if not queued and commit_was_built(commit['sha']):
+        return Response('Already built {}'.format(commit['sha']), status=202)
+
+    if not queued:
+        return Response('Already building {}'.format(commit['sha']), status=202)
+
+    return Response('Building {}'.format(commit['sha']), status=202)
@@ -0,0 +1,659 @@
+''' Build and publish the live site outside of web requests.
+
+Publishing a commit means checking it out, building it with Jekyll, and
+making the built site live at the publish path, which can take minutes.
+Requests queue a publish job in the running state dir instead, and
+chime.worker runs queued jobs in the background, retrying failed ones.
+
+Built sites are kept as releases in a directory next to the publish path,
+one per commit, and the publish path is a symlink to the live release.
+Making a release live or rolling back to an earlier one swaps the symlink
+in one step, so visitors never see a half-copied site.
+
+Each release has a manifest of its files' content hashes. When only static
+files changed since the live release, the next release is made from the
+live one without running Jekyll, writing only the files that changed.
+Text files get gzip and brotli copies for the web server to send, made
+only for files that changed.
+'''
+from __future__ import absolute_import, print_function
+from logging import getLogger
+Logger = getLogger('chime.publish_functions')
+
+from os.path import join, isdir, islink, exists, basename, abspath, dirname, relpath, getsize
+from multiprocessing import Pool, cpu_count
+from gzip import GzipFile
+from io import BytesIO
+from os import rename, symlink, readlink, makedirs, walk, link, remove
+from fnmatch import fnmatch
+from hashlib import sha1
+from tempfile import mkdtemp
+from shutil import rmtree
+from copy import deepcopy
+from contextlib import contextmanager
+from time import time
+import argparse
+import tarfile
+import uuid
+import json
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from git.cmd import GitCommandError
+from gitdb.exc import BadName
+import yaml
+
+from .jekyll_functions import build_jekyll_site
+from .repo_functions import TASK_METADATA_FILENAME
+from . import google_api_functions
+
+# Name of file in running state dir that holds the publish jobs.
+PUBLISH_JOBS_FILE = 'publish-jobs.json'
+
+# How many times to try a publish job before giving up on it.
+PUBLISH_JOB_MAX_ATTEMPTS = 3
+
+# Seconds to wait before trying a failed publish job again, multiplied by the attempts so far.
+PUBLISH_JOB_RETRY_DELAY = 30
+
+# Seconds before a running publish job is assumed to have died with its worker.
+PUBLISH_JOB_TIMEOUT = 3600
+
+# How many finished publish jobs to remember.
+PUBLISH_JOB_HISTORY_SIZE = 20
+
+# States of a publish job
+JOB_STATE_QUEUED = u'queued'
+JOB_STATE_RUNNING = u'running'
+JOB_STATE_DONE = u'done'
+JOB_STATE_FAILED = u'failed'
+JOB_STATE_SUPERSEDED = u'superseded'
+
+FINISHED_JOB_STATES = (JOB_STATE_DONE, JOB_STATE_FAILED, JOB_STATE_SUPERSEDED)
+
+# Name of file in a releases directory that lists its releases.
+RELEASES_FILE = 'releases.json'
+
+# How many releases to keep for each publish path, counting the live one.
+PUBLISH_RELEASES_KEPT = 5
+
+# How many Jekyll processes build a site at once; see jekyll_functions.build_jekyll_site_in_shards().
+PUBLISH_BUILD_SHARDS = 1
+
+# Name of file in a releases directory with the content hashes of a release's files.
+RELEASE_MANIFEST_PATTERN = '{hexsha}.manifest.json'
+
+# Bytes read at a time when hashing a file.
+HASH_CHUNK_SIZE = 64 * 1024
+
+# Built files that get compressed copies for the web server, and the smallest worth compressing.
+COMPRESSED_EXTENSIONS = ('.html', '.htm', '.css', '.js', '.json', '.xml', '.svg', '.txt', '.csv', '.rss')
+COMPRESS_MIN_SIZE = 256
+
+# File name extensions for compressed copies of built files.
+GZIP_EXTENSION = '.gz'
+BROTLI_EXTENSION = '.br'
+
+# Jekyll renders files that start with this, and copies the rest as they are.
+FRONT_MATTER_PATTERN = re.compile(r'^---\r?\n')
+
+def get_releases_dir(publish_path):
+    ''' Return the directory where releases for the passed publish path are kept.
+    '''
+    return '{}.releases'.format(abspath(publish_path))
+
+def make_release_staging_dir(publish_path, prefix):
+    ''' Make and return a new temporary directory inside the releases directory.
+
+        Sites built or unpacked here can be moved into a release without
+        copying, since they're on the same filesystem.
+    '''
+    releases_dir = get_releases_dir(publish_path)
+
+    if not isdir(releases_dir):
+        makedirs(releases_dir)
+
+    return mkdtemp(prefix=prefix, dir=releases_dir)
+
+@contextmanager
+def _releases(publish_path):
+    ''' Lock the releases file and yield its list of releases, saving any changes.
+
+        Releases are dictionaries, oldest first, each with the "hexsha"
+        it was built from and the time it was "released".
+    '''
+    releases_dir = get_releases_dir(publish_path)
+
+    if not isdir(releases_dir):
+        makedirs(releases_dir)
+
+    with google_api_functions.WriteLocked(join(releases_dir, RELEASES_FILE)) as file:
+        try:
+            saved = json.load(file)
+        except ValueError:
+            saved = {}
+
+        releases = deepcopy(saved.get('releases', []))
+        yield releases
+
+        if releases != saved.get('releases', []):
+            file.seek(0)
+            file.truncate(0)
+            json.dump(dict(releases=releases), file, indent=2)
+
+def get_live_release(publish_path):
+    ''' Return the commit SHA of the live release, or None if there isn't one.
+    '''
+    if not islink(publish_path):
+        return None
+
+    return basename(readlink(publish_path))
+
+def get_releases(publish_path):
+    ''' Return the kept releases for the passed publish path, newest first.
+    '''
+    with _releases(publish_path) as releases:
+        return list(reversed(releases))
+
+def _activate_release(publish_path, hexsha):
+    ''' Point the publish path at the release for the passed commit.
+
+        A new symlink is made next to the publish path and renamed over
+        it, which replaces the old one atomically. A publish path that's
+        still a plain directory is moved out of the way first.
+    '''
+    publish_path = abspath(publish_path)
+    release_dir = join(get_releases_dir(publish_path), hexsha)
+
+    if not isdir(release_dir):
+        raise ValueError(u'There\'s no release of {} for {}'.format(hexsha, publish_path))
+
+    old_dir = None
+    if isdir(publish_path) and not islink(publish_path):
+        old_dir = '{}.old-{}'.format(publish_path, uuid.uuid4())
+        rename(publish_path, old_dir)
+
+    link_path = '{}.link-{}'.format(publish_path, uuid.uuid4())
+    symlink(release_dir, link_path)
+    rename(link_path, publish_path)
+
+    if old_dir:
+        rmtree(old_dir, ignore_errors=True)
+
+def hash_file(path):
+    ''' Return a hash of the contents of the file at the passed path.
+    '''
+    hash = sha1()
+
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            hash.update(chunk)
+
+    return hash.hexdigest()
+
+def make_manifest(dirname):
+    ''' Return content hashes of every file in dirname, keyed on relative path.
+    '''
+    manifest = {}
+
+    for (root, dir_names, file_names) in walk(dirname):
+        for file_name in file_names:
+            path = join(root, file_name)
+            manifest[relpath(path, dirname)] = hash_file(path)
+
+    return manifest
+
+def load_manifest(publish_path, hexsha):
+    ''' Return the manifest of the passed commit's release, or None if there isn't one.
+    '''
+    manifest_path = join(get_releases_dir(publish_path), RELEASE_MANIFEST_PATTERN.format(hexsha=hexsha))
+
+    try:
+        with open(manifest_path) as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return None
+
+def _compress_file(path):
+    ''' Write compressed copies of the file at path next to it, where they're smaller.
+    '''
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    variants = [(GZIP_EXTENSION, _gzip(data))]
+    if brotli is not None:
+        variants.append((BROTLI_EXTENSION, brotli.compress(data)))
+
+    for (extension, compressed) in variants:
+        # a copy might be hard-linked from another release, so replace it instead of writing to it
+        if exists(path + extension):
+            remove(path + extension)
+
+        if len(compressed) < len(data):
+            with open(path + extension, 'wb') as file:
+                file.write(compressed)
+
+def _gzip(data):
+    ''' Return gzipped data, the same each time for the same input.
+    '''
+    buffer = BytesIO()
+    with GzipFile(filename='', mode='wb', fileobj=buffer, compresslevel=9, mtime=0) as file:
+        file.write(data)
+
+    return buffer.getvalue()
+
+def precompress_files(dirname, manifest, old_dir=None, old_manifest=None):
+    ''' Write gzip and brotli copies of the text files in dirname for the web server to send.
+
+        Compressed copies of files that are the same in the old release are
+        hard-linked from it; the rest are compressed in parallel, a process
+        per core. Brotli copies are only made if the brotli module is there.
+    '''
+    old_manifest = old_manifest or {}
+    compress_paths = []
+
+    for path in sorted(manifest):
+        if not path.endswith(COMPRESSED_EXTENSIONS) or getsize(join(dirname, path)) < COMPRESS_MIN_SIZE:
+            continue
+
+        if old_dir and old_manifest.get(path) == manifest[path]:
+            extensions = [GZIP_EXTENSION] + ([BROTLI_EXTENSION] if brotli is not None else [])
+            linked_count = 0
+
+            for extension in extensions:
+                try:
+                    link(join(old_dir, path + extension), join(dirname, path + extension))
+                    linked_count += 1
+                except OSError:
+                    pass
+
+            if linked_count == len(extensions):
+                continue
+
+        compress_paths.append(join(dirname, path))
+
+    if len(compress_paths) > 1:
+        pool = Pool(cpu_count())
+        try:
+            pool.map(_compress_file, compress_paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        map(_compress_file, compress_paths)
+
+def make_release(built_dir, publish_path, hexsha, kept=PUBLISH_RELEASES_KEPT, manifest=None):
+    ''' Move a built site into a new release for the passed commit, and make it live.
+
+        The built site is moved, not copied, so it should already be on
+        the same filesystem; see make_release_staging_dir(). Its manifest
+        is saved with it, and made here if one isn't passed. Releases
+        beyond the newest kept ones are removed, unless they're live.
+    '''
+    releases_dir = get_releases_dir(publish_path)
+    release_dir = join(releases_dir, hexsha)
+
+    with _releases(publish_path) as releases:
+        if get_live_release(publish_path) != hexsha:
+            if exists(release_dir):
+                rmtree(release_dir)
+
+            if manifest is None:
+                manifest = make_manifest(built_dir)
+
+            live_hexsha = get_live_release(publish_path)
+            if live_hexsha:
+                precompress_files(built_dir, manifest, join(releases_dir, live_hexsha), load_manifest(publish_path, live_hexsha))
+            else:
+                precompress_files(built_dir, manifest)
+
+            with open(join(releases_dir, RELEASE_MANIFEST_PATTERN.format(hexsha=hexsha)), 'w') as file:
+                json.dump(manifest, file)
+
+            rename(built_dir, release_dir)
+            _activate_release(publish_path, hexsha)
+
+        releases[:] = [release for release in releases if release['hexsha'] != hexsha]
+        releases.append(dict(hexsha=hexsha, released=time()))
+
+        # remove old releases that aren't live
+        live_hexsha = get_live_release(publish_path)
+        for release in releases[:-kept]:
+            if release['hexsha'] != live_hexsha:
+                rmtree(join(releases_dir, release['hexsha']), ignore_errors=True)
+                manifest_path = join(releases_dir, RELEASE_MANIFEST_PATTERN.format(hexsha=release['hexsha']))
+                if exists(manifest_path):
+                    remove(manifest_path)
+                releases.remove(release)
+
+    Logger.info(u'Released {} to {}'.format(hexsha, publish_path))
+
+def rollback_release(publish_path, hexsha=None):
+    ''' Make a kept release live again, and return its commit SHA.
+
+        With no hexsha, roll back to the release made before the live one.
+        Nothing is rebuilt, so this takes no longer than any other release.
+    '''
+    with _releases(publish_path) as releases:
+        hexshas = [release['hexsha'] for release in releases]
+
+        if hexsha is None:
+            live_hexsha = get_live_release(publish_path)
+            index = hexshas.index(live_hexsha) if live_hexsha in hexshas else len(hexshas)
+            if index < 1:
+                raise ValueError(u'There\'s no release before {} to roll back to'.format(live_hexsha))
+            hexsha = hexshas[index - 1]
+
+        elif hexsha not in hexshas:
+            raise ValueError(u'There\'s no kept release of {} for {}'.format(hexsha, publish_path))
+
+        _activate_release(publish_path, hexsha)
+
+    Logger.info(u'Rolled {} back to {}'.format(publish_path, hexsha))
+    return hexsha
+
+def extract_commit(repo, hexsha, dirname):
+    ''' Write the files in the passed commit to dirname.
+
+        The output of git archive is unpacked as it's read, so nothing
+        is held in memory or written to disk but the files themselves.
+        This works in a bare repository and leaves a clone's index alone.
+    '''
+    archive = repo.git.archive(hexsha, format='tar', as_process=True)
+
+    try:
+        with tarfile.open(fileobj=archive.stdout, mode='r|') as tar:
+            tar.extractall(dirname)
+    finally:
+        archive.stdout.close()
+        archive.wait()
+
+def is_static_path(path):
+    ''' Return True if Jekyll would copy the file at path as it is, going by its name.
+
+        Files that start with front matter are rendered whatever they're
+        called, so their contents have to be checked too.
+    '''
+    for part in path.split('/'):
+        if part.startswith(('.', '_', '#')) or part.endswith('~'):
+            return False
+
+    return True
+
+def is_excluded_path(path, excluded):
+    ''' Return True if the passed path matches the site's excluded paths.
+    '''
+    for pattern in excluded:
+        pattern = pattern.strip('/')
+        if path == pattern or path.startswith(pattern + '/') or fnmatch(path, pattern):
+            return True
+
+    return False
+
+def get_static_changes(repo, old_hexsha, new_hexsha):
+    ''' Return list of static files changed in place between two commits.
+
+        Return None if a page, a layout, the configuration, or anything
+        else Jekyll renders changed, since then the whole site must be
+        built again. So must a static file being added, removed or
+        renamed, because site.static_files and the directory structure
+        generator put the list of files into rendered pages. Changes to
+        files Jekyll leaves out are ignored.
+    '''
+    old_commit, new_commit = repo.commit(old_hexsha), repo.commit(new_hexsha)
+
+    try:
+        config = yaml.safe_load(new_commit.tree['_config.yml'].data_stream.read()) or {}
+    except KeyError:
+        config = {}
+
+    excluded = config.get('exclude') or []
+    changed_paths = []
+
+    # paths are separated by nulls, so none need unquoting
+    fields = repo.git.diff(old_commit.hexsha, new_commit.hexsha, name_status=True, no_renames=True, z=True).split('\0')
+
+    for (status, path) in zip(fields[0::2], fields[1::2]):
+        if path == TASK_METADATA_FILENAME or is_excluded_path(path, excluded):
+            continue
+
+        if status != 'M' or not is_static_path(path):
+            return None
+
+        # a page on either side means rendered output appears or goes away
+        for blob in (old_commit.tree[path], new_commit.tree[path]):
+            if FRONT_MATTER_PATTERN.match(blob.data_stream.read(8)):
+                return None
+
+        changed_paths.append(path)
+
+    return changed_paths
+
+def publish_static_changes(repo, publish_path, old_hexsha, new_hexsha, changed_paths):
+    ''' Make a release of new_hexsha from the release of old_hexsha and the passed static file changes.
+
+        Files that didn't change are hard-linked from the old release, so
+        only the changed files are written, and Jekyll isn't run.
+    '''
+    old_dir = join(get_releases_dir(publish_path), old_hexsha)
+    manifest = load_manifest(publish_path, old_hexsha)
+    release_dir = make_release_staging_dir(publish_path, '.release-')
+    new_tree = repo.commit(new_hexsha).tree
+    skipped_paths = set(changed_paths)
+
+    try:
+        for path in sorted(manifest):
+            if path in skipped_paths:
+                continue
+
+            if not isdir(join(release_dir, dirname(path))):
+                makedirs(join(release_dir, dirname(path)))
+
+            link(join(old_dir, path), join(release_dir, path))
+
+        for path in changed_paths:
+            if not isdir(join(release_dir, dirname(path))):
+                makedirs(join(release_dir, dirname(path)))
+
+            with open(join(release_dir, path), 'wb') as file:
+                new_tree[path].stream_data(file)
+
+            manifest[path] = hash_file(join(release_dir, path))
+
+        make_release(release_dir, publish_path, new_hexsha, manifest=manifest)
+
+    finally:
+        rmtree(release_dir, ignore_errors=True)
+
+    Logger.info(u'Published {} static files changed since {}'.format(len(changed_paths), old_hexsha))
+
+def publish_commit(repo, publish_path, hexsha=None, build_shards=PUBLISH_BUILD_SHARDS):
+    ''' Publish a commit from the given repo as a new release at publish_path.
+
+        Publishes the current commit if no hexsha is passed. The commit is
+        extracted, built, and moved into its release without being copied
+        or zipped along the way, unless the only changes since the live
+        release are to the contents of static files; see
+        publish_static_changes(). Any change to a page is built in full.
+    '''
+    hexsha = repo.commit(hexsha).hexsha
+    live_hexsha = get_live_release(publish_path)
+
+    # if only the contents of static files changed since the live release, skip Jekyll
+    if live_hexsha and live_hexsha != hexsha and isdir(join(get_releases_dir(publish_path), live_hexsha)) \
+       and load_manifest(publish_path, live_hexsha) is not None:
+        try:
+            static_changes = get_static_changes(repo, live_hexsha, hexsha)
+        except (GitCommandError, BadName, ValueError):
+            static_changes = None
+
+        if static_changes is not None:
+            return publish_static_changes(repo, publish_path, live_hexsha, hexsha, static_changes)
+
+    checkout_dir = make_release_staging_dir(publish_path, '.build-')
+
+    try:
+        extract_commit(repo, hexsha, checkout_dir)
+        built_dir = build_jekyll_site(checkout_dir, build_shards)
+
+        if not isdir(built_dir):
+            raise Exception(u'Jekyll didn\'t build a site for {}'.format(hexsha))
+
+        make_release(built_dir, publish_path, hexsha)
+
+    finally:
+        rmtree(checkout_dir, ignore_errors=True)
+
+@contextmanager
+def _publish_jobs(running_state_dir):
+    ''' Lock the publish jobs file and yield its list of jobs, saving any changes.
+
+        Jobs are dictionaries in the order they were queued, each with an
+        "id", the "hexsha" to publish, the "publish_path" to publish it
+        to, the "branch_name" of the activity that asked for it, its
+        "state", how many "attempts" were made, and times it was "queued",
+        "started", and "finished".
+    '''
+    with google_api_functions.WriteLocked(join(running_state_dir, PUBLISH_JOBS_FILE)) as file:
+        try:
+            saved = json.load(file)
+        except ValueError:
+            saved = {}
+
+        jobs = deepcopy(saved.get('jobs', []))
+        yield jobs
+
+        # forget the oldest finished jobs
+        finished = [job for job in jobs if job['state'] in FINISHED_JOB_STATES]
+        for job in finished[:-PUBLISH_JOB_HISTORY_SIZE]:
+            jobs.remove(job)
+
+        if jobs != saved.get('jobs', []):
+            file.seek(0)
+            file.truncate(0)
+            json.dump(dict(jobs=jobs), file, indent=2)
+
+def queue_publish_job(running_state_dir, hexsha, publish_path, branch_name=None):
+    ''' Queue a job to publish the passed commit to publish_path, and return it.
+
+        Queued jobs that haven't started yet for the same publish path
+        are superseded, since only the newest commit needs publishing.
+        Raises ValueError without a publish_path, since the job could
+        never succeed.
+    '''
+    if not publish_path:
+        raise ValueError(u'Can\'t queue a publish job for {} without a publish path'.format(hexsha))
+
+    job = dict(id=str(uuid.uuid4()), hexsha=hexsha, publish_path=publish_path,
+               branch_name=branch_name, state=JOB_STATE_QUEUED, attempts=0,
+               error=None, queued=time(), started=None, finished=None, retry_after=None)
+
+    with _publish_jobs(running_state_dir) as jobs:
+        for older_job in jobs:
+            if older_job['state'] == JOB_STATE_QUEUED and older_job['publish_path'] == publish_path:
+                older_job.update(state=JOB_STATE_SUPERSEDED, finished=time())
+
+        jobs.append(job)
+
+    Logger.info(u'Queued publish job {} for {}'.format(job['id'], hexsha))
+    return job
+
+def get_publish_jobs(running_state_dir):
+    ''' Return all the remembered publish jobs, newest first.
+    '''
+    with _publish_jobs(running_state_dir) as jobs:
+        return list(reversed(jobs))
+
+def get_publish_job_for_branch(running_state_dir, branch_name):
+    ''' Return the newest publish job queued for the passed activity, or None.
+    '''
+    for job in get_publish_jobs(running_state_dir):
+        if job['branch_name'] == branch_name:
+            return job
+
+    return None
+
+def _claim_publish_job(running_state_dir):
+    ''' Mark the oldest publish job that's ready to run as running, and return a copy.
+
+        Running jobs that have gone on too long are taken to be abandoned
+        by a worker that died, and are tried again. Return None if no job
+        is ready.
+    '''
+    now = time()
+
+    with _publish_jobs(running_state_dir) as jobs:
+        for job in jobs:
+            if job['state'] == JOB_STATE_RUNNING and now - job['started'] > PUBLISH_JOB_TIMEOUT:
+                job.update(state=JOB_STATE_QUEUED, error=u'Publishing took too long.')
+
+            if job['state'] != JOB_STATE_QUEUED or (job['retry_after'] or 0) > now:
+                continue
+
+            job.update(state=JOB_STATE_RUNNING, started=now, attempts=job['attempts'] + 1)
+            return dict(job)
+
+    return None
+
+def _finish_publish_job(running_state_dir, job_id, error=None):
+    ''' Record the outcome of a publish job run, queueing it again if it can be retried.
+    '''
+    with _publish_jobs(running_state_dir) as jobs:
+        for job in jobs:
+            if job['id'] != job_id:
+                continue
+
+            if error is None:
+                job.update(state=JOB_STATE_DONE, error=None, finished=time())
+            elif job['attempts'] < PUBLISH_JOB_MAX_ATTEMPTS:
+                job.update(state=JOB_STATE_QUEUED, error=error, retry_after=time() + PUBLISH_JOB_RETRY_DELAY * job['attempts'])
+            else:
+                job.update(state=JOB_STATE_FAILED, error=error, finished=time())
+
+def run_publish_jobs(repo, running_state_dir, build_shards=PUBLISH_BUILD_SHARDS):
+    ''' Run every publish job that's ready, oldest first, and return how many ran.
+
+        The repo is where the jobs' commits are checked out from, usually
+        the origin repository. Nothing is locked while a site builds, so
+        requests can queue new jobs in the meantime. Sites are built by
+        build_shards Jekyll processes at once.
+    '''
+    count = 0
+
+    while True:
+        job = _claim_publish_job(running_state_dir)
+        if job is None:
+            return count
+
+        Logger.info(u'Publishing {} to {}, attempt {}'.format(job['hexsha'], job['publish_path'], job['attempts']))
+
+        try:
+            publish_commit(repo, job['publish_path'], job['hexsha'], build_shards)
+        except Exception as e:
+            Logger.error(u'Publish job {} failed: {}'.format(job['id'], e))
+            _finish_publish_job(running_state_dir, job['id'], u'{}'.format(e))
+        else:
+            _finish_publish_job(running_state_dir, job['id'])
+
+        count += 1
+
+parser = argparse.ArgumentParser(description='List or roll back releases of the live site.')
+parser.add_argument('command', choices=('list', 'rollback'), help='What to do.')
+parser.add_argument('publish_path', help='Path where the live site is published.')
+parser.add_argument('--to', dest='hexsha', help='Commit SHA of the release to roll back to; defaults to the one before the live release.')
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    if args.command == 'rollback':
+        print(rollback_release(args.publish_path, args.hexsha))
+
+    else:
+        live_hexsha = get_live_release(args.publish_path)
+        for release in get_releases(args.publish_path):
+            print('*' if release['hexsha'] == live_hexsha else ' ', release['hexsha'])
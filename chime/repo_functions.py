@@ -1,15 +1,25 @@
 # -- coding: utf-8 --
 from __future__ import absolute_import
 import logging
+from contextlib import contextmanager
 from os import mkdir, remove
 from os.path import join, split, exists, isdir, sep
+from tempfile import mkdtemp
+from shutil import rmtree
+from collections import OrderedDict
+from copy import deepcopy
+from time import time
+from io import BytesIO
 from git import Repo
 from git.cmd import GitCommandError
+from gitdb import IStream
+from gitdb.util import hex_to_bin
 import yaml
 import re
 import json
 import random
 from . import edit_functions, google_api_functions
+from .simple_flock import SimpleFlock
 from . import constants
 
 TASK_METADATA_FILENAME = u'_task.yml'
@@ -28,6 +38,34 @@ ACTIVITY_MERGED_MESSAGE = u'Merged changes from another activity.'
 # Name of file in running state dir that signals a need to push upstream.
 NEEDS_PUSH_FILE = 'needs-push'
 
+# Directory in origin where pushes to each ref take turns, and how long to wait for a turn.
+ORIGIN_LOCKS_DIRNAME = 'chime-locks'
+ORIGIN_LOCK_TIMEOUT = 60
+
+# Name of file in running state dir that remembers which activities conflict with the default branch.
+CONFLICTS_FILE = 'conflicts.json'
+
+# Name of file in running state dir that lists pre-made activity branches.
+ACTIVITY_POOL_FILE = 'activity-pool.json'
+
+# How many unclaimed branches the worker keeps in the activity pool; none unless
+# the ACTIVITY_POOL_SIZE environment variable asks for some.
+ACTIVITY_POOL_SIZE = 0
+
+# Seconds before a claimed pool branch that was never used or released is taken back.
+ACTIVITY_POOL_CLAIM_TIMEOUT = 3600
+
+# Where pool branches are kept in origin until they're claimed, out of the way of
+# branch listings and pushes of every branch.
+ACTIVITY_POOL_REFS = 'refs/chime-pool'
+
+# Syncs and pushes put off until the end of an open branch_transaction(), keyed on clone directory.
+_open_transactions = {}
+
+# How many merge results to remember, keyed on the SHAs of both sides.
+CONFLICT_CACHE_SIZE = 1024
+_conflict_cache = OrderedDict()
+
 # actions for merge conflict descriptions
 CONFLICT_ACTION_CREATED = u'created'
 CONFLICT_ACTION_DELETED = u'deleted'
@@ -120,6 +158,23 @@ def get_activity_working_state(repo, default_branch_name, branch_name):
 
     return constants.WORKING_STATE_ACTIVE
 
+def get_activity_working_state_from_refs(repo, default_branch_name, branch_name):
+    ''' Get whether the activity is active, published, or deleted.
+
+        Like get_activity_working_state(), but only looks at refs that have
+        already been fetched from origin, so the working directory is never touched.
+    '''
+    if branch_name in repo.tags:
+        return constants.WORKING_STATE_PUBLISHED
+
+    if _origin(branch_name) not in repo.refs:
+        return constants.WORKING_STATE_DELETED
+
+    if branch_name == default_branch_name:
+        return constants.WORKING_STATE_LIVE
+
+    return constants.WORKING_STATE_ACTIVE
+
 def get_branch_start_point(clone, default_branch_name, new_branch_name):
     ''' Return the last commit on the branch
     '''
@@ -179,31 +234,50 @@ def get_branch_if_exists_at_origin(clone, default_branch_name, new_branch_name):
 def get_start_branch(clone, default_branch_name, task_description, author_email):
     ''' Start a new repository branch, push it to origin and return it.
 
-        Don't touch the working directory. If an existing branch is found
-        with the same name, use it instead of creating a fresh branch.
+        Don't touch the working directory. The branch and its task metadata
+        commit are made from refs and objects alone, and pushed to origin
+        once. If an existing branch is found with the same name, use it
+        instead of creating a fresh branch.
     '''
+    # only the default branch needs to be current to start from it
+    clone.git.fetch('origin', default_branch_name)
 
     # make a new branch name
     new_branch_name = make_branch_name()
 
-    existing_branch = get_existing_branch(clone, default_branch_name, new_branch_name)
-    if existing_branch:
-        return existing_branch
+    if new_branch_name in clone.branches or _origin(new_branch_name) in clone.refs:
+        return get_existing_branch(clone, default_branch_name, new_branch_name)
 
-    # create a brand new branch
+    # commit the task metadata file on top of the default branch
     start_point = get_branch_start_point(clone, default_branch_name, new_branch_name)
-    branch = clone.create_head(new_branch_name, commit=start_point, force=True)
-    clone.git.push('origin', new_branch_name)
+    task_metadata = {"author_email": author_email, "task_description": task_description, "branch_name": new_branch_name}
+    message = make_commit_message(subject=u'The "{}" {}'.format(task_description, ACTIVITY_CREATED_MESSAGE), body=json.dumps(task_metadata, ensure_ascii=False))
+    task_file = BytesIO()
+    dump_task_metadata(task_metadata, task_file)
+    commit_sha = make_commit_with_file(clone, start_point, TASK_METADATA_FILENAME, task_file.getvalue(), message)
 
-    # create the task metadata file in the new branch
-    active_branch_name = clone.active_branch.name
-    clone.git.checkout(new_branch_name)
-    metadata_values = {"author_email": author_email, "task_description": task_description, "branch_name": new_branch_name}
-    save_task_metadata_for_branch(clone, default_branch_name, metadata_values)
-    clone.git.checkout(active_branch_name)
+    branch = clone.create_head(new_branch_name, commit=commit_sha, force=True)
+    push_to_origin(clone, [new_branch_name])
 
     return branch
 
+def make_commit_with_file(clone, parent_commit, path, content, message):
+    ''' Return the SHA of a new commit on parent_commit that adds or replaces one file.
+
+        The commit is built in a temporary index, so nothing is checked out.
+    '''
+    index_dirname = mkdtemp(dir=clone.git_dir)
+    try:
+        with clone.git.custom_environment(GIT_INDEX_FILE=join(index_dirname, 'index')):
+            clone.git.read_tree(parent_commit.hexsha)
+            blob = clone.odb.store(IStream('blob', len(content), BytesIO(content)))
+            clone.git.update_index('--add', '--cacheinfo', u'100644,{},{}'.format(blob.hexsha, path))
+            tree_sha = clone.git.write_tree()
+
+        return clone.git.commit_tree(tree_sha, p=parent_commit.hexsha, m=message.encode('utf8'))
+    finally:
+        rmtree(index_dirname)
+
 def strip_index_file(file_path):
     ''' Strip the index file from the end of the passed path
     '''
@@ -230,6 +304,17 @@ def ignore_task_metadata_on_merge(clone):
     c_writer.set_value('merge "ignored"', 'driver', 'true')
     c_writer = None
 
+def dump_task_metadata(task_metadata, file):
+    ''' Write the passed task metadata to a file as YAML.
+    '''
+    # Use newline-preserving block literal form.
+    # yaml.SafeDumper ensures best unicode output.
+    dump_kwargs = dict(Dumper=yaml.SafeDumper, default_flow_style=False,
+                       canonical=False, default_style='|', indent=2,
+                       allow_unicode=True)
+
+    yaml.dump(task_metadata, file, **dump_kwargs)
+
 def save_task_metadata_for_branch(clone, default_branch_name, values={}):
     ''' Save the passed values to the branch's task metadata file, preserving values that aren't overwritten.
     '''
@@ -255,22 +340,16 @@ def save_task_metadata_for_branch(clone, default_branch_name, values={}):
         message = make_commit_message(subject=u'The "{}" {}'.format(task_metadata['task_description'], ACTIVITY_UPDATED_MESSAGE), body=task_metadata_json)
 
     # Dump the updated task metadata to disk
-    # Use newline-preserving block literal form.
-    # yaml.SafeDumper ensures best unicode output.
-    dump_kwargs = dict(Dumper=yaml.SafeDumper, default_flow_style=False,
-                       canonical=False, default_style='|', indent=2,
-                       allow_unicode=True)
-
     task_file_path = join(clone.working_dir, TASK_METADATA_FILENAME)
     with open(task_file_path, 'w') as file:
         file.seek(0)
         file.truncate()
-        yaml.dump(task_metadata, file, **dump_kwargs)
+        dump_task_metadata(task_metadata, file)
 
     # add & commit the file to the branch
     return save_working_file(clone, TASK_METADATA_FILENAME, message, clone.commit().hexsha, default_branch_name)
 
-def delete_task_metadata_for_branch(clone, default_branch_name):
+def delete_task_metadata_for_branch(clone, default_branch_name, push=True):
     ''' Delete the task metadata file and return its contents
     '''
     task_metadata = get_task_metadata_for_branch(clone)
@@ -279,7 +358,10 @@ def delete_task_metadata_for_branch(clone, default_branch_name):
     if do_save:
         task_metadata_json = json.dumps(task_metadata, ensure_ascii=False)
         message = make_commit_message(subject=u'The "{}" {}'.format(task_metadata['task_description'], ACTIVITY_DELETED_MESSAGE), body=task_metadata_json)
-        save_working_file(clone, TASK_METADATA_FILENAME, message, clone.commit().hexsha, default_branch_name)
+        if push:
+            save_working_file(clone, TASK_METADATA_FILENAME, message, clone.commit().hexsha, default_branch_name)
+        else:
+            save_local_working_file(clone, TASK_METADATA_FILENAME, message)
     return task_metadata, message
 
 def get_task_metadata_for_branch(clone, working_branch_name=None):
@@ -430,17 +512,23 @@ def complete_branch(clone, default_branch_name, working_branch_name, comment_tex
 
     # tag the commit with the branch name and a json object containing the task metadata
     task_metadata_json = json.dumps(task_metadata, ensure_ascii=False)
-    clone.create_tag(working_branch_name, message=task_metadata_json)
+    tag = clone.create_tag(working_branch_name, message=task_metadata_json)
 
     #
-    # Delete the working branch.
+    # Push the default branch and the tag, and delete the working branch, all at once.
     #
-    clone.remotes.origin.push(':' + working_branch_name)
-    clone.delete_head([working_branch_name])
+    refspecs = [default_branch_name, tag.path] + _deletion_refspecs(clone, working_branch_name)
+    try:
+        push_to_origin(clone, refspecs, atomic=True)
+    except GitCommandError:
+        # nothing changed in origin, so put the clone back how it was
+        clone.delete_tag(tag)
+        clone.git.reset(default_reset_commit.hexsha, hard=True)
+        clone.git.checkout(working_branch_name)
+        clone.git.reset(working_reset_commit.hexsha, hard=True)
+        raise
 
-    # now push the changes and the tag to origin
-    clone.git.push('origin', default_branch_name)
-    clone.git.push('--tags')
+    clone.delete_head([working_branch_name])
 
     return clone.commit()
 
@@ -450,14 +538,16 @@ def abandon_branch(clone, default_branch_name, working_branch_name, comment_text
     #
     # Delete the task metadata and commit an activity deletion message.
     #
-    _, message = delete_task_metadata_for_branch(clone, default_branch_name)
+    _, message = delete_task_metadata_for_branch(clone, default_branch_name, push=False)
 
     #
     # Delete the old branch.
     #
     clone.branches[default_branch_name].checkout()
     clone.index.commit(message)
-    clone.remotes.origin.push(':' + working_branch_name)
+    deletion_refspecs = _deletion_refspecs(clone, working_branch_name)
+    if deletion_refspecs:
+        push_to_origin(clone, deletion_refspecs)
 
     if working_branch_name in clone.branches:
         clone.git.branch('-D', working_branch_name)
@@ -478,14 +568,139 @@ def clobber_default_branch(clone, default_branch_name, working_branch_name, comm
     clone.branches[default_branch_name].checkout()
     clone.git.pull('origin', default_branch_name)
     clone.git.merge(working_branch_name, '--ff-only')
-    clone.git.push('origin', default_branch_name)
 
     #
-    # Delete the working branch.
+    # Push the default branch and delete the working branch, all at once.
     #
-    clone.remotes.origin.push(':' + working_branch_name)
+    push_to_origin(clone, [default_branch_name] + _deletion_refspecs(clone, working_branch_name), atomic=True)
     clone.delete_head([working_branch_name])
 
+def push_to_origin(clone, refspecs, atomic=False):
+    ''' Push the passed refspecs to origin, taking turns with other pushes to the same refs.
+
+        Pushes to a ref are queued on a lock file for that ref in origin,
+        so simultaneous saves and publishes from different processes line
+        up instead of failing to lock the ref and retrying. Locks are
+        taken in name order, so pushes to overlapping refs can't deadlock.
+        With atomic, either every ref in origin is updated or none are,
+        so a failed push can't leave an activity half-published.
+    '''
+    lock_paths = [_get_origin_lock_path(clone, refspec) for refspec in refspecs]
+    options = ['--atomic'] if atomic else []
+
+    with _locked(sorted(set(filter(None, lock_paths)))):
+        clone.git.push('origin', *(options + list(refspecs)))
+
+@contextmanager
+def _locked(lock_paths):
+    ''' Hold a lock on each of the passed paths, in order.
+    '''
+    if not lock_paths:
+        yield
+        return
+
+    with SimpleFlock(lock_paths[0], ORIGIN_LOCK_TIMEOUT):
+        with _locked(lock_paths[1:]):
+            yield
+
+def _get_origin_lock_path(clone, refspec):
+    ''' Return the path to the lock file for the origin ref the passed refspec updates,
+        or None if origin isn't on this machine.
+    '''
+    origin_path = clone.remotes.origin.url
+    if not isdir(origin_path):
+        return None
+
+    return _get_ref_lock_path(origin_path, refspec)
+
+def _get_ref_lock_path(origin_path, refspec):
+    ''' Return the path to the lock file for the ref the passed refspec updates in origin.
+    '''
+    # lock files live in origin's git directory
+    if isdir(join(origin_path, '.git')):
+        origin_path = join(origin_path, '.git')
+
+    locks_dirname = join(origin_path, ORIGIN_LOCKS_DIRNAME)
+    if not isdir(locks_dirname):
+        try:
+            mkdir(locks_dirname)
+        except OSError:
+            # someone else made it first
+            pass
+
+    # 'master', 'sha:master', and ':refs/heads/master' all update refs/heads/master
+    ref_name = refspec.lstrip('+').split(':')[-1]
+    if not ref_name.startswith('refs/'):
+        ref_name = 'refs/heads/{}'.format(ref_name)
+
+    return join(locks_dirname, '{}.lock'.format(re.sub(r'\W+', '-', ref_name)))
+
+def _deletion_refspecs(clone, branch_name):
+    ''' Return a list with a refspec that deletes the passed branch from origin,
+        or an empty list if it's already gone; an atomic push fails outright
+        if it's asked to delete a missing branch.
+    '''
+    if _origin(branch_name) in clone.refs:
+        return [':refs/heads/{}'.format(branch_name)]
+
+    return []
+
+@contextmanager
+def branch_transaction(clone):
+    ''' Group several commits to the clone's active branch, then sync and push them once.
+
+        Inside the with block, save_working_file(), move_existing_file(),
+        add_empty_commit() and the functions built on them commit locally
+        and note which branches they'd sync with. When the block ends, the
+        branch is synced with each of those branches once and pushed once,
+        so a review action with a comment and a rename costs one round
+        trip instead of three. Might raise a MergeConflict on the way out.
+
+        Commits returned inside the block are from before the sync, so the
+        branch may move on from them. The with statement gets a dictionary
+        whose "hexsha" is set to the synced and pushed commit once the block
+        ends; tell users their changes were saved only after that.
+    '''
+    key = clone.working_dir
+    if key in _open_transactions:
+        # already in a transaction; the outer one will sync and push
+        yield _open_transactions[key]
+        return
+
+    _open_transactions[key] = dict(sync_branch_names=[], push=False, hexsha=None)
+    try:
+        yield _open_transactions[key]
+    finally:
+        transaction = _open_transactions.pop(key)
+
+    if transaction['sync_branch_names']:
+        sync_and_push(clone, transaction['sync_branch_names'], transaction['push'])
+
+    transaction['hexsha'] = clone.active_branch.commit.hexsha
+
+def sync_and_push(clone, sync_branch_names, push=True):
+    ''' Sync the active branch with each of the passed branches in turn, then push it.
+
+        Inside a branch_transaction(), just note the branches for later.
+    '''
+    transaction = _open_transactions.get(clone.working_dir)
+    if transaction is not None:
+        for sync_branch_name in sync_branch_names:
+            if sync_branch_name not in transaction['sync_branch_names']:
+                transaction['sync_branch_names'].append(sync_branch_name)
+        transaction['push'] = transaction['push'] or push
+        return
+
+    active_branch_name = clone.active_branch.name
+    for sync_branch_name in sync_branch_names:
+        # a branch claimed from the activity pool isn't in origin until it's first pushed
+        if sync_branch_name == active_branch_name and _origin(sync_branch_name) not in clone.refs:
+            continue
+        sync_with_branch(clone, active_branch_name, sync_branch_name)
+
+    if push:
+        push_to_origin(clone, [active_branch_name])
+
 def sync_with_branch(clone, working_branch_name, sync_branch_name):
     ''' Sync the passed branch with default and upstream branches.
     '''
@@ -526,6 +741,10 @@ def save_working_file(clone, path, message, base_sha, default_branch_name):
         After committing the new file, attempts to merge the origin working
         branch and the origin default branches in turn, to surface possible
         merge problems early. Might raise a MergeConflict.
+
+        Inside a branch_transaction(), the merges and push wait until the
+        transaction ends, so the returned commit is the unsynced one; use
+        the transaction's "hexsha" for the commit that was pushed.
     '''
     if clone.active_branch.commit.hexsha != base_sha:
         raise Exception(u'Unable to save page because someone else made edits while you were working.')
@@ -539,38 +758,115 @@ def save_working_file(clone, path, message, base_sha, default_branch_name):
     #
     # Sync with the default and upstream branches in case someone made a change.
     #
-    for sync_branch_name in (active_branch_name, ):
-        try:
-            sync_with_branch(clone, active_branch_name, sync_branch_name)
-        except MergeConflict as conflict:
-            raise conflict
-
-    clone.git.push('origin', active_branch_name)
+    sync_and_push(clone, (active_branch_name, ))
 
     return clone.active_branch.commit
 
-def get_conflict(clone, other_branch_name):
+def get_conflict(clone, other_branch_name, branch_name=None):
     ''' Attempt to merge from origin default branch, return a conflict (if any).
 
-        Currently requires a clean working tree in the clone!
+        Merges the origin copy of branch_name, or the clone's current commit
+        if no branch name is passed. The merge happens in memory, so the
+        working tree isn't touched, and the result is remembered for the
+        pair of commits.
     '''
     clone.git.fetch('origin', other_branch_name)
 
-    try:
-        # Try a no-commit merge from the other branch.
-        clone.git.merge(_origin(other_branch_name), '--no-commit')
+    if branch_name:
+        local_commit = clone.refs[_origin(branch_name)].commit
+    else:
+        local_commit = clone.commit()
 
-    except GitCommandError as err:
-        # Okay, we have a conflict. Make a new MergeConflict and return it.
-        clone.git.merge('--abort')
-        logging.info('Git command "{}" returned status {}'.format(' '.join(err.command), err.status))
+    remote_commit = clone.refs[_origin(other_branch_name)].commit
 
-        remote_commit = clone.refs[_origin(other_branch_name)].commit
-        return MergeConflict(remote_commit, local_commit=clone.commit())
+    if get_merge_conflicted(clone, local_commit.hexsha, remote_commit.hexsha):
+        return MergeConflict(remote_commit, local_commit)
 
+def get_merge_conflicted(clone, local_hexsha, remote_hexsha):
+    ''' Return True if merging the two passed commits would conflict.
+    '''
+    key = (local_hexsha, remote_hexsha)
+    if key in _conflict_cache:
+        conflicted = _conflict_cache.pop(key)
     else:
-        # Merged clean, we're clean, everybody's clean.
-        clone.git.reset('--hard')
+        conflicted = merge_tree_conflicted(clone, local_hexsha, remote_hexsha)
+
+    # the most recently used results are at the end
+    _conflict_cache[key] = conflicted
+    while len(_conflict_cache) > CONFLICT_CACHE_SIZE:
+        _conflict_cache.popitem(last=False)
+
+    return conflicted
+
+def merge_tree_conflicted(clone, local_hexsha, remote_hexsha):
+    ''' Merge the two passed commits with merge-tree, return True if they conflict.
+
+        Conflicts in the task metadata file are skipped, as they are by
+        ignore_task_metadata_on_merge(), so bare repositories agree with clones.
+    '''
+    status, output, _ = clone.git.merge_tree(
+        local_hexsha, remote_hexsha, write_tree=True, name_only=True, no_messages=True,
+        with_extended_output=True, with_exceptions=False
+    )
+
+    # merge-tree exits with 1 for a conflict, and lists the conflicted files after the tree
+    if status == 1:
+        conflicted_paths = set(output.splitlines()[1:]) - set([TASK_METADATA_FILENAME])
+        return bool(conflicted_paths)
+
+    if status != 0:
+        # older versions of git can't write merged trees
+        logging.info('Git merge-tree returned status {}'.format(status))
+        return index_merge_conflicted(clone, local_hexsha, remote_hexsha)
+
+    return False
+
+def index_merge_conflicted(clone, local_hexsha, remote_hexsha):
+    ''' Merge the two passed commits in a temporary index, return True if they conflict.
+
+        The task metadata file is skipped, as it is by ignore_task_metadata_on_merge().
+    '''
+    base_hexsha = clone.git.merge_base(local_hexsha, remote_hexsha)
+    merge_dirname = mkdtemp(prefix='merge-', dir=clone.git_dir)
+
+    try:
+        with clone.git.custom_environment(GIT_INDEX_FILE=join(merge_dirname, 'index')):
+            clone.git.read_tree(base_hexsha, local_hexsha, remote_hexsha, m=True, i=True, aggressive=True)
+            unmerged = clone.git.ls_files(u=True, z=True)
+
+        # collect the base (1), local (2), and remote (3) blobs of each unmerged file
+        stages = {}
+        for line in unmerged.split('\0'):
+            if not line:
+                continue
+            info, path = line.split('\t', 1)
+            _, hexsha, stage = info.split()
+            stages.setdefault(path, {})[stage] = hexsha
+
+        for (path, hexshas) in stages.items():
+            if path == TASK_METADATA_FILENAME:
+                continue
+
+            # added on both sides, or edited on one side and deleted on the other
+            if len(hexshas) < 3:
+                return True
+
+            # edited on both sides; see if the edits can be merged
+            blob_paths = []
+            for stage in ('2', '1', '3'):
+                blob_paths.append(join(merge_dirname, stage))
+                with open(blob_paths[-1], 'w') as file:
+                    file.write(clone.odb.stream(hex_to_bin(hexshas[stage])).read())
+
+            try:
+                clone.git.merge_file(*blob_paths, p=True, q=True)
+            except GitCommandError:
+                return True
+
+    finally:
+        rmtree(merge_dirname)
+
+    return False
 
 def get_changed(clone, other_branch_name):
     ''' Check differenace against origin default branch, return a boolean True if any.
@@ -594,6 +890,10 @@ def move_existing_file(clone, old_path, new_path, base_sha, default_branch_name)
         After committing the new file, attempts to merge the origin working
         branch and the origin default branches in turn, to surface possible
         merge problems early. Might raise a MergeConflict.
+
+        Inside a branch_transaction(), the merges and push wait until the
+        transaction ends, so the returned commit is the unsynced one; use
+        the transaction's "hexsha" for the commit that was pushed.
     '''
     if clone.active_branch.commit.hexsha != base_sha:
         raise Exception(u'Unable to move page because someone else made edits while you were working.')
@@ -623,13 +923,7 @@ def move_existing_file(clone, old_path, new_path, base_sha, default_branch_name)
     #
     # Sync with the default and upstream branches in case someone made a change.
     #
-    for sync_branch_name in (active_branch_name, default_branch_name):
-        try:
-            sync_with_branch(clone, active_branch_name, sync_branch_name)
-        except MergeConflict as conflict:
-            raise conflict
-
-    clone.git.push('origin', active_branch_name)
+    sync_and_push(clone, (active_branch_name, default_branch_name))
 
     return clone.active_branch.commit
 
@@ -778,14 +1072,7 @@ def add_empty_commit(clone, subject, body, push=True):
     #
     # Sync with the default and upstream branches in case someone made a change.
     #
-    for sync_branch_name in (active_branch_name, ):
-        try:
-            sync_with_branch(clone, active_branch_name, sync_branch_name)
-        except MergeConflict as conflict:
-            raise conflict
-
-    if push:
-        clone.git.push('origin', active_branch_name)
+    sync_and_push(clone, (active_branch_name, ), push)
 
     return clone.active_branch.commit
 
@@ -838,6 +1125,240 @@ def mark_upstream_push_needed(running_state_dir):
         file.truncate()
         file.write('Yes')
 
+def get_conflicted_branch_names(repo, default_branch_name, running_state_dir, branch_names=None):
+    ''' Return a set of the passed branch names that would conflict with the default branch.
+
+        Checks every branch but the default if no names are passed. Answers
+        are kept in the conflicts file in the running state dir, keyed on
+        branch SHAs, until the default branch moves; only branches that
+        have moved since the last check get merged. Answers for other
+        branches are kept, unless every branch was checked.
+    '''
+    checked_all = branch_names is None
+    if checked_all:
+        branch_names = [branch.name for branch in repo.branches if branch.name != default_branch_name]
+
+    default_hexsha = repo.branches[default_branch_name].commit.hexsha
+    conflicts_path = join(running_state_dir, CONFLICTS_FILE)
+    conflicted_branch_names = set()
+
+    with google_api_functions.WriteLocked(conflicts_path) as file:
+        try:
+            saved = json.load(file)
+        except ValueError:
+            saved = {}
+
+        # answers for another default branch tip are no use
+        if saved.get('default_hexsha') == default_hexsha:
+            conflicts = saved.get('conflicts', {})
+        else:
+            conflicts = {}
+
+        checked_conflicts = {}
+        for branch_name in branch_names:
+            hexsha = repo.branches[branch_name].commit.hexsha
+            if hexsha not in conflicts:
+                try:
+                    conflicts[hexsha] = get_merge_conflicted(repo, hexsha, default_hexsha)
+                except GitCommandError:
+                    # Skip this branch if it looks to be an orphan.
+                    continue
+
+            checked_conflicts[hexsha] = conflicts[hexsha]
+            if conflicts[hexsha]:
+                conflicted_branch_names.add(branch_name)
+
+        # save the answers, forgetting those for old branch tips after checking every branch
+        checked = dict(default_hexsha=default_hexsha, conflicts=checked_conflicts if checked_all else conflicts)
+        if checked != saved:
+            file.seek(0)
+            file.truncate(0)
+            json.dump(checked, file, indent=2)
+
+    return conflicted_branch_names
+
+@contextmanager
+def _activity_pool(running_state_dir):
+    ''' Lock the activity pool file and yield its branches, saving any changes.
+
+        Branches are a dictionary keyed on name, each with the "hexsha"
+        it was made at and the time it was "claimed", or None.
+    '''
+    with google_api_functions.WriteLocked(join(running_state_dir, ACTIVITY_POOL_FILE)) as file:
+        try:
+            saved = json.load(file)
+        except ValueError:
+            saved = {}
+
+        branches = deepcopy(saved.get('branches', {}))
+        yield branches
+
+        if branches != saved.get('branches', {}):
+            file.seek(0)
+            file.truncate(0)
+            json.dump(dict(branches=branches), file, indent=2)
+
+def _pool_ref(branch_name):
+    ''' Return the name of the ref in origin that keeps an unclaimed pool branch.
+    '''
+    return '{}/{}'.format(ACTIVITY_POOL_REFS, branch_name)
+
+def _update_pool_ref(origin, branch_name, new_hexsha, old_hexsha):
+    ''' Move, make, or delete a pool ref in origin, taking turns with pushes to it.
+
+        Raises GitCommandError if the ref isn't at old_hexsha any more.
+    '''
+    ref_name = _pool_ref(branch_name)
+
+    with _locked([_get_ref_lock_path(origin.git_dir, ref_name)]):
+        if new_hexsha is None:
+            origin.git.update_ref('-d', ref_name, old_hexsha)
+        else:
+            origin.git.update_ref(ref_name, new_hexsha, old_hexsha)
+
+def _get_pool_refs(origin):
+    ''' Return a dictionary of pool branch names and SHAs kept in origin.
+    '''
+    output = origin.git.for_each_ref('--format=%(objectname) %(refname)', ACTIVITY_POOL_REFS)
+    pool_refs = dict()
+
+    for line in output.splitlines():
+        hexsha, ref_name = line.split(' ', 1)
+        pool_refs[ref_name[len(ACTIVITY_POOL_REFS) + 1:]] = hexsha
+
+    return pool_refs
+
+def fill_activity_pool(origin, default_branch_name, running_state_dir, size=ACTIVITY_POOL_SIZE):
+    ''' Keep size unclaimed, unannounced activity branches in the origin repository.
+
+        Pool branches are refs under ACTIVITY_POOL_REFS at the tip of the
+        default branch, with no task metadata, so they aren't listed as
+        activities or pushed upstream. They are moved along with the
+        default branch until someone claims one, and the first push to a
+        claimed one makes it a real branch. A branch that exists has been
+        used, so it's dropped from the pool. So is one whose claim timed
+        out, since its task metadata commit may be waiting unpushed in a
+        clone, and a second claimant would share the branch. Unclaimed
+        branches over size are dropped too, so a size of zero empties the
+        pool. Works on the origin repository directly.
+    '''
+    pool_refs = _get_pool_refs(origin)
+
+    with _activity_pool(running_state_dir) as branches:
+        if not size and not branches and not pool_refs:
+            # the pool is turned off
+            return
+
+        default_hexsha = origin.branches[default_branch_name].commit.hexsha
+        origin_branch_names = set([ref.name for ref in origin.branches])
+        unclaimed_count, dropped_names = 0, []
+
+        for branch_name in sorted(branches):
+            branch = branches[branch_name]
+            claimed = branch['claimed']
+            if claimed and time() - claimed < ACTIVITY_POOL_CLAIM_TIMEOUT:
+                continue
+
+            if claimed or branch_name in origin_branch_names or pool_refs.get(branch_name) != branch['hexsha']:
+                # the branch was used, might be in use, or its ref is gone, so it's not ours any more
+                branches.pop(branch_name)
+                dropped_names.append(branch_name)
+                continue
+
+            if unclaimed_count >= size:
+                branches.pop(branch_name)
+                dropped_names.append(branch_name)
+                continue
+
+            if branch['hexsha'] != default_hexsha:
+                # keep up with the default branch
+                try:
+                    _update_pool_ref(origin, branch_name, default_hexsha, branch['hexsha'])
+                except GitCommandError:
+                    branches.pop(branch_name)
+                    continue
+
+            branches[branch_name] = dict(hexsha=default_hexsha, claimed=None)
+            unclaimed_count += 1
+
+        # forget the refs of branches that left the pool; refs this pool doesn't
+        # know about might belong to another worker's, unless they were used
+        for branch_name in pool_refs:
+            if branch_name in dropped_names or (branch_name not in branches and branch_name in origin_branch_names):
+                try:
+                    _update_pool_ref(origin, branch_name, None, pool_refs[branch_name])
+                except GitCommandError:
+                    pass
+
+        taken_names = origin_branch_names | set([ref.name for ref in origin.tags] + list(pool_refs))
+
+        while unclaimed_count < size:
+            branch_name = make_branch_name()
+            if branch_name in taken_names or branch_name in branches:
+                continue
+
+            # an all-zero old value makes sure the ref is new
+            try:
+                _update_pool_ref(origin, branch_name, default_hexsha, '0' * 40)
+            except GitCommandError:
+                if not origin.git.for_each_ref(_pool_ref(branch_name)):
+                    raise
+
+                # another worker made a ref with this name first, so it's theirs
+                taken_names.add(branch_name)
+                continue
+
+            branches[branch_name] = dict(hexsha=default_hexsha, claimed=None)
+            unclaimed_count += 1
+
+def claim_pool_branch(running_state_dir):
+    ''' Claim an unused branch from the activity pool, and return its name and commit SHA.
+
+        Return (None, None) if the pool is empty. A claimed branch becomes
+        an activity when task metadata is first pushed to it; until then,
+        release_pool_branch() returns it to the pool without any pushing.
+    '''
+    with _activity_pool(running_state_dir) as branches:
+        for branch_name in sorted(branches):
+            if not branches[branch_name]['claimed']:
+                branches[branch_name]['claimed'] = time()
+                return branch_name, branches[branch_name]['hexsha']
+
+    return None, None
+
+def fetch_pool_branch(clone, branch_name):
+    ''' Fetch a claimed pool branch's commit from origin into the clone.
+    '''
+    clone.git.fetch('origin', _pool_ref(branch_name))
+
+def release_pool_branch(clone, running_state_dir, branch_name):
+    ''' Return a claimed branch that wasn't used to the activity pool.
+
+        If it was pushed to after all, it's a real branch now and it's dropped from the pool instead.
+    '''
+    pushed = bool(clone.git.ls_remote('origin', 'refs/heads/{}'.format(branch_name)).strip())
+
+    with _activity_pool(running_state_dir) as branches:
+        if branch_name not in branches:
+            return
+
+        if pushed:
+            branches.pop(branch_name)
+        else:
+            branches[branch_name]['claimed'] = None
+
+def remove_pool_branch(running_state_dir, branch_name):
+    ''' Take a claimed branch that's now an activity out of the activity pool.
+    '''
+    with _activity_pool(running_state_dir) as branches:
+        branches.pop(branch_name, None)
+
+def get_pool_branch_names(running_state_dir):
+    ''' Return a set of the names of branches in the activity pool, claimed or not.
+    '''
+    with _activity_pool(running_state_dir) as branches:
+        return set(branches)
+
 def push_upstream_if_needed(repo, running_state_dir):
     ''' If needs-push file is found and origin exists, push it.
     '''
@@ -0,0 +1,14 @@
+$(document).ready(function() {
+	$('.dir__more').click(function(e) {
+		e.preventDefault();
+		var more = $(this);
+		$.getJSON(more.attr('href'), function(page) {
+			more.siblings('.dir').append(page.html);
+			if (page.more_path) {
+				more.attr('href', page.more_path);
+			} else {
+				more.remove();
+			}
+		});
+	})
+})
@@ -1,14 +1,18 @@
 from contextlib import contextmanager
 from os.path import join, exists, dirname, relpath, isdir, realpath
-from os import environ, makedirs
+from os import environ, remove
+from io import BytesIO
+from tempfile import TemporaryFile
 from time import sleep, time
 import fcntl
 import errno
 
 from git import Repo, GitCommandError
+from gitdb import IStream
+from gitdb.util import hex_to_bin
 from slugify import slugify
 
-from ..repo_functions import MergeConflict
+from ..repo_functions import MergeConflict, push_to_origin
 from ..constants import WORKING_STATE_PUBLISHED, WORKING_STATE_DELETED, WORKING_STATE_LIVE, WORKING_STATE_ACTIVE, USERTASK_DIRECTORY_PATTERN
 
 def _calculate_dirname(actor, origin):
@@ -34,18 +38,32 @@ class UserTaskUnpushable(RuntimeError):
     pass
 
 class UserTask():
+    ''' One user's edits to one task, built as a commit without a working tree.
+
+        Changed files are written straight to the object database and staged
+        in a private index that starts out as a copy of start_point's tree,
+        so saving doesn't depend on the size of the checkout. The working
+        tree is only used when the task has moved on since start_point
+        and the new commit has to be rebased onto it.
+    '''
     actor = None
     commit_sha = None
+    new = False
+    _local_sha = None
+    _index_path = None
     _writeable = True
     _committed = False
     _pushed = False
 
-    def __init__(self, actor, task_id, default_id, origin_dirname, working_dirname, start_point=None):
+    def __init__(self, actor, task_id, default_id, origin_dirname, working_dirname, start_point=None, new=False):
         '''
 
             start_point: task ID or commit SHA.
+            new: True if the task isn't in origin until it's first pushed,
+                 like a branch claimed from the activity pool.
         '''
         self.actor = actor
+        self.new = new
         self.task_id = task_id
         self.default_id = default_id
 
@@ -58,13 +76,9 @@ class UserTask():
 
         if isdir(clone_dirname):
             self.repo = Repo(clone_dirname)
-            self.repo.git.checkout('zelig')
-            self.repo.git.reset('origin/master', hard=True)
         else:
-            # Clone origin to local checkout.
-            self.repo = origin.clone(clone_dirname)
-            self.repo.git.checkout('zelig', orphan=True)
-            self.repo.git.reset('origin/master', hard=True)
+            # Clone origin to local repository, without checking anything out.
+            self.repo = origin.clone(clone_dirname, no_checkout=True)
 
         # Fetch all branches from origin.
         self.repo.git.fetch('origin')
@@ -81,8 +95,9 @@ class UserTask():
         else:
             self.commit_sha = start_point
 
-        # Point local zelig to start_point.
-        self.repo.git.reset(self.commit_sha, hard=True)
+        # Start a private index from start_point's tree.
+        self._index_path = join(self.repo.git_dir, 'usertask-index')
+        self._git_index('read_tree', self.commit_sha)
 
     def __repr__(self):
         return '<UserTask {} in {}>'.format(self.actor.email, self.repo.working_dir)
@@ -108,8 +123,24 @@ class UserTask():
     def _unlock(self):
         fcntl.flock(self._lockfile, fcntl.LOCK_UN)
 
-    def _open(self, path, *args, **kwargs):
-        return open(join(self.repo.working_dir, path), *args, **kwargs)
+    def _git_index(self, command, *args, **kwargs):
+        ''' Run a git command against this task's private index.
+        '''
+        with self.repo.git.custom_environment(GIT_INDEX_FILE=self._index_path):
+            return getattr(self.repo.git, command)(*args, **kwargs)
+
+    def _list_index(self, path):
+        ''' Return a list of (mode, sha, path) tuples for index entries at or under the passed path.
+        '''
+        entries = []
+        for line in self._git_index('ls_files', '-s', '-z', '--', path).split('\0'):
+            if not line:
+                continue
+            info, entry_path = line.split('\t', 1)
+            mode, sha, _ = info.split()
+            entries.append((mode, sha, entry_path))
+
+        return entries
 
     @property
     def published(self):
@@ -121,7 +152,7 @@ class UserTask():
     def deleted(self):
         ''' True if this task is deleted
         '''
-        return 'origin/{}'.format(self.task_id) not in self.repo.refs
+        return not self.new and 'origin/{}'.format(self.task_id) not in self.repo.refs
 
     @property
     def live(self):
@@ -143,15 +174,41 @@ class UserTask():
         return WORKING_STATE_ACTIVE
 
     def read(self, filename):
-        with self._open(filename, 'r') as file:
-            return file.read()
+        for (mode, sha, path) in self._list_index(filename):
+            if path == filename:
+                return self.repo.odb.stream(hex_to_bin(sha)).read()
+
+        raise IOError(errno.ENOENT, 'No such file in task', filename)
+
+    def open(self, filename):
+        ''' Return a file-like object with the contents of the passed file.
+        '''
+        return BytesIO(self.read(filename))
 
     def write(self, filename, content):
         assert self._writeable and not (self._committed or self._pushed)
 
-        with self._open(filename, 'w') as file:
-            file.write(content)
-        self.repo.git.add(filename)
+        blob = self.repo.odb.store(IStream('blob', len(content), BytesIO(content)))
+        cacheinfo = u'100644,{},{}'.format(blob.hexsha, filename)
+        self._git_index('update_index', '--add', '--cacheinfo', cacheinfo)
+
+    def write_files(self, files):
+        ''' Write each (filename, stream, size) in the passed iterable.
+
+            Each stream is copied into the object database a chunk at a
+            time and all the files are staged together at the end, so a
+            long list of files can be generated lazily without holding
+            them in memory.
+        '''
+        assert self._writeable and not (self._committed or self._pushed)
+
+        with TemporaryFile() as index_info:
+            for (filename, stream, size) in files:
+                blob = self.repo.odb.store(IStream('blob', size, stream))
+                index_info.write(u'100644 {}\t{}\0'.format(blob.hexsha, filename).encode('utf8'))
+
+            index_info.seek(0)
+            self._git_index('update_index', '-z', '--index-info', istream=index_info)
 
     def move(self, old_path, new_path):
         assert self._writeable and not (self._committed or self._pushed)
@@ -167,22 +224,51 @@ class UserTask():
             if not relpath(new_dirname, old_dirname).startswith('..'):
                 raise ValueError(u'I cannot move a directory inside itself!', u'warning')
 
-        dir_path = join(self.repo.working_dir, dirname(new_path))
+        old_path, new_path = old_path.rstrip('/'), new_path.rstrip('/')
+        entries = [(mode, sha, path) for (mode, sha, path) in self._list_index(old_path)
+                   if path == old_path or path.startswith(old_path + '/')]
 
-        if not exists(dir_path):
-            makedirs(dir_path)
+        if not entries:
+            raise ValueError(u'I cannot move something that doesn\'t exist!', u'warning')
 
-        self.repo.git.mv(old_path, new_path)
+        # Stage every file under the old path at the same place under the new one.
+        cacheinfos = []
+        for (mode, sha, path) in entries:
+            cacheinfos += ['--cacheinfo', u'{},{},{}'.format(mode, sha, new_path + path[len(old_path):])]
+
+        self._git_index('update_index', '--force-remove', *[path for (_, _, path) in entries])
+        self._git_index('update_index', '--add', *cacheinfos)
+
+    def delete(self, path):
+        assert self._writeable and not (self._committed or self._pushed)
+
+        # Unstage the file, or every file under the directory.
+        path = path.rstrip('/')
+        entries = [entry_path for (_, _, entry_path) in self._list_index(path)
+                   if entry_path == path or entry_path.startswith(path + '/')]
+
+        if not entries:
+            raise ValueError(u'I cannot delete something that doesn\'t exist!', u'warning')
+
+        self._git_index('update_index', '--force-remove', *entries)
+
+    def changed(self):
+        ''' True if anything's been written, moved, or deleted since start_point.
+        '''
+        return self._git_index('write_tree') != self.repo.commit(self.commit_sha).tree.hexsha
 
     def commit(self, message):
         assert self._writeable and not (self._committed or self._pushed)
         self._committed = True
 
-        # Commit to local zelig, push to origin task ID.
+        # Commit the private index on top of start_point; push to origin task ID.
         self._set_author_env()
-        dirty = self.repo.is_dirty()
+        tree_sha = self._git_index('write_tree')
+        dirty = self.changed()
         if dirty:
-            self.repo.git.commit(m=message, a=True)
+            self._local_sha = self.repo.git.commit_tree(tree_sha, p=self.commit_sha, m=message)
+        else:
+            self._local_sha = self.commit_sha
         return dirty
 
     def is_pushable(self):
@@ -230,12 +316,15 @@ class UserTask():
         task_sha = self._get_task_sha()
 
         # Rebase if necessary.
-        if task_sha != self.commit_sha:
+        if task_sha is not None and task_sha != self.commit_sha:
             self._rebase_with_author_check(task_sha)
 
         try:
             # Push to origin; we think this is safe to do.
-            self.repo.git.push('origin', 'zelig:{}'.format(self.task_id))
+            push_to_origin(self.repo, ['{}:refs/heads/{}'.format(self._local_sha, self.task_id)])
+
+            # Pushing a bare commit doesn't move the remote-tracking branch.
+            self.repo.git.update_ref('refs/remotes/origin/{}'.format(self.task_id), self._local_sha)
 
         except GitCommandError:
             # Push failed, possibly because origin has
@@ -284,7 +373,13 @@ class UserTask():
 
     def _get_task_sha(self):
         ''' Get local commit SHA for a given task ID.
+
+            Return None if the task isn't in origin yet, like a branch
+            claimed from the activity pool that hasn't been pushed to.
         '''
+        if 'origin/{}'.format(self.task_id) not in self.repo.refs:
+            return None
+
         branch = self.repo.refs['origin/{}'.format(self.task_id)]
         return branch.commit.hexsha
 
@@ -294,7 +389,12 @@ class UserTask():
             If no interlopers exist, use an aggressive merge strategy
             to clobber possible conflicts. If any interloper exists,
             use a more timid strategy and possibly raise a MergeConflict.
+
+            Rebasing needs a working tree, so the new commit is checked
+            out to local zelig first.
         '''
+        self.repo.git.checkout('-B', 'zelig', self._local_sha, force=True)
+
         if self._is_interloped(task_sha):
             try:
                 # Do a timid rebase since someone else has been here.
@@ -308,8 +408,13 @@ class UserTask():
             # Do an aggressive rebase since no one else has been here.
             self.repo.git.rebase(task_sha, X='theirs')
 
+        self._local_sha = self.repo.head.commit.hexsha
+
     def cleanup(self):
         # once we have locking, we will unlock here
+        if self._index_path and exists(self._index_path):
+            remove(self._index_path)
+        self._index_path = None
         self._unlock()
 
     def __del__(self):
@@ -0,0 +1,141 @@
+from os.path import join, isdir, realpath, islink, getsize, getmtime, exists
+from os import walk
+from shutil import rmtree
+from urllib import quote
+from time import time
+import json
+
+from slugify import slugify
+
+from ..repo_functions import ChimeRepo, ignore_task_metadata_on_merge
+from ..constants import WORKTREE_DIRECTORY_PATTERN, WORKTREE_INDEX_PATTERN
+
+# SHA of the first commit in each origin, keyed on its git directory.
+_root_hexshas = {}
+
+def _get_root_hexsha(origin):
+    ''' Return the SHA of the first commit in the passed repository.
+
+        The first commit never changes, so it's looked up once per origin
+        instead of walking the whole history on every request.
+    '''
+    if origin.git_dir not in _root_hexshas:
+        # listed in the same order as iter_commits(), so the last is the oldest
+        root_hexshas = origin.git.rev_list('HEAD', max_parents=0).split()
+        _root_hexshas[origin.git_dir] = root_hexshas[-1]
+
+    return _root_hexshas[origin.git_dir]
+
+def _calculate_dirnames(email, branch_name, origin):
+    ''' Prepare a consistent clone directory and index file name for this user,
+        this branch, and this repository.
+    '''
+    first_commit = _get_root_hexsha(origin)
+    clone_dirname = WORKTREE_DIRECTORY_PATTERN.format(sha=first_commit[:8], email=slugify(email), branch=slugify(branch_name))
+    index_filename = WORKTREE_INDEX_PATTERN.format(sha=first_commit[:8], email=slugify(email))
+    return quote(clone_dirname), quote(index_filename)
+
+def _measure(dirname):
+    ''' Return the number of bytes used by the files in the passed directory.
+    '''
+    total = 0
+    for (root, dirs, files) in walk(dirname):
+        for name in files:
+            path = join(root, name)
+            if not islink(path):
+                total += getsize(path)
+
+    return total
+
+def _refresh_size(entry):
+    ''' Measure the clone in the passed index entry again if it was written to since.
+
+        Saving in a clone always commits, which writes its git index, so
+        only clones with a newer git index than the measurement are walked.
+    '''
+    git_index_path = join(entry['path'], '.git', 'index')
+
+    if 'size' in entry and exists(git_index_path) and getmtime(git_index_path) < entry.get('measured', 0):
+        return entry
+
+    # note the time first, so writes during the walk are measured next time
+    entry['measured'] = time()
+    entry['size'] = _measure(entry['path'])
+    return entry
+
+def _load_index(index_path):
+    ''' Load the passed user's index of clones, keyed on branch name.
+    '''
+    if not exists(index_path):
+        return {}
+
+    with open(index_path) as file:
+        try:
+            return json.load(file)
+        except ValueError:
+            return {}
+
+def _save_index(index_path, index):
+    ''' Save the passed user's index of clones.
+    '''
+    with open(index_path, 'w') as file:
+        json.dump(index, file, indent=2)
+
+def evict_worktrees(index, disk_budget, keep=None):
+    ''' Remove least-recently-used clones in the index until they fit in disk_budget bytes.
+
+        Clones written to since they were last measured are measured again
+        first. The clone for the branch named in keep is never removed,
+        even if it's bigger than the whole budget on its own.
+    '''
+    total = sum([_refresh_size(entry)['size'] for entry in index.values()])
+
+    for branch_name in sorted(index, key=lambda name: index[name]['used']):
+        if total <= disk_budget:
+            break
+
+        if branch_name == keep:
+            continue
+
+        entry = index.pop(branch_name)
+        rmtree(entry['path'], ignore_errors=True)
+        total -= entry['size']
+
+    return index
+
+def get_worktree(email, branch_name, origin_dirname, working_dirname, disk_budget):
+    ''' Return a clone for the passed user to work in the passed branch.
+
+        Each (user, branch) pair gets its own clone, so once the branch is
+        checked out, moving between activities doesn't rewrite the working directory. When the user's
+        clones take up more than disk_budget bytes, the least-recently-used
+        ones are removed. The clones and their index aren't locked here;
+        hold the user's lock while calling this.
+    '''
+    origin = ChimeRepo(origin_dirname)
+    clone_dirname, index_filename = _calculate_dirnames(email, branch_name, origin)
+    clone_path = realpath(join(working_dirname, clone_dirname))
+    index_path = realpath(join(working_dirname, index_filename))
+    index = _load_index(index_path)
+
+    if isdir(clone_path):
+        clone = ChimeRepo(clone_path)
+        clone.git.reset(hard=True)
+        clone.remotes.origin.fetch()
+    else:
+        # the default branch gets checked out here, since so much expects a
+        # local copy of it; callers check out the activity's branch after
+        clone = origin.clone(clone_path)
+
+        # tell git to ignore merge conflicts on the task metadata file
+        ignore_task_metadata_on_merge(clone)
+        index.pop(branch_name, None)
+
+    entry = index.get(branch_name) or dict(path=clone_path)
+    entry['used'] = time()
+    index[branch_name] = entry
+
+    evict_worktrees(index, disk_budget, keep=branch_name)
+    _save_index(index_path, index)
+
+    return clone
@@ -1 +1,2 @@
 from .user_task import *
+from .worktree import *
@@ -1,7 +1,7 @@
 from subprocess import check_call
 from tempfile import mkdtemp
 from shutil import rmtree
-from os.path import join
+from os.path import join, exists
 from os import mkdir
 
 from git import Actor
@@ -116,6 +116,45 @@ class TestFirst(TestCase):
         with get_usertask(Frances, self.task_id, *self.get_usertask_args, start_point=self.task_id) as usertask:
             self.assertEqual(usertask.read('carholing/carholes/parking.md'), '---\nold stuff')
 
+    def testMoveDirectory(self):
+        with get_usertask(Erica, self.task_id, *self.get_usertask_args, start_point=self.task_id) as usertask:
+            usertask.move('parking.md', 'parking/index.md')
+            usertask.write('parking/lots.md', "---\nlots of stuff")
+            usertask.move('parking', 'carholing/parking')
+            usertask.commit('I moved some things')
+            usertask.push()
+        with get_usertask(Frances, self.task_id, *self.get_usertask_args, start_point=self.task_id) as usertask:
+            self.assertEqual(usertask.read('carholing/parking/index.md'), '---\nold stuff')
+            self.assertEqual(usertask.read('carholing/parking/lots.md'), '---\nlots of stuff')
+            with self.assertRaises(IOError):
+                usertask.read('parking.md')
+
+    def testDeleteDirectory(self):
+        with get_usertask(Erica, self.task_id, *self.get_usertask_args, start_point=self.task_id) as usertask:
+            usertask.write('parking/index.md', "---\nparking")
+            usertask.write('parking/lots.md', "---\nlots of stuff")
+            usertask.delete('parking')
+            usertask.delete('parking.md')
+            with self.assertRaises(ValueError):
+                usertask.delete('parking')
+            usertask.commit('I deleted some things')
+            usertask.push()
+        with get_usertask(Frances, self.task_id, *self.get_usertask_args, start_point=self.task_id) as usertask:
+            for path in ('parking.md', 'parking/index.md', 'parking/lots.md'):
+                with self.assertRaises(IOError):
+                    usertask.read(path)
+
+    def testLeavesWorkingTreeAlone(self):
+        with get_usertask(Erica, self.task_id, *self.get_usertask_args, start_point=self.task_id) as usertask:
+            working_dir = usertask.repo.working_dir
+            usertask.write('parking.md', "---\nnew stuff")
+            usertask.commit('I wrote new things')
+            usertask.push()
+
+            # nothing was checked out to save the change
+            self.assertFalse(exists(join(working_dir, 'parking.md')))
+            self.assertEqual(usertask.repo.git.show('origin/{}:parking.md'.format(self.task_id)), '---\nnew stuff')
+
     def testResubmitFileEdits(self):
         ''' Simulate a single user's preview, back-button, and re-save.
         '''
@@ -0,0 +1,114 @@
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join, exists
+from os import mkdir
+
+from ...storage.worktree import get_worktree, _measure
+from ...repo_functions import ChimeRepo
+from .user_task import call_git
+from unittest import TestCase
+from mock import patch
+
+
+class TestWorktree(TestCase):
+    def setUp(self):
+        self.working_dirname = mkdtemp(prefix='storage-test-')
+
+        # Make a mostly-empty repo with one master commit,
+        # and two branches called task-abc and task-xyz.
+
+        self.origin_dirname = join(self.working_dirname, 'origin')
+        clone_dirname = join(self.working_dirname, 'clone')
+
+        mkdir(self.origin_dirname)
+        call_git('--bare init', self.origin_dirname)
+
+        call_git(['clone', self.origin_dirname, clone_dirname])
+
+        call_git('commit -m First --allow-empty', clone_dirname)
+        call_git('push origin master', clone_dirname)
+
+        for task_id in ('task-abc', 'task-xyz'):
+            call_git('checkout -b {} master'.format(task_id), clone_dirname)
+
+            with open(join(clone_dirname, 'parking.md'), 'w') as file:
+                file.write('---\n{} stuff'.format(task_id))
+
+            call_git('add parking.md', clone_dirname)
+            call_git('commit -m Second', clone_dirname)
+            call_git('push origin {}'.format(task_id), clone_dirname)
+
+        rmtree(clone_dirname)
+
+    def tearDown(self):
+        rmtree(self.working_dirname)
+
+    def get_worktree(self, branch_name, disk_budget=1024 * 1024 * 1024):
+        clone = get_worktree('erica@example.com', branch_name, self.origin_dirname, self.working_dirname, disk_budget)
+        clone.git.checkout(branch_name)
+        return clone
+
+    def testKeepsBranchCheckedOut(self):
+        clone = self.get_worktree('task-abc')
+        clone = get_worktree('erica@example.com', 'task-abc', self.origin_dirname, self.working_dirname, 1024 * 1024 * 1024)
+        self.assertEqual(clone.active_branch.name, 'task-abc')
+        self.assertTrue('master' in clone.branches)
+
+        with open(join(clone.working_dir, 'parking.md')) as file:
+            self.assertEqual(file.read(), '---\ntask-abc stuff')
+
+    def testSeparateClonePerBranch(self):
+        clone_abc = self.get_worktree('task-abc')
+        clone_xyz = self.get_worktree('task-xyz')
+        self.assertNotEqual(clone_abc.working_dir, clone_xyz.working_dir)
+        self.assertEqual(clone_xyz.active_branch.name, 'task-xyz')
+
+    def testReusesClone(self):
+        clone = self.get_worktree('task-abc')
+
+        # an untracked file survives the reset, so it shows the clone was reused
+        marker_path = join(clone.working_dir, 'marker.txt')
+        open(marker_path, 'w').close()
+        self.get_worktree('task-xyz')
+
+        self.assertEqual(self.get_worktree('task-abc').working_dir, clone.working_dir)
+        self.assertTrue(exists(marker_path))
+
+    def testEvictsLeastRecentlyUsed(self):
+        clone_abc = self.get_worktree('task-abc', 1)
+        clone_xyz = self.get_worktree('task-xyz', 1)
+
+        # the clone in use is kept even though it's over budget
+        self.assertFalse(exists(clone_abc.working_dir))
+        self.assertTrue(exists(clone_xyz.working_dir))
+
+        # evicted clones come back when they're needed again
+        clone_abc = self.get_worktree('task-abc', 1)
+        self.assertEqual(clone_abc.active_branch.name, 'task-abc')
+        self.assertFalse(exists(clone_xyz.working_dir))
+
+    def testMeasuresWrittenClones(self):
+        clone_abc = self.get_worktree('task-abc')
+        disk_budget = _measure(clone_abc.working_dir) * 5 // 2
+
+        clone_abc = self.get_worktree('task-abc', disk_budget)
+        clone_xyz = self.get_worktree('task-xyz', disk_budget)
+
+        # a commit makes the clone bigger than the budget after it was measured
+        with open(join(clone_abc.working_dir, 'big.txt'), 'w') as file:
+            file.write('x' * disk_budget)
+
+        call_git('add big.txt', clone_abc.working_dir)
+        call_git('commit -m Big', clone_abc.working_dir)
+
+        clone_xyz = self.get_worktree('task-xyz', disk_budget)
+        self.assertFalse(exists(clone_abc.working_dir))
+        self.assertTrue(exists(clone_xyz.working_dir))
+
+    def testDoesntWalkHistory(self):
+        self.get_worktree('task-abc')
+
+        with patch.object(ChimeRepo, 'iter_commits', side_effect=AssertionError('Walked the history')):
+            clone = self.get_worktree('task-abc')
+
+        self.assertEqual(clone.active_branch.name, 'task-abc')
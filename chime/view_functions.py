@@ -5,17 +5,16 @@ from .simple_flock import SimpleFlock
 
 Logger = getLogger('chime.view_functions')
 
-from os.path import join, isdir, realpath, basename, exists, sep, split, splitext
+from os.path import join, isdir, realpath, basename, exists, sep, split, splitext, getsize
 from datetime import datetime
-from os import listdir, environ, walk
-from urllib import quote, unquote
+from os import listdir, environ
+from urllib import quote, unquote, urlencode
 from urlparse import urljoin, urlparse, urlunparse
 from mimetypes import guess_type
 from functools import wraps
 from io import BytesIO
+from collections import OrderedDict
 from slugify import slugify
-from tempfile import mkdtemp
-from subprocess import Popen
 from git.cmd import GitCommandError
 from git import Actor
 from glob import glob
@@ -27,24 +26,29 @@ import uuid
 
 from dateutil import parser, tz
 from dateutil.relativedelta import relativedelta
-from flask import request, session, current_app, redirect, flash, render_template, abort, Response
+from flask import request, session, current_app, redirect, flash, render_template, abort, Response, g, get_template_attribute
 
 from requests import get
 
 from .edit_functions import create_new_page, delete_file, update_page, upload_new_file
-from .jekyll_functions import load_jekyll_doc, load_languages, build_jekyll_site, dump_jekyll_doc
+from .jekyll_functions import load_jekyll_doc, load_languages, load_languages_from_config, build_jekyll_site, dump_jekyll_doc, JekyllBuildFailed
 from .google_api_functions import read_ga_config, fetch_google_analytics_for_page
 from .repo_functions import (
     get_existing_branch, get_branch_if_exists_locally, ignore_task_metadata_on_merge,
     ChimeRepo, get_task_metadata_for_branch, complete_branch, abandon_branch,
     clobber_default_branch, get_review_state_and_authorized, update_review_state,
     provide_feedback, move_existing_file, mark_upstream_push_needed, MergeConflict,
-    get_activity_working_state, make_branch_name, save_local_working_file,
+    get_activity_working_state, get_activity_working_state_from_refs, make_branch_name, save_local_working_file,
     sync_with_branch, strip_index_file, save_task_metadata_for_branch, make_commit_message,
-    get_start_branch, save_working_file
+    get_start_branch, save_working_file, get_conflicted_branch_names, push_to_origin,
+    branch_transaction, claim_pool_branch, fetch_pool_branch, release_pool_branch, remove_pool_branch,
+    get_pool_branch_names, dump_task_metadata, TASK_METADATA_FILENAME, ACTIVITY_CREATED_MESSAGE
 )
 from . import constants
-from .storage.user_task import UserTask, UserTaskPublished, UserTaskDeleted
+from .storage.user_task import UserTask, UserTaskPublished, UserTaskDeleted, get_usertask
+from .storage.worktree import get_worktree
+from .commit_tree import CommitTree, get_commit_tree
+from .publish_functions import queue_publish_job
 
 from .href import needs_redirect, get_redirect
 
@@ -53,6 +57,9 @@ from . import chime_activity
 # Maximum age of an authentication check in seconds.
 AUTH_CHECK_LIFESPAN = 300.0
 
+# Bytes read at a time when streaming a file in a response.
+FILE_CHUNK_SIZE = 64 * 1024
+
 # Name of default AUTH_DATA_HREF value
 AUTH_DATA_HREF_DEFAULT = 'data/authentication.csv'
 
@@ -80,6 +87,20 @@ FILE_FILTERS = [
 ]
 FILE_FILTERS_COMPILED = re.compile('(' + '|'.join(FILE_FILTERS) + ')')
 
+# How many directory listings to keep in the per-process listing cache
+DIRECTORY_LISTING_CACHE_SIZE = 512
+# directory listings keyed on (commit SHA, directory path, showallfiles)
+_directory_listing_cache = OrderedDict()
+# last-modified timestamps keyed on (commit SHA, file path)
+_modified_timestamp_cache = OrderedDict()
+
+# How many entries to keep in the per-process content index caches
+CONTENT_INDEX_CACHE_SIZE = 4096
+# front matter keyed on blob SHA
+_front_matter_cache = OrderedDict()
+# recursive directory descriptions keyed on tree SHA
+_directory_description_cache = OrderedDict()
+
 def dos2unix(string):
     ''' Returns a copy of the strings with line-endings corrected.
     '''
@@ -94,6 +115,10 @@ def get_repo(flask_app=None, repo_path=None, work_path=None, email=None):
     '''
     # If a flask_app is passed use it, otherwise use the passed params.
     if flask_app:
+        # use the activity's own clone if get_activity_repo() picked one for this request
+        if getattr(g, 'activity_repo', None) is not None:
+            return g.activity_repo
+
         repo_path = flask_app.config['REPO_PATH']
         work_path = flask_app.config['WORK_PATH']
 
@@ -118,6 +143,25 @@ def get_repo(flask_app=None, repo_path=None, work_path=None, email=None):
 
     return user_repo
 
+def get_activity_repo(flask_app, branch_name):
+    ''' Gets a repository for the current user to check the passed branch out in.
+
+        With a WORKTREE_DISK_BUDGET configured, each activity gets its own
+        clone, and get_repo() returns it for the rest of the request.
+        Otherwise, it's the user's one clone from get_repo().
+    '''
+    disk_budget = flask_app.config.get('WORKTREE_DISK_BUDGET')
+    if not disk_budget or not branch_name:
+        return get_repo(flask_app=flask_app)
+
+    g.activity_repo = get_worktree(
+        email=session.get('email', 'nobody'), branch_name=branch_name,
+        origin_dirname=flask_app.config['REPO_PATH'],
+        working_dirname=flask_app.config['WORK_PATH'], disk_budget=disk_budget
+    )
+
+    return g.activity_repo
+
 def name_branch(description):
     ''' Generate a name for a branch from a description.
 
@@ -206,13 +250,6 @@ def file_type_plural(file_type):
 
     return file_type
 
-# ONLY CALLED FROM sorted_paths()
-def is_display_editable(file_path):
-    ''' Returns True if the file at the passed path is either an editable file,
-        or a directory containing only an editable index file.
-    '''
-    return (is_editable(file_path) or is_article_dir(file_path))
-
 def is_article_dir(file_path):
     ''' Returns True if the file at the passed path is a directory containing only an index file with an article jekyll layout.
     '''
@@ -248,20 +285,66 @@ def is_editable(file_path, layout=None):
     return False
 
 def describe_directory_contents(clone, file_path):
-    ''' Return a description of the contents of the passed path
+    ''' Generate a description of each file in the passed path, from the top down.
+
+        Descriptions come from the content index for the checked-out commit,
+        so files that haven't changed since they were last described aren't
+        opened or parsed again.
     '''
     file_path = file_path.rstrip('/')
-    full_path = join(clone.working_dir, file_path)
-    described_files = []
-    for (dir_path, dir_names, file_names) in walk(full_path):
-        for check_name in file_names:
-            check_path = join(dir_path, check_name)
-            display_type, title = index_path_display_type_and_title(check_path)
-            short_path = re.sub('{}/'.format(clone.working_dir), '', check_path)
-            is_root = file_path == short_path or file_path == split(short_path)[0]
-            described_files.append({"display_type": display_type, "title": title, "file_path": short_path, "is_root": is_root})
-
-    return described_files
+    tree = CommitTree(clone, clone.commit())
+    if not tree.isdir(file_path):
+        return
+
+    for (sub_path, display_type, title) in get_directory_description(tree, file_path):
+        short_path = join(file_path, sub_path)
+        is_root = file_path == short_path or file_path == split(short_path)[0]
+        yield {"display_type": display_type, "title": title, "file_path": short_path, "is_root": is_root}
+
+def get_directory_description(tree, dir_path):
+    ''' Return (relative path, display type, title) for each file in the passed directory of a CommitTree.
+
+        Descriptions are cached on the directory's tree SHA; a directory's
+        description depends only on its contents, wherever it's found.
+    '''
+    cache_key = tree.tree_sha(dir_path)
+    if cache_key in _directory_description_cache:
+        description = _directory_description_cache.pop(cache_key)
+        _directory_description_cache[cache_key] = description
+        return description
+
+    description = make_directory_description(tree, dir_path)
+
+    _directory_description_cache[cache_key] = description
+    while len(_directory_description_cache) > CONTENT_INDEX_CACHE_SIZE:
+        _directory_description_cache.popitem(last=False)
+
+    return description
+
+def make_directory_description(tree, dir_path):
+    ''' Describe the files in the passed directory of a CommitTree, and then those in its subdirectories.
+    '''
+    index_filename = u'index.{}'.format(constants.CONTENT_FILE_EXTENSION)
+    description = []
+    subdir_names = []
+    for name in sorted(tree.listdir(dir_path)):
+        check_path = join(dir_path, name)
+        if tree.isdir(check_path):
+            subdir_names.append(name)
+            continue
+
+        if name == index_filename:
+            display_type, title = tree_index_path_display_type_and_title(tree, check_path)
+        else:
+            display_type, title = tree_path_type(tree, check_path), u''
+
+        description.append((name, display_type, title))
+
+    for dir_name in subdir_names:
+        for (sub_path, display_type, title) in get_directory_description(tree, join(dir_path, dir_name)):
+            description.append((join(dir_name, sub_path), display_type, title))
+
+    return description
 
 def get_front_matter(file_path):
     ''' Get the front matter for the file at the passed path if it exists.
@@ -305,6 +388,143 @@ def is_dir_with_layout(file_path, layout, only=True):
     # it's not a directory
     return False
 
+def tree_path_type(tree, file_path):
+    ''' Returns the type of file at the passed path in the passed CommitTree
+    '''
+    if tree.isdir(file_path):
+        return constants.FOLDER_FILE_TYPE
+
+    if str(guess_type(file_path)[0]).startswith('image/'):
+        return constants.IMAGE_FILE_TYPE
+
+    return constants.FILE_FILE_TYPE
+
+def tree_path_display_type(tree, file_path):
+    ''' Works like path_display_type, for a path in the passed CommitTree
+    '''
+    if tree_is_dir_with_layout(tree, file_path, constants.ARTICLE_LAYOUT, True):
+        return constants.ARTICLE_LAYOUT
+
+    if tree_is_dir_with_layout(tree, file_path, constants.CATEGORY_LAYOUT, False):
+        return constants.CATEGORY_LAYOUT
+
+    return tree_path_type(tree, file_path)
+
+def tree_index_path_display_type_and_title(tree, file_path):
+    ''' Works like index_path_display_type_and_title, for a path in the passed CommitTree
+    '''
+    index_filename = u'index.{}'.format(constants.CONTENT_FILE_EXTENSION)
+    path_split = split(file_path)
+    if path_split[1] == index_filename:
+        folder_type = tree_path_display_type(tree, path_split[0])
+        # if the enclosing folder is just a folder (and not an article or category)
+        # return the type of the index file instead
+        if folder_type == constants.FOLDER_FILE_TYPE:
+            return constants.FILE_FILE_TYPE, u''
+
+        # the enclosing folder is an article or category
+        return folder_type, tree_get_value_from_front_matter(tree, 'title', file_path)
+
+    # the path was to something other than an index file
+    path_type = tree_path_display_type(tree, file_path)
+    if path_type in (constants.ARTICLE_LAYOUT, constants.CATEGORY_LAYOUT):
+        return path_type, tree_get_value_from_front_matter(tree, 'title', join(file_path, index_filename))
+
+    return path_type, u''
+
+# ONLY CALLED FROM make_directory_listing()
+def tree_is_display_editable(tree, file_path):
+    ''' Returns True if the file at the passed path in the passed CommitTree is either
+        an editable file, or a directory containing only an editable index file.
+    '''
+    return (tree_is_editable(tree, file_path) or tree_is_article_dir(tree, file_path))
+
+def tree_is_article_dir(tree, file_path):
+    ''' Works like is_article_dir, for a path in the passed CommitTree
+    '''
+    return tree_is_dir_with_layout(tree, file_path, constants.ARTICLE_LAYOUT, True)
+
+def tree_is_editable(tree, file_path, layout=None):
+    ''' Works like is_editable, for a path in the passed CommitTree
+    '''
+    try:
+        # directories aren't editable
+        if not tree.isfile(file_path):
+            return False
+
+        # files with the passed layout are editable
+        if layout:
+            front_matter = tree_get_front_matter(tree, file_path)
+            return ('layout' in front_matter and front_matter['layout'] == layout)
+
+        # if no layout was passed, files with front matter are editable
+        if tree.read(file_path)[:4].startswith('---'):
+            return True
+
+    except:
+        pass
+
+    return False
+
+def tree_get_front_matter(tree, file_path):
+    ''' Get the front matter for the file at the passed path in the passed CommitTree if it exists.
+
+        Front matter is cached on the blob SHA, so each version of a file is only parsed once.
+    '''
+    blob_sha = tree.blob_sha(file_path)
+    if not blob_sha:
+        return None
+
+    if blob_sha in _front_matter_cache:
+        front_matter = _front_matter_cache.pop(blob_sha)
+    else:
+        front_matter, _ = load_jekyll_doc(tree.open(file_path))
+
+    _front_matter_cache[blob_sha] = front_matter
+    while len(_front_matter_cache) > CONTENT_INDEX_CACHE_SIZE:
+        _front_matter_cache.popitem(last=False)
+
+    # callers may change what they get back
+    return dict(front_matter) if type(front_matter) is dict else front_matter
+
+def tree_get_value_from_front_matter(tree, key, file_path):
+    ''' Get the value for the passed key in the front matter, for a path in the passed CommitTree
+    '''
+    try:
+        return tree_get_front_matter(tree, file_path)[key]
+    except:
+        return None
+
+def tree_load_languages(tree):
+    ''' Works like load_languages, for the site configuration in the passed CommitTree
+    '''
+    if not tree.isfile(u'_config.yml'):
+        return load_languages_from_config(None)
+
+    return load_languages_from_config(tree.open(u'_config.yml'))
+
+def tree_is_dir_with_layout(tree, file_path, layout, only=True):
+    ''' Works like is_dir_with_layout, for a path in the passed CommitTree
+    '''
+    if tree.isdir(file_path):
+        # it's a directory
+        index_path = join(file_path or u'', u'index.{}'.format(constants.CONTENT_FILE_EXTENSION))
+        if not tree_is_editable(tree, index_path, layout):
+            # there's no index file in the directory or it's not editable
+            return False
+
+        if not only:
+            # it doesn't matter how many files are in the directory
+            return True
+
+        visible_file_count = len([name for name in tree.listdir(file_path) if not FILE_FILTERS_COMPILED.search(name)])
+        if visible_file_count == 0:
+            # there's only an index file in the directory
+            return True
+
+    # it's not a directory
+    return False
+
 def get_solo_directory_name(repo, branch_name, path):
     ''' If, in the passed directory, there is a non-article or -category directory
         that's the only visible object in the hierarchy, return its name.
@@ -606,7 +826,7 @@ def synch_required(route_function):
             # Attempt to push to origin in all cases.
             if branch_name:
                 if working_state == constants.WORKING_STATE_ACTIVE:
-                    repo.git.push('origin', branch_name)
+                    push_to_origin(repo, [branch_name])
 
                     # Push upstream only if the request method indicates a change.
                     mark_upstream_push_needed(current_app.config['RUNNING_STATE_DIR'])
@@ -622,9 +842,9 @@ def synched_checkout_required(route_function):
     '''
     @wraps(route_function)
     def decorated_function(*args, **kwargs):
-        repo = get_repo(flask_app=current_app)
         branch_name, master_name = \
             guess_branch_names_in_decorator(kwargs, current_app.config, request.form)
+        repo = get_activity_repo(current_app, branch_name)
 
         # fetch
         repo.git.fetch('origin')
@@ -663,6 +883,42 @@ def synched_checkout_required(route_function):
 
     return decorated_function
 
+def synched_read_required(route_function):
+    ''' Decorator for read-only routes that show the contents of a branch.
+
+        Fetches from upstream origin before, but doesn't check anything out;
+        use get_commit_tree() to read files. Use below @login_required.
+    '''
+    @wraps(route_function)
+    def decorated_function(*args, **kwargs):
+        repo = get_repo(flask_app=current_app)
+        branch_name, master_name = \
+            guess_branch_names_in_decorator(kwargs, current_app.config, request.form)
+
+        # fetch, forgetting branches that were deleted at origin
+        repo.git.fetch('origin', prune=True)
+
+        # are we in a remotely published or deleted activity?
+        working_state = get_activity_working_state_from_refs(repo, master_name, branch_name)
+        local_branch = get_branch_if_exists_locally(repo, master_name, branch_name)
+        if working_state == constants.WORKING_STATE_PUBLISHED:
+            tag_ref = repo.tag('refs/tags/{}'.format(branch_name))
+            commit = tag_ref.commit
+            published_date = repo.git.show('--format=%ar', commit.hexsha).strip()
+            published_by = commit.committer.email
+            flash_only(MESSAGE_ACTIVITY_PUBLISHED.format(published_date=published_date, published_by=published_by), u'warning')
+
+        elif working_state == constants.WORKING_STATE_DELETED:
+            flash_only(MESSAGE_ACTIVITY_DELETED, u'warning')
+
+            # if the deleted branch doesn't exist locally, raise a 404
+            if not local_branch:
+                abort(404)
+
+        return route_function(*args, **kwargs)
+
+    return decorated_function
+
 def flash_unique(message, category):
     ''' Add the passed message to flash messages if it's not an exact dupe of
         an existing message.
@@ -689,7 +945,22 @@ def flash_only(message, category, by_category=False):
 def get_relative_date(repo, file_path):
     ''' Return the relative modified date for the passed path in the passed repo
     '''
-    return repo.git.log('-1', '--format=%ar', '--', file_path)
+    return format_relative_timestamp(get_modified_timestamp(repo, file_path))
+
+def get_modified_timestamp(repo, file_path):
+    ''' Return the epoch seconds of the last commit to touch the passed path, or None
+    '''
+    timestamp = repo.git.log('-1', '--format=%at', '--', file_path).strip()
+    return int(timestamp) if timestamp else None
+
+def format_relative_timestamp(timestamp):
+    ''' Return a natural-language relative date for the passed epoch seconds
+    '''
+    if timestamp is None:
+        return u''
+
+    now_utc = datetime.utcnow().replace(tzinfo=tz.tzutc())
+    return get_relative_date_string(datetime.fromtimestamp(timestamp, tz.tzutc()), now_utc)
 
 def make_ordinal_number(number_in):
     ''' Turn the passed number into an ordinal string representation
@@ -715,39 +986,40 @@ def make_new_activity_description():
 def make_delete_display_commit_message(repo, working_branch_name, request_path):
     ''' Build a commit message about file deletion for display in the activity history
     '''
-    # construct the commit message
-    targeted_files = describe_directory_contents(repo, request_path)
+    # construct the commit message and its list of actions in one pass
     message_details = {}
     root_file = {}
-    for file_details in targeted_files:
+    targeted_count = 0
+    action_descriptions = []
+    for file_details in describe_directory_contents(repo, request_path):
+        targeted_count += 1
         # don't include the root file in the count
-        if file_details['is_root']:
+        if file_details.pop('is_root'):
             root_file = file_details
         else:
             display_type = file_details['display_type']
             if display_type not in message_details:
                 message_details[display_type] = {}
                 message_details[display_type]['noun'] = file_display_name(display_type)
-                message_details[display_type]['files'] = []
+                message_details[display_type]['count'] = 0
             else:
                 message_details[display_type]['noun'] = file_type_plural(display_type)
-            message_details[display_type]['files'].append(file_details)
+            message_details[display_type]['count'] += 1
+
+        file_details['action'] = u'delete'
+        action_descriptions.append(file_details)
+
     commit_message = u'The "{}" {}'.format(root_file['title'], file_display_name(root_file['display_type']))
-    if len(targeted_files) > 1:
+    if targeted_count > 1:
         message_counts = []
         for detail_key in message_details:
             detail = message_details[detail_key]
-            message_counts.append(u'{} {}'.format(len(detail['files']), detail['noun']))
+            message_counts.append(u'{} {}'.format(detail['count'], detail['noun']))
         commit_message = commit_message + u' (containing {})'.format(u', '.join(message_counts[:-2] + [u' and '.join(message_counts[-2:])]))
 
     commit_message = commit_message + u' was deleted'
 
-    # alter targeted_files and dump it to the message body as json
-    action_descriptions = []
-    for file_description in targeted_files:
-        del file_description['is_root']
-        file_description['action'] = u'delete'
-        action_descriptions.append(file_description)
+    # dump the actions to the message body as json
     branch_name = working_branch_name if working_branch_name else repo.active_branch.name
     message_body = dict(branch_name=branch_name, actions=action_descriptions)
 
@@ -778,41 +1050,127 @@ def make_list_of_published_activities(repo, limit=10):
 
     return published
 
-def sorted_paths(repo, branch_name, path=None, showallfiles=False):
+def sorted_paths(repo, branch_name, path=None, showallfiles=False, sort_by=None, offset=0, limit=None):
     ''' Returns a list of files and their attributes in the passed directory.
+
+        Reads from the tip of the passed branch, not the working directory.
+        Files are sorted by name unless sort_by is SORT_BY_TITLE or
+        SORT_BY_MODIFIED; pass offset and limit to get just one page.
     '''
-    full_path = join(repo.working_dir, path or '.').rstrip('/')
-    all_sorted_files_dirs = sorted(listdir(full_path))
+    path_details, _ = get_directory_page(repo, branch_name, path, showallfiles, sort_by, offset, limit)
+    return path_details
 
-    file_names = [filename for filename in all_sorted_files_dirs if not FILE_FILTERS_COMPILED.search(filename)]
-    if showallfiles:
-        file_names = all_sorted_files_dirs
+def get_directory_page(repo, branch_name, path=None, showallfiles=False, sort_by=None, offset=0, limit=None, include_name=None):
+    ''' Return a page of the files in the passed directory, and the number of files in the directory.
 
-    view_paths = [join('/tree/{}/view'.format(branch_name2path(branch_name)), join(path or '', fn)) for fn in file_names]
-    full_paths = [join(full_path, name) for name in file_names]
-    path_pairs = zip(full_paths, view_paths)
+        Only the files on the page are dated, unless they're sorted by date.
+        If there's a file named include_name after the page, the page is
+        stretched to reach it.
+    '''
+    tree = get_commit_tree(repo, branch_name)
+    view_base = '/tree/{}/view'.format(branch_name2path(branch_name))
+    listing = sort_directory_listing(tree, path, get_directory_listing(tree, path, showallfiles), sort_by)
+
+    end = len(listing) if limit is None else offset + limit
+    if include_name is not None:
+        names = [item['name'] for item in listing]
+        if include_name in names[end:]:
+            end = names.index(include_name) + 1
+
+    page = listing[offset:end]
+    timestamps = get_modified_timestamps(tree, path, [item['name'] for item in page])
 
     # name, title, view_path, display_type, is_editable, modified_date
     path_details = []
-    for (edit_path, view_path) in path_pairs:
-        if realpath(edit_path) != repo.git_dir:
-            info = {}
-            info['name'] = basename(edit_path)
-            info['display_type'] = path_display_type(edit_path)
-            info['link_name'] = u'{}/'.format(info['name']) if info['display_type'] in (constants.FOLDER_FILE_TYPE, constants.CATEGORY_LAYOUT, constants.ARTICLE_LAYOUT) else info['name']
-            file_title = get_value_from_front_matter('title', join(edit_path, u'index.{}'.format(constants.CONTENT_FILE_EXTENSION)))
-            if not file_title:
-                if info['display_type'] in (constants.FOLDER_FILE_TYPE, constants.IMAGE_FILE_TYPE, constants.FILE_FILE_TYPE):
-                    file_title = info['name']
-                else:
-                    file_title = re.sub('-', ' ', info['name']).title()
-            info['title'] = file_title
-            info['view_path'] = view_path
-            info['is_editable'] = is_display_editable(edit_path)
-            info['modified_date'] = get_relative_date(repo, edit_path)
-            path_details.append(info)
+    for item in page:
+        info = dict(item)
+        info['view_path'] = join(view_base, join(path or '', info['name']))
+        info['modified_date'] = format_relative_timestamp(timestamps[info['name']])
+        path_details.append(info)
 
-    return path_details
+    return path_details, len(listing)
+
+def sort_directory_listing(tree, path, listing, sort_by=None):
+    ''' Sort a directory listing by title, or by last-modified date with the newest first.
+    '''
+    if sort_by == constants.SORT_BY_TITLE:
+        return sorted(listing, key=lambda k: k['title'])
+
+    if sort_by == constants.SORT_BY_MODIFIED:
+        timestamps = get_modified_timestamps(tree, path, [item['name'] for item in listing])
+        return sorted(listing, key=lambda k: timestamps[k['name']], reverse=True)
+
+    return listing
+
+def get_modified_timestamps(tree, path, names):
+    ''' Return a dict of the epoch seconds each passed name in the passed directory was last modified.
+
+        Timestamps are cached on the tree's commit SHA, and any that aren't
+        cached are read from a single log of the directory.
+    '''
+    timestamps = {}
+    for name in names:
+        cache_key = tree.hexsha, join(path or u'', name)
+        if cache_key in _modified_timestamp_cache:
+            timestamps[name] = _modified_timestamp_cache[cache_key]
+
+    missing_names = [name for name in names if name not in timestamps]
+    for (name, timestamp) in tree.modified_timestamps(path, missing_names).items():
+        _modified_timestamp_cache[(tree.hexsha, join(path or u'', name))] = timestamp
+        timestamps[name] = timestamp
+
+    while len(_modified_timestamp_cache) > CONTENT_INDEX_CACHE_SIZE:
+        _modified_timestamp_cache.popitem(last=False)
+
+    return timestamps
+
+def get_directory_listing(tree, path=None, showallfiles=False):
+    ''' Return the branch-independent details of the files in the passed directory.
+
+        Listings are cached on the tree's commit SHA, so a directory
+        that's already been classified at this commit isn't listed again.
+    '''
+    cache_key = tree.hexsha, (path or u'').strip('/'), showallfiles
+    if cache_key in _directory_listing_cache:
+        listing = _directory_listing_cache.pop(cache_key)
+        _directory_listing_cache[cache_key] = listing
+        return listing
+
+    listing = make_directory_listing(tree, path, showallfiles)
+
+    _directory_listing_cache[cache_key] = listing
+    while len(_directory_listing_cache) > DIRECTORY_LISTING_CACHE_SIZE:
+        _directory_listing_cache.popitem(last=False)
+
+    return listing
+
+def make_directory_listing(tree, path=None, showallfiles=False):
+    ''' List and classify the files in the passed directory of a CommitTree.
+    '''
+    all_sorted_files_dirs = sorted(tree.listdir(path))
+
+    file_names = [filename for filename in all_sorted_files_dirs if not FILE_FILTERS_COMPILED.search(filename)]
+    if showallfiles:
+        file_names = all_sorted_files_dirs
+
+    # name, title, display_type, link_name, is_editable
+    listing = []
+    for edit_path in [join(path or u'', name) for name in file_names]:
+        info = {}
+        info['name'] = basename(edit_path)
+        info['display_type'] = tree_path_display_type(tree, edit_path)
+        info['link_name'] = u'{}/'.format(info['name']) if info['display_type'] in (constants.FOLDER_FILE_TYPE, constants.CATEGORY_LAYOUT, constants.ARTICLE_LAYOUT) else info['name']
+        file_title = tree_get_value_from_front_matter(tree, 'title', join(edit_path, u'index.{}'.format(constants.CONTENT_FILE_EXTENSION)))
+        if not file_title:
+            if info['display_type'] in (constants.FOLDER_FILE_TYPE, constants.IMAGE_FILE_TYPE, constants.FILE_FILE_TYPE):
+                file_title = info['name']
+            else:
+                file_title = re.sub('-', ' ', info['name']).title()
+        info['title'] = file_title
+        info['is_editable'] = tree_is_display_editable(tree, edit_path)
+        listing.append(info)
+
+    return listing
 
 def make_breadcrumb_paths(branch_name, path=None):
     ''' Get a list of tuples (directory name, edit path) for the passed path
@@ -838,7 +1196,7 @@ def make_edit_path(branch, path, dir_name):
     base_path = path[:dir_index] + dir_name + '/'
     return join('/tree/{}/edit'.format(branch_name2path(branch)), base_path)
 
-def make_directory_columns(clone, branch_name, repo_path=None, edit_base_url=None, showallfiles=False):
+def make_directory_columns(clone, branch_name, repo_path=None, edit_base_url=None, showallfiles=False, sort_by=constants.SORT_BY_TITLE, limit=constants.DIRECTORY_PAGE_SIZE):
     ''' Get a list of lists of dicts for the passed path, with file listings for each level.
         example: passing repo_path='hello/world/wide' will return something like:
             [
@@ -857,6 +1215,10 @@ def make_directory_columns(clone, branch_name, repo_path=None, edit_base_url=Non
                     ]
                 }
             ]
+
+        Each listing is sorted by sort_by and cut short after limit files, unless
+        the selected file comes later; it also has the 'total' number of files
+        in the directory, and a 'more_path' to load the rest from as JSON.
     '''
     # Build a full directory path.
     repo_path = repo_path or u''
@@ -867,7 +1229,6 @@ def make_directory_columns(clone, branch_name, repo_path=None, edit_base_url=Non
     # Create the listings
     # We may've been passed alternate edit and modify URLs
     edit_path_root = u'/tree/{}/edit'.format(branch_name) if not edit_base_url else edit_base_url.rstrip('/')
-    index_filename = u'index.{}'.format(constants.CONTENT_FILE_EXTENSION)
     dir_listings = []
     for i in range(len(dirs)):
         last = False
@@ -878,38 +1239,31 @@ def make_directory_columns(clone, branch_name, repo_path=None, edit_base_url=Non
             last = True
 
         base_path = sep.join(dirs[1:i + 1])
-        current_edit_path = join(edit_path_root, base_path)
-        files = sorted_paths(clone, branch_name, base_path, showallfiles)
-        # name, title, base_path, file_path, edit_path, view_path, display_type, is_editable, modified_date, selected
-        listing = [{'name': item['name'], 'title': item['title'], 'base_path': base_path, 'file_path': join(base_path, item['link_name']), 'edit_path': join(current_edit_path, item['link_name']), 'modify_path': join(current_edit_path, item['link_name'], index_filename), 'view_path': item['view_path'], 'display_type': item['display_type'], 'is_editable': item['is_editable'], 'modified_date': item['modified_date'], 'selected': (current_dir == item['name'] and not last)} for item in files]
-        # explicitly sort the list alphabetically by title
-        listing.sort(key=lambda k: k['title'])
-        dir_listings.append({'base_path': base_path, 'files': listing})
+        selected_name = current_dir if not last else None
+        dir_listings.append(make_directory_column(clone, branch_name, base_path, edit_path_root, showallfiles, sort_by, 0, limit, selected_name))
 
     return dir_listings
 
-def publish_commit(repo, publish_path):
-    ''' Publish current commit from the given repo to the publish_path directory.
+def make_directory_column(clone, branch_name, base_path, edit_path_root, showallfiles=False, sort_by=constants.SORT_BY_TITLE, offset=0, limit=None, selected_name=None):
+    ''' Get a dict with a page of the file listing for one directory, for make_directory_columns()
+        or for loading more of a long listing later.
     '''
-    try:
-        checkout_dir = mkdtemp(prefix='built-site-')
-
-        # http://stackoverflow.com/questions/4479960/git-checkout-to-a-specific-folder
-        environ['GIT_WORK_TREE'], old_GWT = checkout_dir, environ.get('GIT_WORK_TREE')
-        repo.git.checkout(repo.commit().hexsha, '.')
-
-        built_dir = build_jekyll_site(checkout_dir)
-
-        call = 'rsync -ur --delete {built_dir}/ {publish_path}/'.format(**locals())
-        rsync = Popen(call.split())
-        rsync.wait()
-    
-    finally:
-        # Clean up GIT_WORK_TREE so we don't pollute the environment.
-        if old_GWT:
-            environ['GIT_WORK_TREE'] = old_GWT
-        else:
-            del environ['GIT_WORK_TREE']
+    index_filename = u'index.{}'.format(constants.CONTENT_FILE_EXTENSION)
+    current_edit_path = join(edit_path_root, base_path)
+    files, total = get_directory_page(clone, branch_name, base_path, showallfiles, sort_by, offset, limit, selected_name)
+    # name, title, base_path, file_path, edit_path, view_path, display_type, is_editable, modified_date, selected
+    listing = [{'name': item['name'], 'title': item['title'], 'base_path': base_path, 'file_path': join(base_path, item['link_name']), 'edit_path': join(current_edit_path, item['link_name']), 'modify_path': join(current_edit_path, item['link_name'], index_filename), 'view_path': item['view_path'], 'display_type': item['display_type'], 'is_editable': item['is_editable'], 'modified_date': item['modified_date'], 'selected': (selected_name == item['name'])} for item in files]
+
+    # where to get the next page, if there is one
+    next_offset = offset + len(listing)
+    more_path = None
+    if next_offset < total:
+        more_args = [('offset', next_offset), ('sort', sort_by or u'')]
+        if showallfiles:
+            more_args.append(('showallfiles', u'true'))
+        more_path = u'/tree/{}/listing/{}?{}'.format(branch_name2path(branch_name), quote(base_path.encode('utf-8')), urlencode(more_args))
+
+    return {'base_path': base_path, 'files': listing, 'total': total, 'more_path': more_path}
 
 def start_activity_for_edits(repo, default_branch_name):
     ''' Start a new activity for edits
@@ -920,6 +1274,56 @@ def start_activity_for_edits(repo, default_branch_name):
     branch_name = branch_name2path(new_branch.name)
     return branch_name
 
+def claim_activity_for_edits(repo, default_branch_name, checkout=True):
+    ''' Claim a branch from the activity pool to save edits from the live site in.
+
+        Return the branch name, the commit it starts from, and its new task
+        metadata, or Nones if the pool is empty. With checkout, the branch
+        is checked out with the task metadata committed locally, so the
+        first save pushes both; without, the caller saves the task metadata
+        with its first change. Nothing is pushed here.
+    '''
+    branch_name, hexsha = claim_pool_branch(current_app.config['RUNNING_STATE_DIR'])
+    if not branch_name:
+        return None, None, None
+
+    task_metadata = dict(author_email=session['email'], task_description=make_new_activity_description(), branch_name=branch_name)
+
+    if checkout:
+        fetch_pool_branch(repo, branch_name)
+        repo.create_head(branch_name, commit=hexsha, force=True).checkout()
+
+        with open(join(repo.working_dir, TASK_METADATA_FILENAME), 'w') as file:
+            dump_task_metadata(task_metadata, file)
+
+        message = make_commit_message(subject=u'The "{}" {}'.format(task_metadata['task_description'], ACTIVITY_CREATED_MESSAGE), body=json.dumps(task_metadata, ensure_ascii=False))
+        save_local_working_file(repo, TASK_METADATA_FILENAME, message)
+
+    return branch_name, hexsha, task_metadata
+
+def finish_activity_for_edits(repo, default_branch_name, working_branch_name, pooled, did_save):
+    ''' Keep, give back, or abandon the branch that edits from the live site were saved in.
+
+        A pooled branch that wasn't saved to goes back to the activity pool
+        without a push; one that was is an activity now.
+    '''
+    running_state_dir = current_app.config['RUNNING_STATE_DIR']
+
+    if did_save:
+        if pooled:
+            remove_pool_branch(running_state_dir, working_branch_name)
+        return
+
+    if not pooled:
+        abandon_branch(repo, default_branch_name, working_branch_name)
+        return
+
+    if working_branch_name in repo.branches:
+        repo.branches[default_branch_name].checkout(force=True)
+        repo.git.branch('-D', working_branch_name)
+
+    release_pool_branch(repo, running_state_dir, working_branch_name)
+
 def delete_activity_for_edits(repo, default_branch_name, working_branch_name, working_state):
     ''' Delete an activity that was started for edits
     '''
@@ -964,21 +1368,27 @@ def update_activity_review_state(repo, working_branch_name, default_branch_name,
             except MergeConflict as conflict:
                 raise conflict
         else:
-            # comment if comment text was sent
-            if comment_text:
-                provide_feedback(clone=repo, working_branch_name=working_branch_name, comment_text=comment_text, push=True)
-
-            # rename if a new task description was sent
-            if task_description:
-                save_commit = save_task_metadata_for_branch(repo, default_branch_name, {'task_description': task_description})
-                if save_commit:
-                    flash(u'Changed activity name to "{}"!'.format(task_description), u'notice')
-
-            # handle a request feedback or endorse edits action
-            if action == 'request_feedback':
-                update_review_state(clone=repo, working_branch_name=working_branch_name, new_review_state=current_app.config['REVIEW_STATE_FEEDBACK'], push=True)
-            elif action == 'endorse_edits':
-                update_review_state(clone=repo, working_branch_name=working_branch_name, new_review_state=current_app.config['REVIEW_STATE_ENDORSED'], push=True)
+            save_commit = None
+
+            # sync and push once for the comment, rename, and review state together
+            with branch_transaction(repo):
+                # comment if comment text was sent
+                if comment_text:
+                    provide_feedback(clone=repo, working_branch_name=working_branch_name, comment_text=comment_text, push=True)
+
+                # rename if a new task description was sent
+                if task_description:
+                    save_commit = save_task_metadata_for_branch(repo, default_branch_name, {'task_description': task_description})
+
+                # handle a request feedback or endorse edits action
+                if action == 'request_feedback':
+                    update_review_state(clone=repo, working_branch_name=working_branch_name, new_review_state=current_app.config['REVIEW_STATE_FEEDBACK'], push=True)
+                elif action == 'endorse_edits':
+                    update_review_state(clone=repo, working_branch_name=working_branch_name, new_review_state=current_app.config['REVIEW_STATE_ENDORSED'], push=True)
+
+            # the rename is only saved once the transaction has pushed it
+            if save_commit:
+                flash(u'Changed activity name to "{}"!'.format(task_description), u'notice')
 
             return_redirect = redirect(redirect_path, code=303)
     else:
@@ -1024,8 +1434,10 @@ def publish_or_destroy_activity(branch_name, action, comment_text=None):
         else:
             raise Exception(u'Tried to {} an activity, and I don\'t know how to do that.'.format(action))
 
+        # the site is built and published in the background by chime.worker
         if current_app.config['PUBLISH_PATH']:
-            publish_commit(repo, current_app.config['PUBLISH_PATH'])
+            queue_publish_job(current_app.config['RUNNING_STATE_DIR'], repo.commit().hexsha,
+                              current_app.config['PUBLISH_PATH'], branch_name)
 
     except MergeConflict as conflict:
         raise conflict
@@ -1046,9 +1458,11 @@ def render_activities_list(task_description=None, show_new_activity_modal=False)
     '''
     repo = ChimeRepo(current_app.config['REPO_PATH'])
     master_name = current_app.config['default_branch']
-    branch_names = [b.name for b in repo.branches if b.name != master_name]
+    pool_branch_names = get_pool_branch_names(current_app.config['RUNNING_STATE_DIR'])
+    branch_names = [b.name for b in repo.branches if b.name != master_name and b.name not in pool_branch_names]
 
     activities = dict(in_progress=[], feedback=[], endorsed=[], published=[])
+    listed_branch_names = []
 
     for branch_name in branch_names:
         safe_branch = branch_name2path(branch_name)
@@ -1059,6 +1473,8 @@ def render_activities_list(task_description=None, show_new_activity_modal=False)
             # Skip this branch if it looks to be an orphan. Just don't show it.
             continue
 
+        listed_branch_names.append(branch_name)
+
         activity = chime_activity.ChimeActivity(repo=repo, branch_name=safe_branch, default_branch_name=current_app.config['default_branch'], actor_email=session.get('email', None))
         if activity.review_state == constants.REVIEW_STATE_FRESH or activity.review_state == constants.REVIEW_STATE_EDITED:
             activities['in_progress'].append(activity)
@@ -1073,8 +1489,12 @@ def render_activities_list(task_description=None, show_new_activity_modal=False)
 
     activities['published'] = make_list_of_published_activities(repo=repo, limit=10)
 
+    # flag the activities that can't be published without resolving a conflict
+    conflicted_branch_names = get_conflicted_branch_names(repo, master_name, current_app.config['RUNNING_STATE_DIR'], listed_branch_names)
+    conflicted_branches = set([branch_name2path(branch_name) for branch_name in conflicted_branch_names])
+
     kwargs = common_template_args(current_app.config, session)
-    kwargs.update(activities=activities, show_new_activity_modal=show_new_activity_modal)
+    kwargs.update(activities=activities, conflicted_branches=conflicted_branches, show_new_activity_modal=show_new_activity_modal)
 
     # pre-populate the new activity form with description value if it was passed
     if task_description:
@@ -1087,6 +1507,7 @@ def common_article_list_args(repo, branch_name, path, edit_base_url=None):
     '''
     # NOTE: temporarily turning off filtering if 'showallfiles=true' is in the request
     showallfiles = request.args.get('showallfiles') == u'true'
+    sort_by = get_listing_sort_by(request.args)
 
     activity = chime_activity.ChimeActivity(repo=repo, branch_name=branch_name, default_branch_name=current_app.config['default_branch'], actor_email=session.get('email', None))
 
@@ -1094,14 +1515,54 @@ def common_article_list_args(repo, branch_name, path, edit_base_url=None):
 
     dir_columns = make_directory_columns(
         clone=repo, branch_name=branch_name, repo_path=path, edit_base_url=edit_base_url,
-        showallfiles=showallfiles
+        showallfiles=showallfiles, sort_by=sort_by
     )
-    kwargs.update(safe_branch=branch_name2path(branch_name),
+    kwargs.update(safe_branch=branch_name2path(branch_name), sort_by=sort_by,
                   breadcrumb_paths=make_breadcrumb_paths(branch_name, path),
                   dir_columns=dir_columns, activity=activity)
 
     return kwargs
 
+def get_listing_sort_by(args):
+    ''' Return the directory listing sort order asked for in the passed request args.
+    '''
+    if args.get('sort') == constants.SORT_BY_MODIFIED:
+        return constants.SORT_BY_MODIFIED
+
+    return constants.SORT_BY_TITLE
+
+def render_directory_page(repo, branch_name, path):
+    ''' Return a JSON response with a page of the files in the passed directory.
+
+        The files are rendered with the same markup as articles-list.html, so
+        they can be added to the end of a listing that's already on the page.
+    '''
+    tree = get_commit_tree(repo, branch_name)
+    path = (path or u'').strip('/')
+    if not tree or not tree.isdir(path):
+        abort(404)
+
+    showallfiles = request.args.get('showallfiles') == u'true'
+    sort_by = get_listing_sort_by(request.args)
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        abort(400)
+
+    # the live site is edited from browse view
+    default_branch_name = current_app.config['default_branch']
+    edit_path_root = constants.ROUTE_BROWSE_LIVE.rstrip('/') if branch_name == default_branch_name else u'/tree/{}/edit'.format(branch_name)
+    column = make_directory_column(repo, branch_name, path, edit_path_root, showallfiles, sort_by, offset, constants.DIRECTORY_PAGE_SIZE)
+
+    working_state = get_activity_working_state_from_refs(repo, default_branch_name, branch_name)
+    edit_ok = working_state in (constants.WORKING_STATE_ACTIVE, constants.WORKING_STATE_LIVE)
+    directory_item = get_template_attribute('macros/directory_item.html', 'directory_item')
+    column_depth = len(repo.dirs_for_path(join(path, u''))) + 1
+    html = u''.join([directory_item(file, column_depth, edit_ok) for file in column['files']])
+
+    content = dict(html=html, files=column['files'], total=column['total'], more_path=column['more_path'])
+    return Response(json.dumps(content), 200, content_type='application/json')
+
 def render_articles_list(repo, branch_name, path, edit_base_url=None):
     ''' Render a page showing an activity's files
     '''
@@ -1111,36 +1572,37 @@ def render_articles_list(repo, branch_name, path, edit_base_url=None):
 def render_category_modify(repo, branch_name, path, edit_base_url=None):
     ''' Render a page showing an activity's files with an edit form for the selected category directory.
     '''
+    tree = get_commit_tree(repo, branch_name)
     path = path or '.'
-    full_path = join(repo.working_dir, path).rstrip('/')
-    full_index_path = full_path
+    index_path = path.rstrip('/')
     index_filename = u'index.{}'.format(constants.CONTENT_FILE_EXTENSION)
-    if not re.search(ur'\/{}$'.format(index_filename), full_index_path):
-        full_index_path = join(full_path, index_filename)
+    if not re.search(ur'(^|\/){}$'.format(index_filename), index_path):
+        index_path = join(index_path, index_filename)
     # init a category object with the contents of the category's front matter
-    category = get_front_matter(full_index_path)
+    category = tree_get_front_matter(tree, index_path) or {}
 
     if 'layout' not in category:
-        raise Exception(u'No layout found for {}.'.format(full_path))
+        raise Exception(u'No layout found for {}.'.format(path))
     if category['layout'] != constants.CATEGORY_LAYOUT:
         raise Exception(u'Can\'t modify {}s, only categories.'.format(category['layout']))
 
-    languages = load_languages(repo.working_dir)
+    languages = tree_load_languages(tree)
 
     kwargs = common_article_list_args(repo, branch_name, path, edit_base_url)
     # cancel redirects to the edit page for that category
     category['edit_path'] = join(kwargs['activity'].edit_path, path)
     url_slug = re.sub(ur'index.{}$'.format(constants.CONTENT_FILE_EXTENSION), u'', path)
 
-    kwargs.update(category=category, languages=languages, hexsha=repo.commit().hexsha, url_slug=url_slug)
+    kwargs.update(category=category, languages=languages, hexsha=tree.hexsha, url_slug=url_slug)
 
     return render_template('directory-modify.html', **kwargs)
 
 def render_edit_view(repo, branch_name, path, file, base_save_path=None, browse_path=None):
     ''' Render the page that lets you edit a file
     '''
+    tree = get_commit_tree(repo, branch_name)
     front, body = load_jekyll_doc(file)
-    languages = load_languages(repo.working_dir)
+    languages = tree_load_languages(tree)
     url_slug = path
     safe_branch = branch_name2path(branch_name)
     # strip the index file from the slug if appropriate
@@ -1157,7 +1619,6 @@ def render_edit_view(repo, branch_name, path, file, base_save_path=None, browse_
     if ga_config.get('access_token'):
         app_authorized = True
         analytics_dict = fetch_google_analytics_for_page(current_app.config, path, ga_config.get('access_token'))
-    commit = repo.commit()
 
     activity = chime_activity.ChimeActivity(repo=repo, branch_name=branch_name, default_branch_name=current_app.config['default_branch'], actor_email=session.get('email', None))
 
@@ -1166,7 +1627,7 @@ def render_edit_view(repo, branch_name, path, file, base_save_path=None, browse_
 
     kwargs = common_template_args(current_app.config, session)
     kwargs.update(safe_branch=safe_branch,
-                  body=body, hexsha=commit.hexsha, url_slug=url_slug,
+                  body=body, hexsha=tree.hexsha, url_slug=url_slug,
                   front=front, view_path=view_path, edit_path=path,
                   history_path=history_path, save_path=save_path,
                   browse_path=browse_path, languages=languages,
@@ -1336,11 +1797,12 @@ def handle_article_list_submit(repo, branch_name, path):
 
     return '/tree/{}/edit/{}'.format(safe_branch, redirect_path), do_save
 
-def handle_article_edit_submit(repo, branch_name, path, start_point=None):
+def handle_article_edit_submit(repo, branch_name, path, start_point=None, task_metadata=None):
     ''' Handle a form submit from the category modify pages.
 
         The request object persists from the calling method, which was called by the
-        submission of a form.
+        submission of a form. Task metadata for a branch claimed from the
+        activity pool is saved along with the first change.
     '''
     default_branch_name = current_app.config['default_branch']
     actor = Actor(' ', session['email'])
@@ -1350,9 +1812,13 @@ def handle_article_edit_submit(repo, branch_name, path, start_point=None):
     origin_dirname = current_app.config['REPO_PATH']
     working_dirname = current_app.config['WORK_PATH']
     task_id = branch_name2path(branch_var2name(branch_name))
-    user_task = UserTask(actor, task_id, default_branch_name, origin_dirname, working_dirname, start_point)
+    user_task = UserTask(actor, task_id, default_branch_name, origin_dirname, working_dirname, start_point, new=bool(task_metadata))
 
-    languages = load_languages(user_task.repo.working_dir)
+    # there's no working tree to read the site configuration from
+    try:
+        languages = load_languages_from_config(user_task.open('_config.yml'))
+    except IOError:
+        languages = load_languages_from_config(None)
     front, body = prep_jekyll_content(request.form, languages)
 
     data = BytesIO()
@@ -1371,6 +1837,11 @@ def handle_article_edit_submit(repo, branch_name, path, start_point=None):
             else:
                 end_path = new_path
 
+    if task_metadata and user_task.changed():
+        task_file = BytesIO()
+        dump_task_metadata(task_metadata, task_file)
+        user_task.write(TASK_METADATA_FILENAME, task_file.getvalue())
+
     did_save = False
     try:
         title_layout = request.form.get('en-title'), request.form.get('layout')
@@ -1396,6 +1867,113 @@ def handle_article_edit_submit(repo, branch_name, path, start_point=None):
     else:
         return '/tree/{}/edit/{}'.format(task_id, end_path), did_save
 
+def bulk_edit_response(content, status=200):
+    ''' Return a JSON response to a bulk edit request.
+    '''
+    return Response(json.dumps(content), status, content_type='application/json')
+
+def describe_task_file(user_task, path):
+    ''' Return the title and layout of the passed file or article directory in a task.
+    '''
+    for file_path in (path, join(path, u'index.{}'.format(constants.CONTENT_FILE_EXTENSION))):
+        try:
+            front, _ = load_jekyll_doc(user_task.open(file_path))
+        except IOError:
+            continue
+        return front.get('title'), front.get('layout')
+
+    return None, None
+
+def apply_bulk_edit(user_task, change):
+    ''' Apply one write, move, or delete from a bulk edit to a task.
+
+        Return a description of the action for the commit message.
+    '''
+    action, path = change.get('action'), change.get('path')
+    if not isinstance(path, basestring) or not path or path.startswith('/') or u'..' in path.split('/'):
+        raise ValueError(u'"{}" is not a path that can be edited.'.format(path))
+
+    if action == 'write':
+        front, body = change.get('front', {}), change.get('body', u'')
+        if not isinstance(front, dict) or not isinstance(body, basestring):
+            raise ValueError(u'Can\'t write "{}" without front matter and a body.'.format(path))
+
+        try:
+            user_task.read(path)
+        except IOError:
+            action = u'create'
+        else:
+            action = u'edit'
+
+        data = BytesIO()
+        dump_jekyll_doc(front, body, data)
+        user_task.write(path, data.getvalue())
+        title, display_type = front.get('title'), front.get('layout')
+
+    elif action == 'move':
+        new_path = change.get('new_path')
+        if not isinstance(new_path, basestring) or not new_path or new_path.startswith('/') or u'..' in new_path.split('/'):
+            raise ValueError(u'"{}" is not a path that "{}" can be moved to.'.format(new_path, path))
+
+        title, display_type = describe_task_file(user_task, path)
+        user_task.move(path, new_path)
+        path = new_path
+
+    elif action == 'delete':
+        title, display_type = describe_task_file(user_task, path)
+        user_task.delete(path)
+
+    else:
+        raise ValueError(u'"{}" is not a bulk edit action.'.format(action))
+
+    return {'action': action, 'title': title, 'display_type': display_type, 'file_path': path}
+
+def handle_bulk_edit_submit(repo, branch_name, payload):
+    ''' Apply a list of file writes, moves, and deletes to an activity in one commit.
+
+        The payload is decoded JSON: a "hexsha" start point, a list of
+        "changes" and an optional commit "message". Each change has an
+        "action" of "write" (with "front" and "body"), "move" (with
+        "new_path") or "delete", and a "path". All of them are made in
+        one UserTask, so there's a single commit and a single push
+        however many files change.
+    '''
+    if not isinstance(payload, dict) or not payload.get('hexsha') \
+            or not isinstance(payload.get('changes'), list) or not payload['changes']:
+        return bulk_edit_response({'error': u'Send a start point "hexsha" and a list of "changes".'}, 400)
+
+    default_branch_name = current_app.config['default_branch']
+    actor = Actor(' ', session['email'])
+    task_id = branch_name2path(branch_var2name(branch_name))
+    origin_dirname = current_app.config['REPO_PATH']
+    working_dirname = current_app.config['WORK_PATH']
+
+    with get_usertask(actor, task_id, default_branch_name, origin_dirname, working_dirname, payload['hexsha']) as user_task:
+        action_descriptions = []
+        for change in payload['changes']:
+            try:
+                if not isinstance(change, dict):
+                    raise ValueError(u'Each change must be an object.')
+                action_descriptions.append(apply_bulk_edit(user_task, change))
+            except ValueError as e:
+                return bulk_edit_response({'error': e.args[0]}, 400)
+
+        subject = payload.get('message') or u'{} files were changed'.format(len(action_descriptions))
+        message_body = dict(branch_name=task_id, actions=action_descriptions)
+        commit_message = make_commit_message(subject=subject, body=json.dumps(message_body, ensure_ascii=False))
+
+        try:
+            did_save = user_task.commit(commit_message)
+            user_task.push()
+        except UserTaskPublished:
+            return bulk_edit_response({'error': MESSAGE_ACTIVITY_PUBLISHED.format(**user_task.ref_info())}, 409)
+        except UserTaskDeleted:
+            return bulk_edit_response({'error': MESSAGE_ACTIVITY_DELETED}, 409)
+        except MergeConflict as e:
+            return bulk_edit_response({'error': MESSAGE_PAGE_EDITED.format(**user_task.ref_info(e.remote_commit.hexsha))}, 409)
+
+        return bulk_edit_response({'saved': did_save, 'hexsha': user_task.commit_sha})
+
 def add_article_or_category(repo, working_branch_name, dir_path, request_path, create_what):
     ''' Add an article or category
     '''
@@ -1497,7 +2075,11 @@ def get_activity_action_and_authorized(working_branch_name, default_branch_name,
 def get_preview_asset_response(working_dir, path):
     ''' Make sure a Jekyll preview is ready and return a response for the passed asset.
     '''
-    build_jekyll_site(working_dir)
+    # a preview can still show the pages a failed build did make
+    try:
+        build_jekyll_site(working_dir)
+    except JekyllBuildFailed:
+        pass
 
     view_path = join(working_dir, constants.JEKYLL_BUILD_DIRECTORY_NAME, path or '')
 
@@ -1522,6 +2104,49 @@ def get_preview_asset_response(working_dir, path):
 
     return Response(open(local_path).read(), 200, {'Content-Type': mime_type})
 
+def make_file_response(path, etag, mime_type, chunk_size=FILE_CHUNK_SIZE):
+    ''' Return a response that streams the passed file a chunk at a time.
+
+        The etag should change whenever the file does. Conditional requests
+        get a 304, and a request for a single byte range gets just that range.
+    '''
+    headers = {'ETag': u'"{}"'.format(etag), 'Accept-Ranges': 'bytes'}
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    size = getsize(path)
+    start, stop, status = 0, size, 200
+
+    # a range is only good for the version of the file the client already has
+    if_range = request.if_range
+    if request.range and if_range.date is None and if_range.etag in (None, etag):
+        byte_range = request.range.range_for_length(size)
+
+        if byte_range:
+            (start, stop), status = byte_range, 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+
+        elif len(request.range.ranges) == 1:
+            headers['Content-Range'] = 'bytes */{}'.format(size)
+            return Response(status=416, headers=headers)
+
+    headers['Content-Length'] = str(stop - start)
+
+    def read_chunks():
+        with open(path, 'rb') as file:
+            file.seek(start)
+            remaining = stop - start
+
+            while remaining > 0:
+                chunk = file.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    return Response(read_chunks(), status, headers=headers, mimetype=mime_type, direct_passthrough=True)
+
 def prep_jekyll_content(new_values, languages):
     '''
     '''
@@ -1637,7 +2262,7 @@ def save_page(repo, default_branch_name, working_branch_name, file_path, new_val
 
     sync_with_branch(repo, working_branch_name, working_branch_name)
 
-    repo.git.push('origin', working_branch_name)
+    push_to_origin(repo, [working_branch_name])
 
     #
     # Try to merge from the master to the current branch.
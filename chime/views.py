@@ -3,21 +3,22 @@ from __future__ import absolute_import
 from logging import getLogger
 Logger = getLogger('chime.views')
 
-from os.path import join, isdir, exists
+from os.path import join
 from re import compile, MULTILINE, sub
 
 from requests import post
 from datetime import datetime
 from urlparse import urlparse
 from flask import current_app, flash, render_template, redirect, request, Response, session, abort
+from gitdb.exc import BadName
 
 from . import chime as app
-from . import constants, repo_functions, chime_activity
+from . import constants, repo_functions, chime_activity, publish_functions
 from . import publish
 from .jekyll_functions import load_languages
 
 # the decorator functions
-from .view_functions import login_required, lock_on_user, browserid_hostname_required, synch_required, synched_checkout_required, log_application_errors
+from .view_functions import login_required, lock_on_user, browserid_hostname_required, synch_required, synched_checkout_required, synched_read_required, log_application_errors
 # everything else
 from . import view_functions
 
@@ -260,13 +261,16 @@ def update_activity():
 @lock_on_user
 @synch_required
 def get_checkout(ref):
-    '''
+    ''' Stream a zip archive of the commit the passed ref points to.
     '''
     r = view_functions.get_repo(flask_app=current_app)
 
-    bytes = publish.retrieve_commit_checkout(current_app.config['RUNNING_STATE_DIR'], r, ref)
+    try:
+        archive_path, hexsha = publish.retrieve_commit_checkout(current_app.config['RUNNING_STATE_DIR'], r, ref)
+    except (BadName, ValueError):
+        abort(404)
 
-    return Response(bytes.getvalue(), mimetype='application/zip')
+    return view_functions.make_file_response(archive_path, hexsha, 'application/zip')
 
 @app.route('/tree/<branch_name>/view/', methods=['GET'])
 @app.route('/tree/<branch_name>/view/<path:path>', methods=['GET'])
@@ -283,20 +287,21 @@ def branch_view(branch_name, path=None):
 @log_application_errors
 @login_required
 @lock_on_user
-@synched_checkout_required
+@synched_read_required
 def browse_master(path=None):
     repo = view_functions.get_repo(flask_app=current_app)
     default_branch_name = current_app.config['default_branch']
-    full_path = join(repo.working_dir, path or '.').rstrip('/')
+    tree = view_functions.get_commit_tree(repo, default_branch_name)
+    path = path or u''
 
     # make sure the path points to something that exists
-    if not exists(full_path):
+    if not tree or not tree.exists(path):
         abort(404)
 
-    if isdir(full_path):
+    if tree.isdir(path):
         # if this is a directory representing an article, redirect to to the index file within
-        if view_functions.is_article_dir(full_path):
-            index_path = join(path or u'', u'index.{}'.format(constants.CONTENT_FILE_EXTENSION))
+        if view_functions.tree_is_article_dir(tree, path):
+            index_path = join(path, u'index.{}'.format(constants.CONTENT_FILE_EXTENSION))
             return redirect('{}{}'.format(constants.ROUTE_BROWSE_LIVE, index_path))
 
         # if the directory path didn't end with a slash, add it and redirect
@@ -318,7 +323,7 @@ def browse_master(path=None):
         )
 
     # if it's the index file of a category, show the modify view
-    path_type, _ = view_functions.index_path_display_type_and_title(full_path)
+    path_type, _ = view_functions.tree_index_path_display_type_and_title(tree, path)
     if path_type == constants.CATEGORY_LAYOUT:
         # render the directory modification view
         return view_functions.render_category_modify(
@@ -331,7 +336,7 @@ def browse_master(path=None):
     browse_path = join(constants.ROUTE_BROWSE_LIVE, repo_functions.strip_last_item(path))
     return view_functions.render_edit_view(
         repo=repo, branch_name=default_branch_name,
-        path=path, file=open(full_path, 'r'),
+        path=path, file=tree.open(path),
         base_save_path='{}save'.format(constants.ROUTE_BROWSE_LIVE), browse_path=browse_path
     )
 
@@ -346,18 +351,20 @@ def handle_look_in_submit(path=None):
     '''
     repo = view_functions.get_repo(flask_app=current_app)
     default_branch_name = current_app.config['default_branch']
-    # start a new branch to save any changes in
-    working_branch_name = view_functions.start_activity_for_edits(repo, default_branch_name)
+    # claim a pre-made branch to save any changes in, or start a new one
+    working_branch_name, _, _ = view_functions.claim_activity_for_edits(repo, default_branch_name)
+    pooled = working_branch_name is not None
+    if not pooled:
+        working_branch_name = view_functions.start_activity_for_edits(repo, default_branch_name)
     try:
         redirect_path, did_save = view_functions.handle_article_list_submit(repo, working_branch_name, path)
     except Exception:
-        # abandon the new branch and raise the exception
-        repo_functions.abandon_branch(repo, default_branch_name, working_branch_name)
+        # give back or abandon the new branch and raise the exception
+        view_functions.finish_activity_for_edits(repo, default_branch_name, working_branch_name, pooled, False)
         raise
 
+    view_functions.finish_activity_for_edits(repo, default_branch_name, working_branch_name, pooled, did_save)
     if not did_save:
-        # abandon the new branch
-        repo_functions.abandon_branch(repo, default_branch_name, working_branch_name)
         # redirect to where we started
         return redirect('{}{}'.format(constants.ROUTE_BROWSE_LIVE, path), code=303)
 
@@ -373,21 +380,23 @@ def handle_look_article_submit(path):
     '''
     repo = view_functions.get_repo(flask_app=current_app)
     default_branch_name = current_app.config['default_branch']
-    # start a new branch to save any changes in
-    working_branch_name = view_functions.start_activity_for_edits(repo, default_branch_name)
-    start_point = repo.branches[working_branch_name].commit.hexsha
+    # claim a pre-made branch to save any changes in, or start a new one
+    working_branch_name, start_point, task_metadata = view_functions.claim_activity_for_edits(repo, default_branch_name, checkout=False)
+    pooled = working_branch_name is not None
+    if not pooled:
+        working_branch_name = view_functions.start_activity_for_edits(repo, default_branch_name)
+        start_point = repo.branches[working_branch_name].commit.hexsha
     try:
         redirect_path, did_save = view_functions.handle_article_edit_submit(
-            repo=repo, branch_name=working_branch_name, path=path, start_point=start_point
+            repo=repo, branch_name=working_branch_name, path=path, start_point=start_point, task_metadata=task_metadata
         )
     except Exception:
-        # abandon the new branch and raise the exception
-        repo_functions.abandon_branch(repo, default_branch_name, working_branch_name)
+        # give back or abandon the new branch and raise the exception
+        view_functions.finish_activity_for_edits(repo, default_branch_name, working_branch_name, pooled, False)
         raise
 
+    view_functions.finish_activity_for_edits(repo, default_branch_name, working_branch_name, pooled, did_save)
     if not did_save:
-        # abandon the new branch
-        repo_functions.abandon_branch(repo, default_branch_name, working_branch_name)
         # redirect to where we started
         return redirect('{}{}'.format(constants.ROUTE_BROWSE_LIVE, path), code=303)
 
@@ -418,16 +427,17 @@ def branch_edit(branch_name, path=None):
     if repo_functions.get_conflict(repo, current_app.config['default_branch']):
         view_functions.flash_unique(repo_functions.MERGE_CONFLICT_WARNING_FLASH_MESSAGE, u'warning')
 
-    full_path = join(repo.working_dir, path or '.').rstrip('/')
+    tree = view_functions.get_commit_tree(repo, branch_name)
+    path = path or u''
 
     # make sure the path points to something that exists
-    if not exists(full_path):
+    if not tree or not tree.exists(path):
         abort(404)
 
-    if isdir(full_path):
+    if tree.isdir(path):
         # if this is a directory representing an article, redirect to the index file within
-        if view_functions.is_article_dir(full_path):
-            index_path = join(path or u'', u'index.{}'.format(constants.CONTENT_FILE_EXTENSION))
+        if view_functions.tree_is_article_dir(tree, path):
+            index_path = join(path, u'index.{}'.format(constants.CONTENT_FILE_EXTENSION))
             return redirect('/tree/{}/edit/{}'.format(safe_branch, index_path))
 
         # if the directory path didn't end with a slash, add it and redirect
@@ -447,7 +457,7 @@ def branch_edit(branch_name, path=None):
         )
 
     # if it's the index file of a category, show the modify view
-    path_type, _ = view_functions.index_path_display_type_and_title(full_path)
+    path_type, _ = view_functions.tree_index_path_display_type_and_title(tree, path)
     if path_type == constants.CATEGORY_LAYOUT:
         # render the directory modification view
         return view_functions.render_category_modify(
@@ -459,10 +469,23 @@ def branch_edit(branch_name, path=None):
     browse_path = join('/tree/{}/edit'.format(safe_branch), repo_functions.strip_last_item(path))
     return view_functions.render_edit_view(
         repo=repo, branch_name=branch_name,
-        path=path, file=open(full_path, 'r'),
+        path=path, file=tree.open(path),
         browse_path=browse_path
     )
 
+@app.route('/tree/<branch_name>/listing/', methods=['GET'])
+@app.route('/tree/<branch_name>/listing/<path:path>', methods=['GET'])
+@log_application_errors
+@login_required
+@lock_on_user
+@synched_read_required
+def branch_listing(branch_name, path=None):
+    ''' Return a page of a directory listing as JSON, for loading the rest of long listings
+    '''
+    repo = view_functions.get_repo(flask_app=current_app)
+    branch_name = view_functions.branch_var2name(branch_name)
+    return view_functions.render_directory_page(repo, branch_name, path)
+
 @app.route('/tree/<branch_name>/edit/', methods=['POST'])
 @app.route('/tree/<branch_name>/edit/<path:path>', methods=['POST'])
 @log_application_errors
@@ -510,7 +533,8 @@ def show_activity_overview(branch_name):
     else:
         activity = chime_activity.ChimePublishedActivity(repo=repo, branch_name=safe_branch, default_branch_name=current_app.config['default_branch'])
 
-    kwargs.update(safe_branch=branch_name, activity=activity, app_authorized=app_authorized, languages=languages)
+    publish_job = publish_functions.get_publish_job_for_branch(current_app.config['RUNNING_STATE_DIR'], branch_name)
+    kwargs.update(safe_branch=branch_name, activity=activity, app_authorized=app_authorized, languages=languages, publish_job=publish_job)
 
     # check the request's base URL for modals
     modal_type = urlparse(request.base_url).path.rstrip('/').split('/')[-1]
@@ -551,6 +575,16 @@ def handle_rename_form(branch_name):
 @log_application_errors
 @login_required
 @lock_on_user
+def edit_activity(branch_name):
+    ''' Handle a bulk edit as JSON, or a POST from a form on the activity overview page
+    '''
+    if request.mimetype == 'application/json':
+        # bulk edits are committed without a checkout, like article saves
+        repo = view_functions.get_repo(flask_app=current_app)
+        return view_functions.handle_bulk_edit_submit(repo, branch_name, request.get_json(silent=True))
+
+    return edit_activity_overview(branch_name=branch_name)
+
 @synched_checkout_required
 def edit_activity_overview(branch_name):
     ''' Handle a POST from a form on the activity overview page
@@ -632,17 +666,21 @@ def styleguide():
 @log_application_errors
 @login_required
 def admin():
-    return render_template('admin.html')
+    publish_jobs = publish_functions.get_publish_jobs(current_app.config['RUNNING_STATE_DIR'])
+    return render_template('admin.html', publish_jobs=publish_jobs)
 
 @app.route('/admin/publish', methods=['POST'])
 @log_application_errors
 @login_required
 def publish_branch():
-    repo = view_functions.get_repo(flask_app=current_app)
-    master_name = current_app.config['default_branch']
-    repo.git.checkout(master_name)
-    view_functions.publish_commit(repo, current_app.config['PUBLISH_PATH'])
-    flash(u'Published!', u'notice')
+    if not current_app.config['PUBLISH_PATH']:
+        flash(u'There\'s nowhere to publish the live site to; set PUBLISH_PATH first.', u'error')
+        return redirect('/admin')
+
+    origin = repo_functions.ChimeRepo(current_app.config['REPO_PATH'])
+    hexsha = origin.branches[current_app.config['default_branch']].commit.hexsha
+    publish_functions.queue_publish_job(current_app.config['RUNNING_STATE_DIR'], hexsha, current_app.config['PUBLISH_PATH'])
+    flash(u'Queued the live site for publishing!', u'notice')
     return redirect('/admin')
 
 @app.route('/<path:path>')
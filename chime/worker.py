@@ -10,7 +10,8 @@ import traceback
 
 from git import Repo
 
-from .repo_functions import push_upstream_if_needed
+from .repo_functions import push_upstream_if_needed, get_conflicted_branch_names, fill_activity_pool
+from .publish_functions import run_publish_jobs
 from .google_api_functions import (
     is_overdue_ga_config, read_ga_config, request_new_google_access_token
 )
@@ -25,6 +26,10 @@ if __name__ == '__main__':
         os.environ['RUNNING_STATE_DIR'], os.environ['GA_CLIENT_ID'], \
         os.environ['GA_CLIENT_SECRET'], os.environ.get('REPO_PATH', 'sample-site')
 
+    default_branch_name = os.environ.get('DEFAULT_BRANCH', 'master')
+    build_shards = int(os.environ.get('PUBLISH_BUILD_SHARDS', 1))
+    activity_pool_size = int(os.environ.get('ACTIVITY_POOL_SIZE', 0))
+
     while True:
         #
         # Periodically get a new access_token and store it.
@@ -50,5 +55,33 @@ if __name__ == '__main__':
         except:
             traceback.print_exc(file=sys.stderr)
 
+        #
+        # Periodically check every activity for conflicts with the default
+        # branch, so the activities list can show them without merging.
+        #
+        try:
+            get_conflicted_branch_names(Repo(repo_path), default_branch_name, running_state_dir)
+        except:
+            traceback.print_exc(file=sys.stderr)
+
+        #
+        # Periodically top up the pool of pre-made activity branches,
+        # so edits from the live site don't wait for a new branch.
+        # With no ACTIVITY_POOL_SIZE, this only empties a pool left over.
+        #
+        try:
+            fill_activity_pool(Repo(repo_path), default_branch_name, running_state_dir, activity_pool_size)
+        except:
+            traceback.print_exc(file=sys.stderr)
+
+        #
+        # Build and publish the live site for every queued publish job,
+        # so publishing an activity doesn't wait for Jekyll.
+        #
+        try:
+            run_publish_jobs(Repo(repo_path), running_state_dir, build_shards)
+        except:
+            traceback.print_exc(file=sys.stderr)
+
         Logger.debug('Sleeping.')
         time.sleep(5)
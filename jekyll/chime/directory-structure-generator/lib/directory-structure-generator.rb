@@ -1,3 +1,5 @@
+require 'directory-structure-shards'
+
 module Jekyll
     class DirectoryStructureGenerator < Jekyll::Generator
         safe true
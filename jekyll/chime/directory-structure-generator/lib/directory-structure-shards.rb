@@ -0,0 +1,31 @@
+require 'zlib'
+
+module Jekyll
+    # Render and write only this shard's share of the site.
+    #
+    # chime_shard in the site config holds this build's index and the
+    # count of shards; each page, post or file belongs to one shard
+    # based on a checksum of its path. Posts are still rendered by
+    # every shard, because pages like feeds include their content.
+    module DirectoryStructureShard
+        def in_chime_shard?
+            shard = @site.config['chime_shard']
+            return true if not shard
+            return Zlib.crc32(relative_path) % shard['count'] == shard['index']
+        end
+
+        def write(dest)
+            super if in_chime_shard?
+        end
+    end
+
+    module DirectoryStructureShardRendering
+        def render(layouts, site_payload)
+            super if in_chime_shard?
+        end
+    end
+
+    Page.send(:prepend, DirectoryStructureShard, DirectoryStructureShardRendering)
+    Post.send(:prepend, DirectoryStructureShard)
+    StaticFile.send(:prepend, DirectoryStructureShard)
+end
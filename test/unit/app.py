@@ -4,17 +4,21 @@ from __future__ import absolute_import
 from unittest import main, TestCase
 
 from tempfile import mkdtemp
-from os.path import join, exists, dirname, isdir, abspath, sep
+from os.path import join, exists, dirname, isdir, abspath, relpath, sep
 from urlparse import urlparse, urljoin
-from os import environ, mkdir
+from os import environ, mkdir, listdir, walk
 from shutil import rmtree, copytree
-from re import search, sub
+from re import search, sub, DOTALL
 import random
 from datetime import date, timedelta, datetime
 import sys
+import json
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from io import BytesIO
 from chime.repo_functions import ChimeRepo
 from slugify import slugify
 from multiprocessing import Process
+from threading import Event
 import time
 import logging
 import tempfile
@@ -30,7 +34,8 @@ from bs4 import Comment, BeautifulSoup
 
 from chime import (
     create_app, repo_functions, google_api_functions, view_functions,
-    publish, errors)
+    publish, publish_functions, errors)
+from chime.publish import functions as publish_webhook_functions
 from chime import constants
 from chime import chime_activity
 
@@ -609,7 +614,9 @@ class TestApp (TestCase):
         self.assertTrue(generated_branch_name in response.data)
         self.assertTrue(response.data.find(generated_branch_name) > response.data.find(u'Recently Published Activities'))
 
-        # Look in the published directory and see if the words are there.
+        # Build the site the way the worker would, then look in the
+        # published directory and see if the words are there.
+        publish_functions.run_publish_jobs(ChimeRepo(self.app.config['REPO_PATH']), self.app.config['RUNNING_STATE_DIR'])
         with open(join(self.publish_path, fake_page_slug, 'index.html')) as file:
             self.assertTrue(fake_page_content in file.read())
 
@@ -830,6 +837,49 @@ class TestApp (TestCase):
         # and the activity title wrapped in an a tag
         self.assertIsNotNone(pub_li.find('a', text=fake_task_description))
 
+    # in TestApp
+    def test_checkout_archive(self):
+        ''' Zip archives of commits are streamed from a cache, with ETags and ranges.
+        '''
+        with HTTMock(self.mock_persona_verify_erica):
+            self.test_client.post('/sign-in', data={'assertion': 'erica@example.com'})
+
+        master_hexsha = ChimeRepo(self.app.config['REPO_PATH']).branches['master'].commit.hexsha
+
+        with HTTMock(self.auth_csv_example_allowed):
+            response = self.test_client.get('/checkouts/master.zip')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['ETag'], u'"{}"'.format(master_hexsha))
+            self.assertEqual(int(response.headers['Content-Length']), len(response.data))
+            self.assertTrue('index.md' in ZipFile(BytesIO(response.data)).namelist())
+            archive_data = response.data
+
+            # the archive was cached by SHA, and is sent from the cache for the same commit
+            cache_path = join(self.app.config['RUNNING_STATE_DIR'], publish.CHECKOUTS_DIRNAME, '{}.zip'.format(master_hexsha))
+            self.assertTrue(exists(cache_path))
+
+            with patch('git.Repo.archive') as archive:
+                response = self.test_client.get('/checkouts/{}.zip'.format(master_hexsha))
+            self.assertFalse(archive.called)
+            self.assertEqual(response.data, archive_data)
+
+            response = self.test_client.get('/checkouts/master.zip', headers={'If-None-Match': u'"{}"'.format(master_hexsha)})
+            self.assertEqual(response.status_code, 304)
+
+            response = self.test_client.get('/checkouts/master.zip', headers={'Range': 'bytes=10-19'})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.data, archive_data[10:20])
+            self.assertEqual(response.headers['Content-Range'], 'bytes 10-19/{}'.format(len(archive_data)))
+
+            response = self.test_client.get('/checkouts/master.zip', headers={'Range': 'bytes=10-19', 'If-Range': '"out-of-date"'})
+            self.assertEqual(response.status_code, 200)
+
+            response = self.test_client.get('/checkouts/master.zip', headers={'Range': 'bytes={}-'.format(len(archive_data))})
+            self.assertEqual(response.status_code, 416)
+
+            response = self.test_client.get('/checkouts/no-such-ref.zip')
+            self.assertEqual(response.status_code, 404)
+
     # in TestApp
     def test_get_request_does_not_create_branch(self):
         ''' Navigating to a made-up URL should not create a branch
@@ -2480,9 +2530,41 @@ class TestApp (TestCase):
         with HTTMock(self.auth_csv_example_allowed):
             response = self.test_client.post('/tree/{}/'.format(generated_branch_name_1), data={'comment_text': u'', 'endorse_edits': 'Endorse Edits'}, follow_redirects=True)
 
-        # And publish person 1's change!
-        with HTTMock(self.auth_csv_example_allowed):
+        # And publish person 1's change! The site isn't built until the worker gets to it.
+        with HTTMock(self.auth_csv_example_allowed), \
+             patch('chime.publish_functions.build_jekyll_site') as build_jekyll_site:
             response = self.test_client.post('/tree/{}/'.format(generated_branch_name_1), data={'comment_text': u'', 'merge': 'Publish'}, follow_redirects=True)
+        self.assertFalse(build_jekyll_site.called)
+
+        # the publish job shows on the activity and admin pages
+        with HTTMock(self.auth_csv_example_allowed):
+            response = self.test_client.get('/tree/{}/'.format(generated_branch_name_1), follow_redirects=True)
+            soup = BeautifulSoup(response.data)
+            self.assertEqual(soup.find(attrs={'data-test-id': 'publish-job-state'}).text.strip(), u'Waiting to be built for the live site.')
+
+            response = self.test_client.get('/admin', follow_redirects=True)
+            soup = BeautifulSoup(response.data)
+            self.assertEqual(len(soup.find(attrs={'data-test-id': 'publish-jobs'}).find_all('tr')), 2)
+            self.assertTrue(generated_branch_name_1 in response.data)
+
+            # nothing is queued when there's nowhere to publish to
+            with patch.dict(self.app.config, {'PUBLISH_PATH': None}):
+                response = self.test_client.post('/admin/publish', follow_redirects=True)
+            self.assertTrue(u'set PUBLISH_PATH first' in response.data)
+            soup = BeautifulSoup(response.data)
+            self.assertEqual(len(soup.find(attrs={'data-test-id': 'publish-jobs'}).find_all('tr')), 2)
+
+        # Person 2's change is flagged on the activities list
+        with HTTMock(self.auth_csv_example_allowed):
+            response = self.test_client.get(constants.ROUTE_ACTIVITY, follow_redirects=True)
+            self.assertEqual(response.data.count(u'Conflicts with the live site'), 1)
+            self.assertTrue(search(r'<!-- branch: {} -->(?:(?!<li).)*Conflicts with the live site'.format(generated_branch_name_2), response.data, DOTALL))
+
+            # and the flag is remembered until something moves
+            with patch('chime.repo_functions.get_merge_conflicted') as get_merge_conflicted:
+                response = self.test_client.get(constants.ROUTE_ACTIVITY, follow_redirects=True)
+            self.assertEqual(get_merge_conflicted.call_count, 0)
+            self.assertEqual(response.data.count(u'Conflicts with the live site'), 1)
 
         #
         #
@@ -2532,6 +2614,12 @@ class TestApp (TestCase):
             categories_slug = u'categories'
             mkdir(join(repo.working_dir, testing_slug))
             mkdir(join(repo.working_dir, testing_slug, categories_slug))
+            # git doesn't track empty directories, so commit a hidden placeholder
+            placeholder_path = join(testing_slug, categories_slug, u'.gitkeep')
+            open(join(repo.working_dir, placeholder_path), 'w').close()
+            repo.index.add([placeholder_path])
+            repo.index.commit(u'Added a solo directory')
+            repo.git.push('origin', branch_name)
 
             # open the top level directory
             erica.open_link(url='/tree/{}/edit/'.format(branch_name))
@@ -2764,6 +2852,34 @@ class TestApp (TestCase):
             task_metadata = repo_functions.get_task_metadata_for_branch(repo, branch_name)
             self.assertEqual(task_metadata['task_description'], new_description)
 
+    # in TestApp
+    def test_no_rename_message_when_push_fails(self):
+        ''' The rename message is only shown once the renamed activity is pushed.
+        '''
+        with HTTMock(self.auth_csv_example_allowed):
+            erica_email = u'erica@example.com'
+            with HTTMock(self.mock_persona_verify_erica):
+                erica = ChimeTestClient(self.app.test_client(), self)
+                erica.sign_in(erica_email)
+
+            erica.open_link(constants.ROUTE_ACTIVITY)
+            args = u'Skates are cartilaginous fish', u'The Two Subfamilies Are Rajinae And Arhynchobatinae'
+            erica.quick_activity_setup(*args)
+            activity_path = erica.path
+
+            form = erica.soup.find('form', {'data-test-id': 'request-feedback-form'})
+            data = {i['name']: i.get('value', u'') for i in form.find_all(['input', 'button', 'textarea'])}
+            data.update(comment_text=u'', task_description=u'Skates Are Oviparous')
+            save_path = urlparse(urljoin(erica.path, form['action'])).path
+
+            with patch('chime.repo_functions.push_to_origin', side_effect=Exception(u'Origin went away')):
+                response = erica.client.post(save_path, data=data)
+            self.assertEqual(response.status_code, 500)
+            self.assertFalse(u'Changed activity name' in response.data.decode('utf8'))
+
+            response = erica.client.get(activity_path)
+            self.assertFalse(u'Changed activity name' in response.data.decode('utf8'))
+
     # in TestApp
     def test_save_unchanged_article(self):
         ''' Saving an unchanged article doesn't raise any errors.
@@ -2807,6 +2923,136 @@ class TestApp (TestCase):
             comments = erica.soup.findAll(text=lambda text: isinstance(text, Comment))
             self.assertTrue(pattern_template_comment_stripped.format(u'articles-list') in comments)
 
+    # in TestApp
+    def test_browse_reads_from_commit_tree(self):
+        ''' Browsing the live site doesn't check anything out in the working directory.
+        '''
+        with HTTMock(self.auth_csv_example_allowed):
+            erica_email = u'erica@example.com'
+            with HTTMock(self.mock_persona_verify_erica):
+                erica = ChimeTestClient(self.app.test_client(), self)
+                erica.sign_in(erica_email)
+
+            repo = view_functions.get_repo(repo_path=self.app.config['REPO_PATH'], work_path=self.app.config['WORK_PATH'], email=erica_email)
+            repo.git.checkout('-b', 'scratch')
+
+            # browse into a category and open an article
+            articles_slug = u'test-articles'
+            erica.open_link(url='/browse/{}/'.format(articles_slug))
+            self.assertIsNotNone(erica.soup.find(text=u'Test Topic'))
+            erica.open_link(url='/browse/{}/test-topic/test-subtopic/test-article/index.{}'.format(articles_slug, constants.CONTENT_FILE_EXTENSION))
+
+            # the working directory wasn't touched
+            self.assertEqual(repo.active_branch.name, 'scratch')
+
+    # in TestApp
+    def test_directory_listing_pages(self):
+        ''' The rest of a long directory listing can be loaded as JSON.
+        '''
+        with HTTMock(self.auth_csv_example_allowed):
+            erica_email = u'erica@example.com'
+            with HTTMock(self.mock_persona_verify_erica):
+                erica = ChimeTestClient(self.app.test_client(), self)
+                erica.sign_in(erica_email)
+
+            # get the second page of the live site's top-level listing
+            response = erica.client.get('/tree/master/listing/?offset=1&sort=title', follow_redirects=True)
+            self.assertEqual(response.status_code, 200)
+            page = json.loads(response.data)
+            self.assertEqual(page['total'], len(page['files']) + 1)
+            self.assertIsNone(page['more_path'])
+            for file in page['files']:
+                self.assertTrue(u'file name: {},'.format(file['name']) in page['html'])
+
+            # a bad offset or a missing directory is an error
+            response = erica.client.get('/tree/master/listing/?offset=lots', follow_redirects=True)
+            self.assertEqual(response.status_code, 400)
+            response = erica.client.get('/tree/master/listing/no-such-directory/', follow_redirects=True)
+            self.assertEqual(response.status_code, 404)
+
+    # in TestApp
+    def test_bulk_edit_makes_one_commit(self):
+        ''' Writes, moves, and deletes posted together as JSON are saved in one commit.
+        '''
+        with HTTMock(self.auth_csv_example_allowed):
+            erica_email = u'erica@example.com'
+            with HTTMock(self.mock_persona_verify_erica):
+                erica = ChimeTestClient(self.app.test_client(), self)
+                erica.sign_in(erica_email)
+
+            erica.open_link(constants.ROUTE_ACTIVITY)
+            branch_name = erica.quick_activity_setup(u'Walk to the pond', u'Ducks', u'Mallards')
+            origin = self.origin
+            start_commit = origin.branches[branch_name].commit
+
+            changes = [
+                dict(action='write', path='other/ducks/teals/index.markdown', front=dict(title=u'Teals', layout=constants.ARTICLE_LAYOUT), body=u'Small.'),
+                dict(action='write', path='other/ducks/wigeons/index.markdown', front=dict(title=u'Wigeons', layout=constants.ARTICLE_LAYOUT), body=u'Whistly.'),
+                dict(action='move', path='other/ducks/teals/index.markdown', new_path='other/ducks/green-winged-teals/index.markdown'),
+                dict(action='delete', path='other/ducks/mallards'),
+            ]
+            payload = dict(hexsha=start_commit.hexsha, changes=changes)
+            response = erica.client.post('/tree/{}/'.format(branch_name), data=json.dumps(payload), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            result = json.loads(response.data)
+            self.assertTrue(result['saved'])
+
+            # one new commit in origin, with every change in it
+            commit = origin.branches[branch_name].commit
+            self.assertEqual(result['hexsha'], commit.hexsha)
+            self.assertEqual([parent.hexsha for parent in commit.parents], [start_commit.hexsha])
+            paths = [blob.path for blob in commit.tree.traverse() if blob.type == 'blob']
+            self.assertTrue('other/ducks/green-winged-teals/index.markdown' in paths)
+            self.assertTrue('other/ducks/wigeons/index.markdown' in paths)
+            self.assertFalse('other/ducks/teals/index.markdown' in paths)
+            self.assertFalse('other/ducks/mallards/index.markdown' in paths)
+
+            # the changes show up on the activity page
+            erica.open_link('/tree/{}/'.format(branch_name))
+            self.assertIsNotNone(erica.soup.find(text=u'Wigeons'))
+
+            # a bad change is refused without committing anything
+            payload = dict(hexsha=commit.hexsha, changes=[dict(action='delete', path='no/such/file.md')])
+            response = erica.client.post('/tree/{}/'.format(branch_name), data=json.dumps(payload), content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+            self.assertTrue(u'doesn\'t exist' in json.loads(response.data)['error'])
+            response = erica.client.post('/tree/{}/'.format(branch_name), data=json.dumps(dict(changes=[])), content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(origin.branches[branch_name].commit, commit)
+
+    # in TestApp
+    def test_activities_get_their_own_clones(self):
+        ''' With a worktree disk budget, switching activities doesn't check anything out in the user's clone.
+        '''
+        self.app.config['WORKTREE_DISK_BUDGET'] = 1024 * 1024 * 1024
+
+        with HTTMock(self.auth_csv_example_allowed):
+            erica_email = u'erica@example.com'
+            with HTTMock(self.mock_persona_verify_erica):
+                erica = ChimeTestClient(self.app.test_client(), self)
+                erica.sign_in(erica_email)
+
+            repo = view_functions.get_repo(repo_path=self.app.config['REPO_PATH'], work_path=self.app.config['WORK_PATH'], email=erica_email)
+            active_branch_name = repo.active_branch.name
+
+            # start two activities and add an article to each
+            erica.open_link(constants.ROUTE_ACTIVITY)
+            branch_name1 = erica.quick_activity_setup(u'Walk to the pond', u'Ducks', u'Mallards', u'Drakes')
+            erica.open_link(constants.ROUTE_ACTIVITY)
+            branch_name2 = erica.quick_activity_setup(u'Walk to the river', u'Geese', u'Canada Geese', u'Goslings')
+
+            # switch back and forth between them
+            erica.open_link('/tree/{}/edit/other/ducks/'.format(branch_name1))
+            self.assertIsNotNone(erica.soup.find(text=u'Mallards'))
+            erica.open_link('/tree/{}/edit/other/geese/'.format(branch_name2))
+            self.assertIsNotNone(erica.soup.find(text=u'Canada Geese'))
+
+            # the user's clone stayed where it was, and each activity has a clone of its own
+            self.assertEqual(repo.active_branch.name, active_branch_name)
+            worktree_names = [name for name in listdir(self.work_path) if name.startswith('worktree-')]
+            self.assertTrue(len([name for name in worktree_names if name.endswith(branch_name1)]) == 1)
+            self.assertTrue(len([name for name in worktree_names if name.endswith(branch_name2)]) == 1)
+
     # in TestApp
     def test_no_activity_bar_when_browsing(self):
         ''' There's no activity bar when you're browsing the live site.
@@ -3085,6 +3331,61 @@ class TestApp (TestCase):
             # a flash about the article's edit is on the page
             self.assertEqual(PATTERN_FLASH_SAVED_ARTICLE.format(title=new_title), erica.soup.find('li', class_='flash').text)
 
+    # in TestApp
+    def test_edit_article_in_browse_claims_pooled_activity(self):
+        ''' Editing an article from browse view uses a pre-made branch from the activity pool.
+        '''
+        running_state_dir = self.app.config['RUNNING_STATE_DIR']
+        repo_functions.fill_activity_pool(self.origin, 'master', running_state_dir, size=2)
+        pool_branch_names = repo_functions.get_pool_branch_names(running_state_dir)
+        self.assertEqual(len(pool_branch_names), 2)
+
+        with HTTMock(self.auth_csv_example_allowed):
+            erica_email = u'erica@example.com'
+            with HTTMock(self.mock_persona_verify_erica):
+                erica = ChimeTestClient(self.app.test_client(), self)
+                erica.sign_in(erica_email)
+
+            # pool branches aren't activities
+            erica.open_link(constants.ROUTE_ACTIVITY)
+            for branch_name in pool_branch_names:
+                self.assertFalse(branch_name in erica.soup.text)
+
+            # saving changes claims a pool branch, with one push and without starting a new activity
+            erica.open_link(url='/browse/test-articles/test-topic/test-subtopic/test-article/index.{}'.format(constants.CONTENT_FILE_EXTENSION))
+            new_title = u'Mostly Hairless, Apart From Their Whiskers'
+            real_push_to_origin = repo_functions.push_to_origin
+            with patch('chime.repo_functions.push_to_origin', wraps=real_push_to_origin) as push_to_origin, \
+                 patch('chime.storage.user_task.push_to_origin', wraps=real_push_to_origin) as user_task_push_to_origin, \
+                 patch('chime.repo_functions.get_start_branch') as get_start_branch:
+                erica.edit_article(title_str=new_title, body_str=u'Their internal organs are visible through the skin.')
+            self.assertEqual(push_to_origin.call_count + user_task_push_to_origin.call_count, 1)
+            self.assertFalse(get_start_branch.called)
+
+            branch_name = erica.get_branch_name()
+            self.assertTrue(branch_name in pool_branch_names)
+            self.assertEqual(PATTERN_FLASH_SAVED_ARTICLE.format(title=new_title), erica.soup.find('li', class_='flash').text)
+            self.assertEqual(repo_functions.get_pool_branch_names(running_state_dir), pool_branch_names - set([branch_name]))
+
+            # the branch is an activity now, started by erica
+            task_metadata = repo_functions.get_task_metadata_for_branch(self.origin, branch_name)
+            self.assertEqual(task_metadata['author_email'], erica_email)
+            erica.open_link(constants.ROUTE_ACTIVITY)
+            self.assertTrue(task_metadata['task_description'] in erica.soup.text)
+
+            # adding a topic from browse view claims the other one
+            erica.open_link(url='/browse/test-articles/')
+            erica.add_category(u'Plants')
+            other_branch_name = erica.get_branch_name()
+            self.assertEqual(set([branch_name, other_branch_name]), pool_branch_names)
+            self.assertEqual(repo_functions.get_task_metadata_for_branch(self.origin, other_branch_name)['author_email'], erica_email)
+            self.assertIsNotNone(self.origin.branches[other_branch_name].commit.tree['test-articles/plants/index.{}'.format(constants.CONTENT_FILE_EXTENSION)])
+
+            # the worker tops the pool back up
+            repo_functions.fill_activity_pool(self.origin, 'master', running_state_dir, size=2)
+            self.assertEqual(len(repo_functions.get_pool_branch_names(running_state_dir)), 2)
+            self.assertFalse(pool_branch_names & repo_functions.get_pool_branch_names(running_state_dir))
+
 class TestPublishApp (TestCase):
 
     def setUp(self):
@@ -3110,7 +3411,7 @@ class TestPublishApp (TestCase):
             return response(302, '', headers={'Location': 'https://codeload.github.com/chimecms/chime-starter/tar.gz/93250f1308daef66c5809fe87fc242d092e61db7'})
 
         if (host, path) == ('codeload.github.com', '/chimecms/chime-starter/tar.gz/93250f1308daef66c5809fe87fc242d092e61db7'):
-            with open(join(dirname(__file__), '93250f1308daef66c5809fe87fc242d092e61db7.zip')) as file:
+            with open(join(dirname(__file__), '..', '93250f1308daef66c5809fe87fc242d092e61db7.zip')) as file:
                 return response(200, file.read(), headers={'Content-Type': 'application/zip'})
 
         raise Exception('Unknown URL {}'.format(url.geturl()))
@@ -3139,10 +3440,98 @@ class TestPublishApp (TestCase):
             }
             '''
 
-        with HTTMock(self.mock_github_request):
+        with HTTMock(self.mock_github_request), \
+             patch.dict(publish_webhook_functions._built_shas, clear=True):
             response = self.client.post('/', data=payload)
+            publish_webhook_functions.wait_for_queued_commits()
+
+        self.assertEqual(response.status_code, 202)
+
+    # in TestPublishApp
+    def test_webhook_dedupes_commits(self):
+        ''' Webhooks are answered before the build, and each commit is built once.
+        '''
+        sha = '93250f1308daef66c5809fe87fc242d092e61db7'
+        payload = json.dumps({'commits': [{'sha': sha, 'url': 'https://github.com/chimecms/chime-starter/commit/{}'.format(sha)}]})
+        build_may_finish, built_dirs = Event(), []
+
+        def fake_build_jekyll_site(dirname):
+            build_may_finish.wait(10)
+            built_dirs.append(listdir(dirname))
+            return dirname
+
+        with HTTMock(self.mock_github_request), \
+             patch.dict(publish_webhook_functions._built_shas, clear=True), \
+             patch('chime.publish.functions.build_jekyll_site', side_effect=fake_build_jekyll_site):
+            # Github sends the webhook again while the first build is still going
+            response1 = self.client.post('/', data=payload)
+            response2 = self.client.post('/', data=payload)
+            build_may_finish.set()
+            publish_webhook_functions.wait_for_queued_commits()
+
+            # and once more after it's done
+            response3 = self.client.post('/', data=payload)
+            publish_webhook_functions.wait_for_queued_commits()
+
+        self.assertEqual([response1.status_code, response2.status_code, response3.status_code], [202, 202, 202])
+        self.assertTrue(response1.data.startswith('Building'))
+        self.assertTrue(response2.data.startswith('Already building'))
+        self.assertTrue(response3.data.startswith('Already built'))
+        self.assertEqual(built_dirs, [['ceviche-starter-{}'.format(sha)]])
+
+    # in TestPublishApp
+    def test_built_commits_are_bounded(self):
+        ''' Only the most recently seen built commits are remembered.
+        '''
+        with patch.dict(publish_webhook_functions._built_shas, clear=True), \
+             patch('chime.publish.functions.BUILT_COMMITS_REMEMBERED', 2):
+            publish_webhook_functions._remember_built_sha('aaa')
+            publish_webhook_functions._remember_built_sha('bbb')
+
+            # a repeated webhook makes a commit the most recently seen
+            self.assertFalse(publish_webhook_functions.queue_remote_commit('https://github.com/chimecms/chime-starter/commit/aaa', 'aaa'))
+            publish_webhook_functions._remember_built_sha('ccc')
+
+            self.assertEqual(list(publish_webhook_functions._built_shas), ['aaa', 'ccc'])
+            self.assertFalse(publish_webhook_functions.commit_was_built('bbb'))
+
+    # in TestPublishApp
+    def test_archive_commit(self):
+        ''' Built sites are zipped in walk order, without compressing images again.
+        '''
+        built_dir = mkdtemp(prefix='chime-built-')
+        mkdir(join(built_dir, 'img'))
+        contents = {
+            'index.html': '<p>Hello, world.</p>\n' * 500,
+            'about/index.html': '<p>About us.</p>\n' * 500,
+            'img/logo.png': ''.join([chr(random.randrange(256)) for i in range(10000)]),
+            'empty.txt': ''
+        }
 
-        self.assertTrue(response.status_code in range(200, 299))
+        for (path, content) in contents.items():
+            if not isdir(join(built_dir, dirname(path))):
+                mkdir(join(built_dir, dirname(path)))
+            with open(join(built_dir, path), 'wb') as file:
+                file.write(content)
+
+        with patch('chime.publish.functions.logger') as logger:
+            zip = publish_webhook_functions.archive_commit(built_dir, spool_size=1024)
+
+        self.assertIsNone(zip.testzip())
+        self.assertEqual(dict([(name, zip.read(name)) for name in zip.namelist()]), contents)
+        self.assertEqual(zip.getinfo('img/logo.png').compress_type, ZIP_STORED)
+        self.assertEqual(zip.getinfo('index.html').compress_type, ZIP_DEFLATED)
+        self.assertTrue(zip.getinfo('index.html').compress_size < len(contents['index.html']))
+
+        # the archive went to disk, and metrics were logged instead of printed
+        self.assertTrue(zip.fp._rolled)
+        metrics = logger.info.call_args[1]['extra']['metrics']
+        self.assertEqual((metrics['files'], metrics['stored_files']), (4, 1))
+        self.assertEqual(metrics['bytes'], sum(map(len, contents.values())))
+
+        # entries are in walk order, whether they were stored or deflated
+        walked = [relpath(join(dirpath, name), built_dir) for (dirpath, _, names) in walk(built_dir) for name in sorted(names)]
+        self.assertEqual(zip.namelist(), walked)
 
     # in TestPublishApp
     def test_load(self):
@@ -4,26 +4,32 @@ from __future__ import absolute_import
 from unittest import main, TestCase
 
 from tempfile import mkdtemp
-from os.path import join, exists, dirname, isdir, abspath, realpath
+from os.path import join, exists, dirname, isdir, abspath, realpath, getsize, samefile, basename
 from urllib import quote
-from os import environ
+from os import environ, chmod, remove, mkdir, makedirs, listdir, rename
 from shutil import rmtree, copytree
 from uuid import uuid4
 import sys
 from chime.repo_functions import ChimeRepo
+from chime.simple_flock import SimpleFlock
 from slugify import slugify
 import json
 import logging
 import tempfile
+import tarfile
+import zipfile
+from io import BytesIO
+from gzip import GzipFile
 logging.disable(logging.CRITICAL)
 
 repo_root = abspath(join(dirname(__file__), '..'))
 sys.path.insert(0, repo_root)
 
 from git.cmd import GitCommandError
+from mock import patch, Mock
 from box.util.rotunicode import RotUnicode
 
-from chime import jekyll_functions, repo_functions, edit_functions, view_functions
+from chime import jekyll_functions, repo_functions, edit_functions, view_functions, import_functions, publish_functions, publish
 from chime import constants
 from chime import chime_activity
 
@@ -91,6 +97,442 @@ class TestRepo (TestCase):
         branch_names = [b.name for b in self.origin.branches]
         self.assertEqual(set(branch_names), set(['master', 'title', 'body']))
 
+    # in TestRepo
+    def test_start_branch_pushes_once(self):
+        ''' A new branch and its task metadata go to origin in one push, without a checkout.
+        '''
+        active_branch_name = self.clone1.active_branch.name
+        head_hexsha = self.clone1.head.commit.hexsha
+        task_description = u'Écrire un article'
+
+        with patch('chime.repo_functions.push_to_origin', wraps=repo_functions.push_to_origin) as push_to_origin, \
+             patch('chime.repo_functions.get_existing_branch') as get_existing_branch:
+            branch1 = repo_functions.get_start_branch(self.clone1, 'master', task_description, u'erica@example.com')
+
+        self.assertEqual(push_to_origin.call_count, 1)
+        self.assertFalse(get_existing_branch.called)
+
+        # the working directory wasn't touched
+        self.assertEqual(self.clone1.active_branch.name, active_branch_name)
+        self.assertEqual(self.clone1.head.commit.hexsha, head_hexsha)
+        self.assertFalse(exists(join(self.clone1.working_dir, repo_functions.TASK_METADATA_FILENAME)))
+
+        # the branch starts with one task metadata commit on top of master
+        commit = self.origin.branches[branch1.name].commit
+        self.assertEqual(commit.hexsha, branch1.commit.hexsha)
+        self.assertEqual(commit.parents[0].hexsha, self.origin.branches['master'].commit.hexsha)
+        self.assertEqual(commit.message.split('\n')[0], u'The "{}" {}'.format(task_description, repo_functions.ACTIVITY_CREATED_MESSAGE))
+        task_metadata = repo_functions.get_task_metadata_for_branch(self.clone1, branch1.name)
+        self.assertEqual(task_metadata, dict(author_email=u'erica@example.com', task_description=task_description, branch_name=branch1.name))
+
+    # in TestRepo
+    def test_activity_pool(self):
+        ''' Pool branches are claimed, given back unused, and kept up with the default branch.
+        '''
+        running_state_dir = mkdtemp(prefix='chime-running-state-')
+        repo_functions.fill_activity_pool(self.origin, 'master', running_state_dir, size=3)
+        pool_branch_names = repo_functions.get_pool_branch_names(running_state_dir)
+        master_hexsha = self.origin.branches['master'].commit.hexsha
+        pool_refs = repo_functions._get_pool_refs(self.origin)
+        self.assertEqual(pool_refs, dict([(branch_name, master_hexsha) for branch_name in pool_branch_names]))
+
+        # pool branches aren't real branches, so they aren't listed or pushed upstream
+        self.assertFalse(pool_branch_names & set([branch.name for branch in self.origin.branches]))
+
+        # claims don't overlap
+        branch_name1, hexsha1 = repo_functions.claim_pool_branch(running_state_dir)
+        branch_name2, _ = repo_functions.claim_pool_branch(running_state_dir)
+        branch_name3, _ = repo_functions.claim_pool_branch(running_state_dir)
+        self.assertEqual(set([branch_name1, branch_name2, branch_name3]), pool_branch_names)
+        self.assertEqual(hexsha1, master_hexsha)
+        self.assertEqual(repo_functions.claim_pool_branch(running_state_dir), (None, None))
+
+        # an unused branch goes back in the pool; a used one doesn't
+        self.clone1.git.fetch('origin')
+        self.clone1.create_head(branch_name2, commit=hexsha1).checkout()
+        self.clone1.index.commit(u'Used it')
+        repo_functions.push_to_origin(self.clone1, [branch_name2])
+        repo_functions.release_pool_branch(self.clone1, running_state_dir, branch_name1)
+        repo_functions.release_pool_branch(self.clone1, running_state_dir, branch_name2)
+        self.assertEqual(repo_functions.get_pool_branch_names(running_state_dir), set([branch_name1, branch_name3]))
+        self.assertEqual(repo_functions.claim_pool_branch(running_state_dir)[0], branch_name1)
+        repo_functions.release_pool_branch(self.clone1, running_state_dir, branch_name1)
+
+        # the worker moves unclaimed branches along with master and tops up the pool
+        self.clone1.git.checkout('master')
+        self.clone1.index.commit(u'Moved master')
+        repo_functions.push_to_origin(self.clone1, ['master'])
+        master_hexsha = self.origin.branches['master'].commit.hexsha
+        repo_functions.fill_activity_pool(self.origin, 'master', running_state_dir, size=3)
+        pool_branch_names = repo_functions.get_pool_branch_names(running_state_dir)
+        self.assertEqual(len(pool_branch_names), 4)
+        self.assertFalse(branch_name2 in pool_branch_names)
+        pool_refs = repo_functions._get_pool_refs(self.origin)
+        self.assertEqual(set(pool_refs), pool_branch_names)
+        self.assertEqual(pool_refs[branch_name1], master_hexsha)
+        self.assertNotEqual(pool_refs[branch_name3], master_hexsha)
+        self.assertNotEqual(self.origin.branches[branch_name2].commit.hexsha, master_hexsha)
+
+    # in TestRepo
+    def test_activity_pool_claims_and_races(self):
+        ''' Timed-out claims aren't handed out again, another worker's new ref is skipped, and size zero empties the pool.
+        '''
+        running_state_dir = mkdtemp(prefix='chime-running-state-')
+        master_hexsha = self.origin.branches['master'].commit.hexsha
+
+        # the pool is off by default
+        repo_functions.fill_activity_pool(self.origin, 'master', running_state_dir)
+        self.assertEqual(repo_functions.get_pool_branch_names(running_state_dir), set())
+
+        # another worker makes a ref with the first name before this one can
+        branch_names = ['raced', 'fresh1', 'fresh2']
+
+        def fake_make_branch_name():
+            branch_name = branch_names.pop(0)
+            if branch_name == 'raced':
+                self.origin.git.update_ref(repo_functions._pool_ref(branch_name), master_hexsha)
+            return branch_name
+
+        with patch('chime.repo_functions.make_branch_name', side_effect=fake_make_branch_name):
+            repo_functions.fill_activity_pool(self.origin, 'master', running_state_dir, size=2)
+
+        self.assertEqual(repo_functions.get_pool_branch_names(running_state_dir), set(['fresh1', 'fresh2']))
+
+        # a claim that timed out may have unpushed task metadata, so it's dropped instead of handed out again
+        branch_name, _ = repo_functions.claim_pool_branch(running_state_dir)
+
+        with patch('chime.repo_functions.ACTIVITY_POOL_CLAIM_TIMEOUT', -1):
+            repo_functions.fill_activity_pool(self.origin, 'master', running_state_dir, size=2)
+
+        pool_branch_names = repo_functions.get_pool_branch_names(running_state_dir)
+        self.assertFalse(branch_name in pool_branch_names)
+        self.assertFalse(branch_name in repo_functions._get_pool_refs(self.origin))
+        self.assertEqual(len(pool_branch_names), 2)
+
+        # turning the pool off empties it
+        repo_functions.fill_activity_pool(self.origin, 'master', running_state_dir, size=0)
+        self.assertEqual(repo_functions.get_pool_branch_names(running_state_dir), set())
+        self.assertEqual(repo_functions._get_pool_refs(self.origin), {'raced': master_hexsha})
+
+    # in TestRepo
+    def test_publish_jobs(self):
+        ''' Publish jobs are run from the origin by the worker, and retried when they fail.
+        '''
+        running_state_dir = mkdtemp(prefix='chime-running-state-')
+        publish_path = mkdtemp(prefix='chime-publish-path-')
+        master_hexsha = self.origin.branches['master'].commit.hexsha
+
+        built_file_names = []
+
+        def fake_build_jekyll_site(dirname, shards=1):
+            built_file_names.extend(listdir(dirname))
+            mkdir(join(dirname, '_site'))
+            open(join(dirname, '_site', 'index.html'), 'w').close()
+            return join(dirname, '_site')
+
+        # only the newest queued job for a publish path gets run
+        job1 = publish_functions.queue_publish_job(running_state_dir, master_hexsha, publish_path, u'first')
+        job2 = publish_functions.queue_publish_job(running_state_dir, master_hexsha, publish_path, u'second')
+        self.assertEqual(publish_functions.get_publish_job_for_branch(running_state_dir, u'second')['state'], publish_functions.JOB_STATE_QUEUED)
+
+        with patch('chime.publish_functions.build_jekyll_site', side_effect=fake_build_jekyll_site):
+            self.assertEqual(publish_functions.run_publish_jobs(self.origin, running_state_dir), 1)
+
+        self.assertTrue('index.md' in built_file_names)
+        self.assertTrue(exists(join(publish_path, 'index.html')))
+        self.assertEqual(publish_functions.get_live_release(publish_path), master_hexsha)
+        self.assertFalse(exists(join(self.origin.git_dir, 'index')))
+        jobs = dict([(job['id'], job) for job in publish_functions.get_publish_jobs(running_state_dir)])
+        self.assertEqual(jobs[job1['id']]['state'], publish_functions.JOB_STATE_SUPERSEDED)
+        self.assertEqual(jobs[job2['id']]['state'], publish_functions.JOB_STATE_DONE)
+
+        # failed jobs wait to be tried again, and give up after the last attempt
+        job3 = publish_functions.queue_publish_job(running_state_dir, master_hexsha, publish_path, u'third')
+
+        with patch('chime.publish_functions.build_jekyll_site', side_effect=Exception(u'Jekyll broke')):
+            self.assertEqual(publish_functions.run_publish_jobs(self.origin, running_state_dir), 1)
+            self.assertEqual(publish_functions.run_publish_jobs(self.origin, running_state_dir), 0)
+
+            job3 = publish_functions.get_publish_job_for_branch(running_state_dir, u'third')
+            self.assertEqual((job3['state'], job3['attempts'], job3['error']), (publish_functions.JOB_STATE_QUEUED, 1, u'Jekyll broke'))
+
+            # the last two attempts are made once the wait is over
+            with patch('chime.publish_functions.PUBLISH_JOB_RETRY_DELAY', 0), \
+                 patch('chime.publish_functions.time', return_value=job3['retry_after'] + 1):
+                self.assertEqual(publish_functions.run_publish_jobs(self.origin, running_state_dir), 2)
+
+        job3 = publish_functions.get_publish_job_for_branch(running_state_dir, u'third')
+        self.assertEqual((job3['state'], job3['attempts']), (publish_functions.JOB_STATE_FAILED, publish_functions.PUBLISH_JOB_MAX_ATTEMPTS))
+
+        # a job without a publish path could never succeed, so it isn't queued
+        with self.assertRaises(ValueError):
+            publish_functions.queue_publish_job(running_state_dir, master_hexsha, None, u'fourth')
+
+        self.assertIsNone(publish_functions.get_publish_job_for_branch(running_state_dir, u'fourth'))
+
+    # in TestRepo
+    def test_failed_build_keeps_live_release(self):
+        ''' A Jekyll build that exits with an error fails its job, even if it left a site behind.
+        '''
+        running_state_dir = mkdtemp(prefix='chime-running-state-')
+        publish_path = mkdtemp(prefix='chime-publish-path-')
+        master_hexsha = self.origin.branches['master'].commit.hexsha
+        exit_codes = []
+
+        def fake_start_jekyll(dirname):
+            # Jekyll wrote one page, then crashed
+            mkdir(join(dirname, '_site'))
+            open(join(dirname, '_site', 'index.html'), 'w').close()
+            return Mock(**{'wait.return_value': exit_codes.pop(0)})
+
+        exit_codes.append(0)
+        publish_functions.queue_publish_job(running_state_dir, master_hexsha, publish_path, u'first')
+
+        with patch('chime.jekyll_functions._start_jekyll', side_effect=fake_start_jekyll):
+            publish_functions.run_publish_jobs(self.origin, running_state_dir)
+
+        self.assertEqual(publish_functions.get_live_release(publish_path), master_hexsha)
+
+        self.clone1.git.checkout('master')
+        with open(join(self.clone1.working_dir, 'index.md'), 'a') as file:
+            file.write('\n\nMore.\n')
+        self.clone1.git.add('index.md')
+        self.clone1.index.commit(u'Changed a page')
+        repo_functions.push_to_origin(self.clone1, ['master'])
+        page_hexsha = self.origin.branches['master'].commit.hexsha
+
+        exit_codes.extend([1] * publish_functions.PUBLISH_JOB_MAX_ATTEMPTS)
+        publish_functions.queue_publish_job(running_state_dir, page_hexsha, publish_path, u'second')
+
+        with patch('chime.jekyll_functions._start_jekyll', side_effect=fake_start_jekyll), \
+             patch('chime.publish_functions.PUBLISH_JOB_RETRY_DELAY', 0):
+            # without a delay, every attempt is made at once
+            self.assertEqual(publish_functions.run_publish_jobs(self.origin, running_state_dir), publish_functions.PUBLISH_JOB_MAX_ATTEMPTS)
+
+        job = publish_functions.get_publish_job_for_branch(running_state_dir, u'second')
+        self.assertEqual((job['state'], job['attempts']), (publish_functions.JOB_STATE_FAILED, publish_functions.PUBLISH_JOB_MAX_ATTEMPTS))
+        self.assertTrue(job['error'].startswith(u'Jekyll failed'))
+        self.assertEqual(publish_functions.get_live_release(publish_path), master_hexsha)
+        self.assertEqual(exit_codes, [])
+
+    # in TestRepo
+    def test_releases_and_rollback(self):
+        ''' Each release gets its own directory, and the publish path is switched between them.
+        '''
+        publish_path = join(mkdtemp(prefix='chime-publish-'), 'site')
+        hexshas = [str(uuid4()) for i in range(4)]
+
+        for hexsha in hexshas:
+            built_dir = publish_functions.make_release_staging_dir(publish_path, '.build-')
+            with open(join(built_dir, 'index.html'), 'w') as file:
+                file.write(hexsha)
+            publish_functions.make_release(built_dir, publish_path, hexsha, kept=3)
+            self.assertFalse(exists(built_dir))
+
+        with open(join(publish_path, 'index.html')) as file:
+            self.assertEqual(file.read(), hexshas[-1])
+
+        # only the newest releases are kept
+        releases_dir = publish_functions.get_releases_dir(publish_path)
+        self.assertEqual([release['hexsha'] for release in publish_functions.get_releases(publish_path)], list(reversed(hexshas[1:])))
+        self.assertFalse(exists(join(releases_dir, hexshas[0])))
+
+        # roll back to the previous release, then to a chosen one
+        self.assertEqual(publish_functions.rollback_release(publish_path), hexshas[2])
+        with open(join(publish_path, 'index.html')) as file:
+            self.assertEqual(file.read(), hexshas[2])
+
+        publish_functions.rollback_release(publish_path, hexshas[3])
+        self.assertEqual(publish_functions.get_live_release(publish_path), hexshas[3])
+
+        with self.assertRaises(ValueError):
+            publish_functions.rollback_release(publish_path, hexshas[0])
+
+        # releasing the live commit again leaves it alone
+        built_dir = publish_functions.make_release_staging_dir(publish_path, '.build-')
+        publish_functions.make_release(built_dir, publish_path, hexshas[3], kept=3)
+        self.assertTrue(exists(built_dir))
+        self.assertEqual([release['hexsha'] for release in publish_functions.get_releases(publish_path)], list(reversed(hexshas[1:])))
+
+    # in TestRepo
+    def test_release_commit(self):
+        ''' A commit is streamed out of git, built in place, and moved into a live release.
+        '''
+        running_dir = mkdtemp(prefix='chime-running-')
+        master_hexsha = self.origin.branches['master'].commit.hexsha
+
+        def fake_build_jekyll_site(dirname, shards=1):
+            # the build happens next to the releases, so its output can be moved
+            self.assertEqual(realpath(join(dirname, '..')), publish_functions.get_releases_dir(join(running_dir, 'master')))
+            rename(join(dirname, 'index.md'), join(dirname, 'index.html'))
+            copytree(dirname, join(dirname, '_site'))
+            return join(dirname, '_site')
+
+        with patch('chime.publish_functions.build_jekyll_site', side_effect=fake_build_jekyll_site):
+            publish.release_commit(running_dir, self.origin, 'master')
+
+        self.assertEqual(publish_functions.get_live_release(join(running_dir, 'master')), master_hexsha)
+        self.assertTrue(exists(join(running_dir, 'master', 'index.html')))
+        self.assertTrue(isdir(join(running_dir, 'master', 'test-articles')))
+
+        # nothing but the release, its manifest, and the list of releases is left behind
+        releases_dir = publish_functions.get_releases_dir(join(running_dir, 'master'))
+        manifest_name = publish_functions.RELEASE_MANIFEST_PATTERN.format(hexsha=master_hexsha)
+        self.assertEqual(sorted(listdir(releases_dir)), sorted([master_hexsha, manifest_name, publish_functions.RELEASES_FILE]))
+
+    # in TestRepo
+    def test_publish_static_changes(self):
+        ''' Releases with only static file changes are made from the live release without Jekyll.
+        '''
+        publish_path = join(mkdtemp(prefix='chime-publish-'), 'site')
+        old_hexsha = self.origin.branches['master'].commit.hexsha
+
+        def fake_build_jekyll_site(dirname, shards=1):
+            copytree(dirname, join(dirname, '_site'))
+            return join(dirname, '_site')
+
+        with patch('chime.publish_functions.build_jekyll_site', side_effect=fake_build_jekyll_site):
+            publish_functions.publish_commit(self.origin, publish_path, old_hexsha)
+
+        manifest = publish_functions.load_manifest(publish_path, old_hexsha)
+        self.assertEqual(manifest['index.md'], publish_functions.hash_file(join(publish_path, 'index.md')))
+
+        # change an image and a stylesheet in place
+        self.clone1.git.checkout('master')
+        with open(join(self.clone1.working_dir, 'img', 'logo_merriweather.png'), 'wb') as file:
+            file.write('not really a png')
+        with open(join(self.clone1.working_dir, 'css', 'main.css'), 'w') as file:
+            file.write('body { color: black; }\n')
+        self.clone1.git.add('img', 'css')
+        self.clone1.index.commit(u'Changed static files')
+        repo_functions.push_to_origin(self.clone1, ['master'])
+        static_hexsha = self.origin.branches['master'].commit.hexsha
+
+        self.assertEqual(publish_functions.get_static_changes(self.origin, old_hexsha, static_hexsha),
+                         [u'css/main.css', u'img/logo_merriweather.png'])
+
+        with patch('chime.publish_functions.build_jekyll_site') as build_jekyll_site:
+            publish_functions.publish_commit(self.origin, publish_path, static_hexsha)
+
+        self.assertFalse(build_jekyll_site.called)
+        self.assertEqual(publish_functions.get_live_release(publish_path), static_hexsha)
+        with open(join(publish_path, 'css', 'main.css')) as file:
+            self.assertEqual(file.read(), 'body { color: black; }\n')
+
+        # unchanged files are shared with the old release, changed ones aren't
+        old_dir = join(publish_functions.get_releases_dir(publish_path), old_hexsha)
+        self.assertTrue(samefile(join(publish_path, 'index.md'), join(old_dir, 'index.md')))
+        self.assertFalse(samefile(join(publish_path, 'img', 'logo_merriweather.png'), join(old_dir, 'img', 'logo_merriweather.png')))
+        release_manifest = publish_functions.make_manifest(realpath(publish_path))
+        release_manifest = dict([(path, hash) for (path, hash) in release_manifest.items() if not path.endswith(('.gz', '.br'))])
+        self.assertEqual(publish_functions.load_manifest(publish_path, static_hexsha), release_manifest)
+
+        # adding or removing a static file changes site.static_files, so the site is built again
+        mkdir(join(self.clone1.working_dir, 'js'))
+        with open(join(self.clone1.working_dir, 'js', 'site.js'), 'w') as file:
+            file.write('alert("Hello");\n')
+        self.clone1.git.add('js')
+        self.clone1.index.commit(u'Added a script')
+        self.clone1.git.rm('css/main.css')
+        self.clone1.index.commit(u'Removed a stylesheet')
+        repo_functions.push_to_origin(self.clone1, ['master'])
+        removed_hexsha = self.origin.branches['master'].commit.hexsha
+        added_hexsha = self.origin.commit(removed_hexsha).parents[0].hexsha
+
+        self.assertIsNone(publish_functions.get_static_changes(self.origin, static_hexsha, added_hexsha))
+        self.assertIsNone(publish_functions.get_static_changes(self.origin, added_hexsha, removed_hexsha))
+
+        with patch('chime.publish_functions.build_jekyll_site', side_effect=fake_build_jekyll_site) as build_jekyll_site:
+            publish_functions.publish_commit(self.origin, publish_path, removed_hexsha)
+
+        self.assertTrue(build_jekyll_site.called)
+        self.assertEqual(publish_functions.get_live_release(publish_path), removed_hexsha)
+        self.assertFalse(exists(join(publish_path, 'css', 'main.css')))
+
+        # changing a page means building the whole site
+        with open(join(self.clone1.working_dir, 'index.md'), 'a') as file:
+            file.write('\n\nMore.\n')
+        self.clone1.git.add('index.md')
+        self.clone1.index.commit(u'Changed a page')
+        repo_functions.push_to_origin(self.clone1, ['master'])
+        page_hexsha = self.origin.branches['master'].commit.hexsha
+
+        self.assertIsNone(publish_functions.get_static_changes(self.origin, removed_hexsha, page_hexsha))
+
+        with patch('chime.publish_functions.build_jekyll_site', side_effect=fake_build_jekyll_site) as build_jekyll_site:
+            publish_functions.publish_commit(self.origin, publish_path, page_hexsha)
+
+        self.assertTrue(build_jekyll_site.called)
+        self.assertEqual(publish_functions.get_live_release(publish_path), page_hexsha)
+
+        # so does a page losing its front matter, because its rendered copy goes away
+        with open(join(self.clone1.working_dir, 'index.md'), 'w') as file:
+            file.write('Just a file now.\n')
+        self.clone1.git.add('index.md')
+        self.clone1.index.commit(u'Made a page plain')
+        repo_functions.push_to_origin(self.clone1, ['master'])
+        plain_hexsha = self.origin.branches['master'].commit.hexsha
+
+        self.assertIsNone(publish_functions.get_static_changes(self.origin, page_hexsha, plain_hexsha))
+
+    # in TestRepo
+    def test_precompress_release(self):
+        ''' Text files in a release get compressed copies, made again only when they change.
+        '''
+        publish_path = join(mkdtemp(prefix='chime-publish-'), 'site')
+        stylesheet = 'body { color: black; }\n' * 100
+
+        def make_release(hexsha, page):
+            built_dir = publish_functions.make_release_staging_dir(publish_path, '.build-')
+            mkdir(join(built_dir, 'css'))
+            for (path, content) in (('index.html', page), ('css/main.css', stylesheet), ('tiny.txt', 'Hi'), ('logo.png', stylesheet)):
+                with open(join(built_dir, path), 'w') as file:
+                    file.write(content)
+            publish_functions.make_release(built_dir, publish_path, hexsha)
+            return join(publish_functions.get_releases_dir(publish_path), hexsha)
+
+        old_dir = make_release('abc', '<p>Hello</p>\n' * 100)
+
+        with GzipFile(join(publish_path, 'css', 'main.css.gz')) as file:
+            self.assertEqual(file.read(), stylesheet)
+
+        self.assertTrue(exists(join(publish_path, 'index.html.gz')))
+        self.assertFalse(exists(join(publish_path, 'tiny.txt.gz')))
+        self.assertFalse(exists(join(publish_path, 'logo.png.gz')))
+        self.assertEqual(exists(join(publish_path, 'index.html.br')), publish_functions.brotli is not None)
+
+        # the unchanged stylesheet's copy is shared, and the changed page's isn't
+        with patch('chime.publish_functions._compress_file', wraps=publish_functions._compress_file) as compress_file:
+            new_dir = make_release('def', '<p>Goodbye</p>\n' * 100)
+
+        self.assertEqual([basename(call[0][0]) for call in compress_file.call_args_list], ['index.html'])
+        self.assertTrue(samefile(join(new_dir, 'css', 'main.css.gz'), join(old_dir, 'css', 'main.css.gz')))
+
+        with GzipFile(join(new_dir, 'index.html.gz')) as file:
+            self.assertEqual(file.read(), '<p>Goodbye</p>\n' * 100)
+        with GzipFile(join(old_dir, 'index.html.gz')) as file:
+            self.assertEqual(file.read(), '<p>Hello</p>\n' * 100)
+
+    # in TestRepo
+    def test_checkout_cache_eviction(self):
+        ''' Cached commit archives are removed least-recently-used first, but never the newest.
+        '''
+        running_dir = mkdtemp(prefix='chime-running-')
+        master_path, _ = publish.retrieve_commit_checkout(running_dir, self.origin, 'master')
+        title_path, _ = publish.retrieve_commit_checkout(running_dir, self.origin, 'title')
+        self.assertTrue(exists(master_path) and exists(title_path))
+
+        # using an archive again makes it the last one to go
+        publish.retrieve_commit_checkout(running_dir, self.origin, 'master')
+        body_path, _ = publish.retrieve_commit_checkout(running_dir, self.origin, 'body', cache_size=getsize(master_path) + getsize(title_path))
+        self.assertFalse(exists(title_path))
+        self.assertTrue(exists(master_path) and exists(body_path))
+
+        body_path, _ = publish.retrieve_commit_checkout(running_dir, self.origin, 'body', cache_size=1)
+        self.assertTrue(exists(body_path))
+        publish.retrieve_commit_checkout(running_dir, self.origin, 'title', cache_size=1)
+        self.assertEqual(len(listdir(join(running_dir, publish.CHECKOUTS_DIRNAME))), 1)
+
     # in TestRepo
     def test_get_start_branch(self):
         ''' Make a simple edit in a clone, verify that it appears in the other.
@@ -610,6 +1052,76 @@ class TestRepo (TestCase):
         self.assertEqual(diffs[1].a_blob.name, 'conflict.md')
         self.assertEqual(diffs[1].b_blob.name, 'conflict.md')
 
+    # in TestRepo
+    def test_conflict_found_without_working_tree(self):
+        ''' Test that a conflict is found without merging in the working tree.
+        '''
+        fake_author_email = u'erica@example.com'
+        task_description1, task_description2 = str(uuid4()), str(uuid4())
+        branch1 = repo_functions.get_start_branch(self.clone1, 'master', task_description1, fake_author_email)
+        branch2 = repo_functions.get_start_branch(self.clone2, 'master', task_description2, fake_author_email)
+        branch1.checkout()
+        branch2.checkout()
+
+        #
+        # Make conflicting files in each branch, and merge the first to master.
+        #
+        edit_functions.create_new_page(self.clone1, '', 'conflict.md', dict(title='Hello'), 'Hello hello.')
+        repo_functions.save_working_file(self.clone1, 'conflict.md', '...', branch1.commit.hexsha, 'master')
+        repo_functions.complete_branch(self.clone1, 'master', branch1.name)
+
+        edit_functions.create_new_page(self.clone2, '', 'conflict.md', dict(title='Goodbye'), 'Goodbye goodbye.')
+        repo_functions.save_working_file(self.clone2, 'conflict.md', '...', branch2.commit.hexsha, 'master')
+
+        #
+        # Look for the conflict from the default branch, with the branch's origin copy.
+        #
+        self.clone2.branches['master'].checkout()
+        head_hexsha = self.clone2.commit().hexsha
+        conflict = repo_functions.get_conflict(self.clone2, 'master', branch2.name)
+
+        self.assertTrue(bool(conflict))
+        self.assertEqual(conflict.local_commit, self.clone2.refs['origin/' + branch2.name].commit)
+        self.assertEqual(self.clone2.commit().hexsha, head_hexsha)
+        self.assertFalse(self.clone2.is_dirty())
+
+        # older versions of git get the same answer without merge-tree
+        args = self.clone2, conflict.local_commit.hexsha, conflict.remote_commit.hexsha
+        self.assertTrue(repo_functions.index_merge_conflicted(*args))
+
+        # the local default branch hasn't seen the first branch's merge
+        self.assertFalse(repo_functions.index_merge_conflicted(self.clone2, branch2.commit.hexsha, head_hexsha))
+
+        # the answer is remembered for the same pair of commits
+        repo_functions._conflict_cache[args[1:]] = False
+        self.assertIsNone(repo_functions.get_conflict(self.clone2, 'master', branch2.name))
+
+    # in TestRepo
+    def test_conflicted_branch_names_are_merged(self):
+        ''' Checking some branches keeps the saved answers for the others.
+        '''
+        fake_author_email = u'erica@example.com'
+        branch1 = repo_functions.get_start_branch(self.clone1, 'master', str(uuid4()), fake_author_email)
+        branch2 = repo_functions.get_start_branch(self.clone1, 'master', str(uuid4()), fake_author_email)
+        running_state_dir = mkdtemp(prefix='chime-running-state-')
+        self.assertNotEqual(branch1.commit.hexsha, branch2.commit.hexsha)
+
+        # the worker checks every branch, then the app checks one
+        repo_functions.get_conflicted_branch_names(self.clone1, 'master', running_state_dir)
+        repo_functions.get_conflicted_branch_names(self.clone1, 'master', running_state_dir, [branch1.name])
+
+        with open(join(running_state_dir, repo_functions.CONFLICTS_FILE)) as file:
+            conflicts = json.load(file)['conflicts']
+
+        self.assertTrue(branch1.commit.hexsha in conflicts)
+        self.assertTrue(branch2.commit.hexsha in conflicts)
+
+        # nothing is merged again for the worker's next check
+        with patch('chime.repo_functions.get_merge_conflicted') as get_merge_conflicted:
+            self.assertEqual(repo_functions.get_conflicted_branch_names(self.clone1, 'master', running_state_dir), set())
+
+        self.assertFalse(get_merge_conflicted.called)
+
     # in TestRepo
     def test_upstream_push_conflict(self):
         ''' Test that a conflict in two branches appears at the right spot.
@@ -890,6 +1402,172 @@ class TestRepo (TestCase):
         self.assertFalse(branch1_name in self.origin.branches)
         self.assertFalse(branch1_name in self.clone1.branches)
 
+    # in TestRepo
+    def test_publish_is_all_or_nothing(self):
+        ''' A publish that origin refuses leaves no trace in origin or the clone.
+        '''
+        fake_author_email = u'erica@example.com'
+        task_description = str(uuid4())
+        branch1 = repo_functions.get_start_branch(self.clone1, 'master', task_description, fake_author_email)
+        branch1_name = branch1.name
+        branch1.checkout()
+
+        edit_functions.create_new_page(self.clone1, '', 'refused.md', dict(title='Refused'), 'Not today.')
+        repo_functions.save_working_file(self.clone1, 'refused.md', '...', branch1.commit.hexsha, 'master')
+        working_hexsha = branch1.commit.hexsha
+        master_hexsha = self.origin.branches['master'].commit.hexsha
+
+        # make origin refuse every push
+        hooks_path = join(self.origin.git_dir, 'hooks')
+        if not isdir(hooks_path):
+            mkdir(hooks_path)
+        hook_path = join(hooks_path, 'pre-receive')
+        with open(hook_path, 'w') as file:
+            file.write('#!/bin/sh\nexit 1\n')
+        chmod(hook_path, 0755)
+
+        with self.assertRaises(GitCommandError):
+            repo_functions.complete_branch(self.clone1, 'master', branch1_name)
+
+        # origin is untouched
+        self.assertEqual(self.origin.branches['master'].commit.hexsha, master_hexsha)
+        self.assertEqual(self.origin.branches[branch1_name].commit.hexsha, working_hexsha)
+        self.assertFalse(branch1_name in self.origin.tags)
+
+        # and so is the clone
+        self.assertEqual(self.clone1.active_branch.name, branch1_name)
+        self.assertEqual(self.clone1.commit().hexsha, working_hexsha)
+        self.assertEqual(self.clone1.branches['master'].commit.hexsha, master_hexsha)
+        self.assertFalse(branch1_name in self.clone1.tags)
+
+        # once origin takes pushes again, the branch, tag, and default branch move together
+        remove(hook_path)
+        repo_functions.complete_branch(self.clone1, 'master', branch1_name)
+        self.assertFalse(branch1_name in self.origin.branches)
+        self.assertEqual(self.origin.tags[branch1_name].commit, self.origin.branches['master'].commit)
+
+    # in TestRepo
+    def test_pushes_take_turns_by_ref(self):
+        ''' A push waits for other pushes to the same origin ref, but not to other refs.
+        '''
+        fake_author_email = u'erica@example.com'
+        branch1 = repo_functions.get_start_branch(self.clone1, 'master', str(uuid4()), fake_author_email)
+        branch2 = repo_functions.get_start_branch(self.clone1, 'master', str(uuid4()), fake_author_email)
+        branch1.checkout()
+        self.clone1.index.commit(u'A change that needs pushing')
+
+        # every way of naming the branch waits on the same lock
+        lock_path = repo_functions._get_origin_lock_path(self.clone1, branch1.name)
+        self.assertEqual(repo_functions._get_origin_lock_path(self.clone1, 'abc123:refs/heads/{}'.format(branch1.name)), lock_path)
+        self.assertEqual(repo_functions._get_origin_lock_path(self.clone1, ':refs/heads/{}'.format(branch1.name)), lock_path)
+        self.assertNotEqual(repo_functions._get_origin_lock_path(self.clone1, branch2.name), lock_path)
+
+        old_timeout, repo_functions.ORIGIN_LOCK_TIMEOUT = repo_functions.ORIGIN_LOCK_TIMEOUT, .1
+        try:
+            with SimpleFlock(lock_path):
+                # someone else is pushing this branch
+                with self.assertRaises(IOError):
+                    repo_functions.push_to_origin(self.clone1, [branch1.name])
+                self.assertNotEqual(self.origin.branches[branch1.name].commit, branch1.commit)
+
+                # but other branches can go ahead
+                repo_functions.push_to_origin(self.clone1, [':refs/heads/{}'.format(branch2.name)])
+                self.assertFalse(branch2.name in self.origin.branches)
+        finally:
+            repo_functions.ORIGIN_LOCK_TIMEOUT = old_timeout
+
+        repo_functions.push_to_origin(self.clone1, [branch1.name])
+        self.assertEqual(self.origin.branches[branch1.name].commit, branch1.commit)
+
+    # in TestRepo
+    def test_transaction_syncs_and_pushes_once(self):
+        ''' Several commits made in a branch transaction are synced and pushed together.
+        '''
+        fake_author_email = u'erica@example.com'
+        branch1 = repo_functions.get_start_branch(self.clone1, 'master', str(uuid4()), fake_author_email)
+        branch1_name = branch1.name
+        branch1.checkout()
+        origin_hexsha = self.origin.branches[branch1_name].commit.hexsha
+
+        with patch('chime.repo_functions.sync_with_branch', wraps=repo_functions.sync_with_branch) as sync_with_branch, \
+             patch('chime.repo_functions.push_to_origin', wraps=repo_functions.push_to_origin) as push_to_origin:
+            with repo_functions.branch_transaction(self.clone1) as transaction:
+                repo_functions.provide_feedback(self.clone1, branch1_name, u'Looks good.')
+                repo_functions.save_task_metadata_for_branch(self.clone1, 'master', {'task_description': u'Renamed'})
+                repo_functions.update_review_state(self.clone1, branch1_name, constants.REVIEW_STATE_FEEDBACK)
+
+                # nothing has gone to origin yet
+                self.assertEqual(self.origin.branches[branch1_name].commit.hexsha, origin_hexsha)
+                self.assertIsNone(transaction['hexsha'])
+
+        self.assertEqual(sync_with_branch.call_count, 1)
+        self.assertEqual(push_to_origin.call_count, 1)
+
+        # all three commits arrived in origin at once, and the transaction knows which is last
+        self.assertEqual(self.origin.branches[branch1_name].commit.hexsha, self.clone1.commit().hexsha)
+        self.assertEqual(transaction['hexsha'], self.clone1.commit().hexsha)
+        messages = [commit.message for commit in self.origin.iter_commits(branch1_name, max_count=3)]
+        self.assertTrue(messages[0].startswith(repo_functions.REVIEW_STATE_COMMIT_PREFIX))
+        self.assertTrue(u'Renamed' in messages[1])
+        self.assertTrue(messages[2].startswith(repo_functions.COMMENT_COMMIT_PREFIX))
+
+    # in TestRepo
+    def test_import_archive_into_new_activity(self):
+        ''' A tar or zip of markdown files is imported into a new activity in one commit.
+        '''
+        source_path = mkdtemp(prefix='chime-import-source-')
+        files = {
+            'Ducks/index.md': '---\ntitle: All About Ducks\n---\nQuack.',
+            'Ducks/Mallard Ducks.md': 'Green heads.',
+            'Geese/Canada Geese.markdown': '---\ntitle: Honkers\nlayout: article\n---\nHonk.',
+            'Geese/Pictures/goose.jpg': 'not really a jpeg',
+            'Geese/.DS_Store': 'junk',
+        }
+        for (path, content) in files.items():
+            if not isdir(dirname(join(source_path, path))):
+                makedirs(dirname(join(source_path, path)))
+            with open(join(source_path, path), 'w') as file:
+                file.write(content)
+
+        archives_path = mkdtemp(prefix='chime-import-archives-')
+
+        try:
+            zip_path = join(archives_path, 'import.zip')
+            with zipfile.ZipFile(zip_path, 'w') as archive:
+                for path in files:
+                    archive.write(join(source_path, path), path)
+            self.assertEqual(set([path for (path, _, _) in import_functions.iter_source_files(zip_path)]), set(files))
+
+            tar_path = join(archives_path, 'import.tar.gz')
+            with tarfile.open(tar_path, 'w:gz') as archive:
+                archive.add(source_path, 'site')
+
+            master_hexsha = self.origin.branches['master'].commit.hexsha
+            branch_name = import_functions.import_new_activity(tar_path, self.origin.working_dir, self.work_path, u'erica@example.com', u'Import birds', 'master', u'other')
+
+            # the task metadata commit and the import commit are the only new commits
+            commit = self.origin.branches[branch_name].commit
+            self.assertEqual(commit.parents[0].parents[0].hexsha, master_hexsha)
+            self.assertTrue(commit.message.startswith(u'5 pages were imported'))
+
+            paths = set([blob.path for blob in commit.tree.traverse() if blob.type == 'blob'])
+            for path in ('other/site/index.markdown', 'other/site/ducks/index.markdown', 'other/site/ducks/mallard-ducks/index.markdown',
+                         'other/site/geese/index.markdown', 'other/site/geese/canada-geese/index.markdown', 'other/site/geese/pictures/goose.jpg'):
+                self.assertTrue(path in paths, path)
+            self.assertFalse('other/site/geese/.DS_Store' in paths)
+
+            def load(path):
+                return jekyll_functions.load_jekyll_doc(BytesIO(commit.tree[path].data_stream.read()))
+
+            self.assertEqual(load('other/site/ducks/index.markdown'), ({'title': u'All About Ducks', 'layout': constants.CATEGORY_LAYOUT, 'description': u'', 'order': 0}, u'Quack.'))
+            self.assertEqual(load('other/site/ducks/mallard-ducks/index.markdown'), ({'title': u'Mallard Ducks', 'layout': constants.ARTICLE_LAYOUT, 'description': u'', 'order': 0}, u'Green heads.'))
+            self.assertEqual(load('other/site/geese/canada-geese/index.markdown')[0]['title'], u'Honkers')
+            self.assertEqual(load('other/site/geese/index.markdown')[0], {'title': u'Geese', 'layout': constants.CATEGORY_LAYOUT, 'description': u'', 'order': 0})
+            self.assertEqual(commit.tree['other/site/geese/pictures/goose.jpg'].data_stream.read(), 'not really a jpeg')
+        finally:
+            rmtree(source_path)
+            rmtree(archives_path)
+
     # in TestRepo
     def test_article_creation_with_unicode(self):
         ''' An article with unicode in its title is created as expected.
@@ -1,18 +1,21 @@
 # -- coding: utf-8 --
 from __future__ import absolute_import
 
-from unittest import main, TestCase
+from unittest import main, TestCase, SkipTest
 
 from tempfile import mkdtemp
 from StringIO import StringIO
-from os.path import join, dirname, abspath, isfile
-from os import environ, remove
+from os.path import join, dirname, abspath, isfile, isdir, basename, relpath, exists
+from os import environ, remove, mkdir, makedirs, getpid, walk, listdir, devnull
+from subprocess import call
+import httplib
 from shutil import rmtree, copytree
 from uuid import uuid4
 import sys
 from chime.repo_functions import ChimeRepo
 import logging
 import tempfile
+import yaml
 logging.disable(logging.CRITICAL)
 
 repo_root = abspath(join(dirname(__file__), '..'))
@@ -20,6 +23,7 @@ sys.path.insert(0, repo_root)
 
 from box.util.rotunicode import RotUnicode
 from httmock import response, HTTMock
+from mock import patch, Mock
 
 from chime import (
     create_app, jekyll_functions, repo_functions, google_api_functions,
@@ -82,6 +86,137 @@ class TestJekyll (TestCase):
         self.assertEqual({}, actual_front)
         self.assertEqual(actual_body, expected_body)
 
+    def make_site_corpus(self):
+        ''' Return path to a small Jekyll site with categories, articles and static files.
+        '''
+        site_dir = mkdtemp(prefix='chime-jekyll-')
+
+        files = {
+            '_config.yml': 'title: Corpus\nexclude: [notes.txt]\n',
+            '_layouts/default.html': '<title>{{ site.title }}: {{ page.title }}</title>\n'
+                                     '{% for column in page.columns %}<ul>{{ column.title }}{% for p in column.pages %}<li>{{ p.title }}</li>{% endfor %}</ul>{% endfor %}\n'
+                                     '{% for crumb in page.breadcrumbs %}<a href="{{ crumb.link_path }}">{{ crumb.title }}</a>{% endfor %}\n'
+                                     '{{ content }}',
+            '_layouts/category.html': '---\nlayout: default\n---\n<h1>{{ page.title }}</h1>{{ content }}',
+            '_layouts/article.html': '---\nlayout: default\n---\n<h2>{{ page.title }}</h2>{{ content }}',
+            'index.html': '---\nlayout: default\ntitle: Home\n---\n{% for p in site.pages %}{{ p.url }} {% endfor %}',
+            'style.css': 'body { color: black }',
+            'notes.txt': 'Not published.'
+        }
+
+        for category in ('fish', 'birds', 'trees'):
+            files[category + '/index.markdown'] = '---\nlayout: category\ntitle: {}\n---\nAll about *{}*.'.format(category.title(), category)
+            files[category + '/photo.png'] = category * 100
+            for number in range(6):
+                files['{}/{}-{}/index.markdown'.format(category, category, number)] \
+                    = '---\nlayout: article\ntitle: {} {}\n---\nNumber **{}**.'.format(category.title(), number, number)
+
+        for (path, content) in files.items():
+            if not isdir(join(site_dir, dirname(path))):
+                makedirs(join(site_dir, dirname(path)))
+            with open(join(site_dir, path), 'w') as file:
+                file.write(content)
+
+        return site_dir
+
+    def test_build_in_shards(self):
+        ''' A site built in shards matches the same site built in one process.
+        '''
+        jekyll_script = join(dirname(jekyll_functions.__file__), '..', 'jekyll', 'run-jekyll.sh')
+        with open(devnull, 'w') as null:
+            if call([jekyll_script, '--version'], stdout=null, stderr=null) != 0:
+                raise SkipTest('Jekyll is not installed')
+
+        single_dir = self.make_site_corpus()
+        sharded_dir = join(mkdtemp(prefix='chime-jekyll-'), 'site')
+        copytree(single_dir, sharded_dir)
+
+        try:
+            single_site_dir = jekyll_functions.build_jekyll_site(single_dir)
+            sharded_site_dir = jekyll_functions.build_jekyll_site(sharded_dir, 3)
+
+            def read_site(site_dir):
+                contents = {}
+                for (dirpath, _, filenames) in walk(site_dir):
+                    for filename in filenames:
+                        with open(join(dirpath, filename)) as file:
+                            contents[relpath(join(dirpath, filename), site_dir)] = file.read()
+                return contents
+
+            single_site = read_site(single_site_dir)
+            self.assertTrue('fish/fish-5/index.html' in single_site)
+            self.assertTrue('Trees 0' in single_site['trees/index.html'])
+            self.assertEqual(read_site(sharded_site_dir), single_site)
+            self.assertFalse(exists(join(sharded_dir, jekyll_functions.JEKYLL_SHARDS_DIRECTORY_NAME)))
+        finally:
+            rmtree(single_dir)
+            rmtree(dirname(sharded_dir))
+
+    def test_merge_shards(self):
+        ''' Each shard gets its own config, and their outputs are merged into one site.
+        '''
+        site_dir = self.make_site_corpus()
+        shard_configs = []
+
+        def fake_start_jekyll(dirname):
+            with open(join(dirname, '_config.yml')) as file:
+                config = yaml.safe_load(file)
+            shard_configs.append(config)
+
+            # every shard writes its own page, and they all write a shared one
+            index = config['chime_shard']['index']
+            makedirs(join(config['destination'], 'shard-{}'.format(index)))
+            with open(join(config['destination'], 'shard-{}'.format(index), 'index.html'), 'w') as file:
+                file.write('Shard {}'.format(index))
+            with open(join(config['destination'], 'feed.xml'), 'w') as file:
+                file.write('Feed')
+
+            return Mock(**{'wait.return_value': 0})
+
+        try:
+            with patch('chime.jekyll_functions._start_jekyll', side_effect=fake_start_jekyll):
+                built_dir = jekyll_functions.build_jekyll_site(site_dir, 3)
+
+            self.assertEqual(built_dir, join(site_dir, '_site'))
+            self.assertEqual(sorted(listdir(built_dir)), ['feed.xml', 'shard-0', 'shard-1', 'shard-2'])
+            with open(join(built_dir, 'shard-2', 'index.html')) as file:
+                self.assertEqual(file.read(), 'Shard 2')
+
+            self.assertEqual([config['chime_shard'] for config in shard_configs],
+                             [dict(index=index, count=3) for index in range(3)])
+            self.assertEqual(set([config['source'] for config in shard_configs]), set([site_dir]))
+            self.assertEqual(shard_configs[0]['exclude'], ['notes.txt'])
+            self.assertFalse(exists(join(site_dir, jekyll_functions.JEKYLL_SHARDS_DIRECTORY_NAME)))
+        finally:
+            rmtree(site_dir)
+
+    def test_failed_shard(self):
+        ''' A site with a failed shard is not merged, so it can't be published half-built.
+        '''
+        site_dir = self.make_site_corpus()
+
+        def fake_start_jekyll(dirname):
+            with open(join(dirname, '_config.yml')) as file:
+                config = yaml.safe_load(file)
+
+            makedirs(config['destination'])
+            with open(join(config['destination'], 'index.html'), 'w') as file:
+                file.write('Shard {}'.format(config['chime_shard']['index']))
+
+            # the middle shard crashes
+            return Mock(**{'wait.return_value': 1 if config['chime_shard']['index'] == 1 else 0})
+
+        try:
+            with patch('chime.jekyll_functions._start_jekyll', side_effect=fake_start_jekyll):
+                with self.assertRaises(jekyll_functions.JekyllBuildFailed) as context:
+                    jekyll_functions.build_jekyll_site(site_dir, 3)
+
+            self.assertIn('shards [1] of 3', str(context.exception))
+            self.assertFalse(exists(join(site_dir, '_site')))
+            self.assertFalse(exists(join(site_dir, jekyll_functions.JEKYLL_SHARDS_DIRECTORY_NAME)))
+        finally:
+            rmtree(site_dir)
+
 
 class TestViewFunctions (TestCase):
 
@@ -126,6 +261,71 @@ class TestViewFunctions (TestCase):
 
         self.assertEqual(sorted_list, expected_list)
 
+    # in TestViewFunctions
+    def test_directory_columns_reuse_parent_listings(self):
+        ''' Navigating deeper at the same commit only lists the new leaf directory.
+        '''
+        # other tests may have listed this same commit already
+        view_functions._directory_listing_cache.clear()
+        view_functions.make_directory_columns(self.clone, 'master', 'test-articles/test-topic/')
+
+        with patch('chime.view_functions.make_directory_listing', wraps=view_functions.make_directory_listing) as listing:
+            dir_columns = view_functions.make_directory_columns(self.clone, 'master', 'test-articles/test-topic/test-subtopic/')
+
+        self.assertEqual(len(dir_columns), 4)
+        self.assertEqual(listing.call_count, 1)
+        self.assertEqual(listing.call_args[0][1], 'test-articles/test-topic/test-subtopic')
+
+    # in TestViewFunctions
+    def test_sorted_paths_pages(self):
+        ''' Pages of a sorted directory listing add up to the whole listing.
+        '''
+        whole_list = view_functions.sorted_paths(self.clone, 'master', sort_by=constants.SORT_BY_TITLE)
+        first_page = view_functions.sorted_paths(self.clone, 'master', sort_by=constants.SORT_BY_TITLE, limit=4)
+        second_page = view_functions.sorted_paths(self.clone, 'master', sort_by=constants.SORT_BY_TITLE, offset=4, limit=4)
+        self.assertEqual(len(first_page), 4)
+        self.assertEqual(first_page + second_page, whole_list)
+
+        # sorting by date puts the most recently changed first
+        by_date = view_functions.sorted_paths(self.clone, 'master', sort_by=constants.SORT_BY_MODIFIED)
+        timestamps = [view_functions.get_modified_timestamp(self.clone, item['name']) for item in by_date]
+        self.assertEqual(timestamps, sorted(timestamps, reverse=True))
+
+    # in TestViewFunctions
+    def test_directory_columns_link_to_more(self):
+        ''' Long directory listings are cut short, with a link to the rest.
+        '''
+        dir_columns = view_functions.make_directory_columns(self.clone, 'master', 'test-articles/', limit=1)
+        self.assertEqual(len(dir_columns[1]['files']), 1)
+        self.assertEqual(dir_columns[1]['total'], 2)
+        self.assertEqual(dir_columns[1]['more_path'], u'/tree/master/listing/test-articles?offset=1&sort=title')
+
+        # the selected directory is always shown, even past the first page
+        self.assertEqual(dir_columns[0]['total'], 6)
+        self.assertTrue(dir_columns[0]['files'][-1]['selected'])
+        self.assertIsNone(dir_columns[0]['more_path'])
+
+    # in TestViewFunctions
+    def test_describe_directory_contents_from_content_index(self):
+        ''' Describing an unchanged directory again doesn't parse any files.
+        '''
+        # other tests may have described this same tree already
+        view_functions._directory_description_cache.clear()
+        view_functions._front_matter_cache.clear()
+        described = list(view_functions.describe_directory_contents(self.clone, 'test-articles/test-topic/'))
+
+        # the root comes first, then everything below it from the top down
+        self.assertEqual(described[0]['file_path'], u'test-articles/test-topic/index.{}'.format(constants.CONTENT_FILE_EXTENSION))
+        self.assertEqual(described[0]['display_type'], constants.CATEGORY_LAYOUT)
+        self.assertTrue(described[0]['is_root'])
+        depths = [len(item['file_path'].split('/')) for item in described]
+        self.assertEqual(depths, sorted(depths))
+
+        with patch('chime.view_functions.load_jekyll_doc') as load_jekyll_doc:
+            self.assertEqual(list(view_functions.describe_directory_contents(self.clone, 'test-articles/test-topic')), described)
+
+        self.assertEqual(load_jekyll_doc.call_count, 0)
+
     # in TestViewFunctions
     def test_breadcrumb_paths_with_no_relative_path(self):
         ''' Ensure that a list with pairs of a sub-directory and the absolute path
@@ -483,6 +683,138 @@ class TestHttpdStuff (TestCase):
         '''
         self.assertIsNotNone(httpd.config)
 
+    def test_precompressed_config(self):
+        ''' Apache is told to send the precompressed copies of published files.
+        '''
+        from chime import httpd
+        root = mkdtemp(prefix='chime-httpd-')
+
+        try:
+            with patch('chime.httpd.exists', return_value=True):
+                httpd.write_config('/var/site', root, 5001)
+
+            with open(join(root, 'httpd.conf')) as file:
+                config = file.read()
+        finally:
+            rmtree(root)
+
+        self.assertTrue('AddEncoding gzip .gz' in config)
+        self.assertTrue('<Directory "/var/site">' in config)
+        self.assertTrue('Header append Vary Accept-Encoding' in config)
+        self.assertTrue('RewriteCond %{REQUEST_FILENAME}index.html.br -f' in config)
+        self.assertTrue('RewriteCond %{REQUEST_FILENAME}.br -f' in config)
+        self.assertTrue('RewriteRule ^(.+)$ $1.gz [L]' in config)
+
+    def test_stale_pid_file(self):
+        ''' A pid file left by an Apache that's no longer running is ignored.
+        '''
+        from chime import httpd
+        root = mkdtemp(prefix='chime-httpd-')
+        pid_path = join(root, 'httpd.pid')
+
+        try:
+            with open(pid_path, 'w') as file:
+                file.write(str(getpid()))
+
+            self.assertTrue(httpd.is_running(pid_path))
+            self.assertIsNone(httpd.run_apache_forever('/var/site', root, 5001, False))
+
+            with open(pid_path, 'w') as file:
+                file.write('not a pid')
+
+            self.assertFalse(httpd.is_running(pid_path))
+
+            with patch('chime.httpd.write_config', side_effect=RuntimeError('No Apache here')):
+                self.assertRaises(RuntimeError, httpd.run_apache_forever, '/var/site', root, 5001, False)
+
+            self.assertFalse(isfile(pid_path))
+        finally:
+            rmtree(root)
+
+    def test_static_server(self):
+        ''' The built-in static server sends files, precompressed copies and 304s.
+        '''
+        from chime.httpd import static
+        doc_root = mkdtemp(prefix='chime-static-')
+        mkdir(join(doc_root, 'about'))
+
+        with open(join(doc_root, 'index.html'), 'w') as file:
+            file.write('<p>Hello, world.</p>')
+        with open(join(doc_root, 'index.html.gz'), 'w') as file:
+            file.write('pretend gzip')
+        with open(join(doc_root, 'about', 'index.html'), 'w') as file:
+            file.write('<p>About us.</p>')
+        with open(join(doc_root, 'big.js'), 'w') as file:
+            file.write('var x;\n' * 20000)
+
+        server = static.run_static_forever(doc_root, 0)
+        port = server.server_address[1]
+
+        def get(path, headers={}):
+            connection = httplib.HTTPConnection('127.0.0.1', port)
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+            connection.close()
+            return response, body
+
+        try:
+            response, body = get('/')
+            self.assertEqual((response.status, body), (200, '<p>Hello, world.</p>'))
+            self.assertEqual(response.getheader('Content-Type'), 'text/html')
+            self.assertIsNone(response.getheader('Content-Encoding'))
+
+            etag, last_modified = response.getheader('ETag'), response.getheader('Last-Modified')
+            response, body = get('/', {'If-None-Match': etag})
+            self.assertEqual((response.status, body), (304, ''))
+
+            response, body = get('/index.html', {'If-Modified-Since': last_modified})
+            self.assertEqual(response.status, 304)
+
+            response, body = get('/', {'Accept-Encoding': 'br, gzip'})
+            self.assertEqual((response.status, body), (200, 'pretend gzip'))
+            self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+            self.assertNotEqual(response.getheader('ETag'), etag)
+
+            response, body = get('/', {'Accept-Encoding': 'gzip;q=0'})
+            self.assertEqual(body, '<p>Hello, world.</p>')
+
+            response, body = get('/about')
+            self.assertEqual((response.status, response.getheader('Location')), (301, '/about/'))
+            self.assertEqual(get('/about/')[1], '<p>About us.</p>')
+            self.assertEqual(get('/about/index')[1], '<p>About us.</p>')
+
+            response, body = get('/big.js')
+            self.assertEqual((response.status, len(body)), (200, 140000))
+
+            self.assertEqual(get('/nothing.html')[0].status, 404)
+            self.assertEqual(get('/../' + basename(doc_root) + '/index.html')[0].status, 404)
+            self.assertEqual(get('/%2e%2e/etc/passwd')[0].status, 404)
+
+            # only the small file was kept in memory
+            self.assertEqual(server.cache.bytes, len('<p>Hello, world.</p>') + len('pretend gzip') + len('<p>About us.</p>'))
+        finally:
+            server.shutdown()
+            server.server_close()
+            rmtree(doc_root)
+
+    # in TestHttpdStuff
+    def test_one_static_server_per_port(self):
+        ''' Only the first gunicorn worker to start the static server gets the port.
+        '''
+        import chime
+        running_dir = mkdtemp(prefix='chime-running-')
+        server = chime.run_static_server(running_dir, 0)
+        port = server.server_address[1]
+
+        try:
+            self.assertEqual(server.doc_root, join(running_dir, 'master'))
+            self.assertIsNone(chime.run_static_server(running_dir, port))
+        finally:
+            server.shutdown()
+            server.server_close()
+            rmtree(running_dir)
+
 
 if __name__ == '__main__':
     main()